@@ -0,0 +1,257 @@
+"""
+Host-wide access index in shared memory.
+
+A memory-mapped file of fixed-size slots, one per user id, holding access_until, version and updated_at. Every worker
+process on the host maps the same file, so there is a single copy per host. It stays warm across restarts, and a
+lookup is a couple of struct reads with no database call and no lock.
+
+Layout: a header (magic, capacity, synced AccessChange seq, last sync time) followed by `capacity` slots of
+(seqlock counter, version + 1, access_until, updated_at), timestamps in microseconds since the epoch. A slot with a
+version of 0 is empty. Writers serialize on an flock of the file, and bump the slot's counter to odd before writing and
+back to even after. Readers retry while the counter is odd or changed during the read, up to READ_RETRIES times: a
+writer killed mid-write leaves the counter odd, and the slot is then a miss until it is written again.
+
+The index is built from the User table on first use. A webhook commit writes the slots of the users it changed, and
+every ACCESS_INDEX_SYNC_INTERVAL_SECONDS reads sync the index with the AccessChange log, which picks up changes
+committed on other hosts.
+Users that aren't in the index (ids above the capacity, or created since the last sync) fall back to the database.
+
+Each process maps the file itself: a process forked after the index was opened (e.g. by `gunicorn --preload`) reopens
+it, because flock is per open file description, and a description shared with the parent wouldn't exclude its writes.
+"""
+import fcntl
+import hashlib
+import mmap
+import os
+import struct
+import threading
+import time
+import tempfile
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+
+from cache import AccessCache, AccessState
+
+MAGIC = b"SNACCIX1"
+HEADER = struct.Struct("<8sQqd")  # magic, capacity, synced seq (-1 until built), synced at
+SLOT = struct.Struct("<IIqq")  # seqlock counter, version + 1 (0 = empty), access_until, updated_at
+COUNTER = struct.Struct("<I")
+COUNTER_AND_VERSION = struct.Struct("<II")
+NULL_TIMESTAMP = -2 ** 63
+EPOCH = datetime(1970, 1, 1)
+READ_RETRIES = 1000
+
+
+def _to_microseconds(value):
+    # naive UTC datetimes, as stored by the models
+    if value is None:
+        return NULL_TIMESTAMP
+    return (value.replace(tzinfo=None) - EPOCH) // timedelta(microseconds=1)
+
+
+def _from_microseconds(value):
+    return None if value == NULL_TIMESTAMP else EPOCH + timedelta(microseconds=value)
+
+
+class AccessIndex:
+
+    def __init__(self):
+        self.path = None
+        self.capacity = 0
+        self._file = None
+        self._map = None
+        self._lock = threading.Lock()  # flock is per open file, so threads of a process serialize here first
+        os.register_at_fork(after_in_child=self._after_fork)
+
+    @property
+    def enabled(self):
+        return self._map is not None
+
+    def init_app(self, app):
+        self.close()
+        if app.config["ACCESS_INDEX_ENABLED"]:
+            self.open(app.config["ACCESS_INDEX_PATH"] or self.default_path(app), app.config["ACCESS_INDEX_CAPACITY"])
+
+    @staticmethod
+    def default_path(app):
+        """
+        A path per app and database, so apps on the same host don't share an index (relative SQLite URIs resolve
+        against the instance path)
+        """
+        key = f"{app.instance_path}\n{app.config['SQLALCHEMY_DATABASE_URI']}".encode()
+        return os.path.join(tempfile.gettempdir(), f"supernaut-access-index-{hashlib.sha256(key).hexdigest()[:16]}")
+
+    def open(self, path, capacity):
+        """
+        Map the index file, creating it if needed. A file with a different capacity is recreated.
+        """
+        self.path, self.capacity = path, capacity
+        size = HEADER.size + capacity * SLOT.size
+
+        while True:
+            self._file = os.fdopen(os.open(path, os.O_RDWR | os.O_CREAT, 0o644), "r+b", buffering=0)
+            with self._write_lock():
+                if os.stat(path).st_ino != os.fstat(self._file.fileno()).st_ino:
+                    replaced = True  # another process replaced the file while we waited for the lock
+                else:
+                    replaced = not self._is_valid(size) and self._replace_file(size)
+
+            if not replaced:
+                break
+            self._file.close()
+
+        self._map = mmap.mmap(self._file.fileno(), size)
+
+    def _is_valid(self, size):
+        header = self._file.read(HEADER.size)
+        return (len(header) == HEADER.size and HEADER.unpack(header)[:2] == (MAGIC, self.capacity)
+                and os.fstat(self._file.fileno()).st_size == size)
+
+    def _replace_file(self, size):
+        # replaced instead of resized in place, processes that still map the old file must not crash
+        temporary_path = f"{self.path}.{os.getpid()}.tmp"
+        with open(temporary_path, "wb") as new_file:
+            new_file.truncate(size)  # sparse, pages are only allocated once a slot is written
+            new_file.write(HEADER.pack(MAGIC, self.capacity, -1, 0.0))
+        os.replace(temporary_path, self.path)
+        return True
+
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+            self._file.close()
+        self._map = self._file = None
+
+    def _after_fork(self):
+        self._lock = threading.Lock()
+        if self._map is not None:
+            self.close()
+            self.open(self.path, self.capacity)
+
+    def get(self, user_id):
+        """
+        The user's AccessState, or AccessCache.MISS if the user isn't in the index
+        """
+        if not 0 <= user_id < self.capacity:
+            return AccessCache.MISS
+
+        offset = HEADER.size + user_id * SLOT.size
+        for _ in range(READ_RETRIES):
+            counter, version, access_until, updated_at = SLOT.unpack_from(self._map, offset)
+            if counter & 1 or SLOT.unpack_from(self._map, offset)[0] != counter:
+                continue  # a write is in progress
+
+            if not version:
+                return AccessCache.MISS
+            return AccessState(_from_microseconds(access_until), version - 1, _from_microseconds(updated_at))
+
+        return AccessCache.MISS  # a writer died mid-write
+
+    def synced_seq(self):
+        return HEADER.unpack_from(self._map, 0)[2]
+
+    def is_sync_due(self, interval_seconds):
+        return time.time() - HEADER.unpack_from(self._map, 0)[3] >= interval_seconds
+
+    def rebuild(self, load_users, load_max_seq):
+        """
+        Refill the whole index from `load_users()`, rows of (id, access_until, version, updated_at).
+        `load_max_seq()` must return the current end of the AccessChange log, it is read before the users so changes
+        committed during the rebuild are applied by the next sync.
+        """
+        with self._write_lock():
+            self._rebuild(load_users, load_max_seq)
+
+    def ensure_built(self, load_users, load_max_seq):
+        """
+        Build the index if no process has built it yet
+        """
+        if self.synced_seq() >= 0:
+            return
+        with self._write_lock():
+            if self.synced_seq() < 0:
+                self._rebuild(load_users, load_max_seq)
+
+    def _rebuild(self, load_users, load_max_seq):
+        synced_seq = load_max_seq()
+        for offset in range(HEADER.size, len(self._map), SLOT.size):
+            if self._map[offset + 4:offset + 8] != b"\0\0\0\0":
+                self._clear_slot(offset)
+        for user_id, access_until, version, updated_at in load_users():
+            self._write_slot(user_id, access_until, version, updated_at, force=True)
+        self._write_header(synced_seq)
+
+    def write(self, rows):
+        """
+        Write the slots of (user_id, access_until, version, updated_at) rows, e.g. the users a commit just changed.
+        The synced seq doesn't move, the next sync still reads their changes from the log (and skips them).
+        """
+        with self._write_lock():
+            for user_id, access_until, version, updated_at in rows:
+                self._write_slot(user_id, access_until, version, updated_at)
+
+    def sync(self, load_changes, overlap, blocking=True):
+        """
+        Apply AccessChange rows from `load_changes(after_seq)`, rows of (seq, user_id, access_until, version,
+        updated_at) in seq order. The last `overlap` seqs are read again, because on Postgres a lower seq can commit
+        after a higher one was synced. Slots that already have a change's version aren't written again. Without
+        `blocking`, the sync is skipped if another process is already syncing.
+        """
+        with self._write_lock(blocking) as locked:
+            if not locked:
+                return
+            synced_seq = self.synced_seq()
+            for seq, user_id, access_until, version, updated_at in load_changes(max(synced_seq - overlap, 0)):
+                self._write_slot(user_id, access_until, version, updated_at)
+                synced_seq = max(synced_seq, seq)
+            self._write_header(synced_seq)
+
+    def _write_slot(self, user_id, access_until, version, updated_at, force=False):
+        if not 0 <= user_id < self.capacity:
+            return
+
+        offset = HEADER.size + user_id * SLOT.size
+        counter, existing_version = COUNTER_AND_VERSION.unpack_from(self._map, offset)
+        if existing_version >= version + 1 and not force:
+            return  # never go back to an older version, nor rewrite the same one
+
+        counter = self._even_counter(counter)
+        COUNTER.pack_into(self._map, offset, counter + 1)  # odd, readers retry until the write is done
+        SLOT.pack_into(self._map, offset, counter + 1, version + 1, _to_microseconds(access_until),
+                       _to_microseconds(updated_at))
+        COUNTER.pack_into(self._map, offset, (counter + 2) & 0xffffffff)
+
+    def _clear_slot(self, offset):
+        counter = self._even_counter(COUNTER.unpack_from(self._map, offset)[0])
+        COUNTER.pack_into(self._map, offset, counter + 1)
+        SLOT.pack_into(self._map, offset, counter + 1, 0, NULL_TIMESTAMP, NULL_TIMESTAMP)
+        COUNTER.pack_into(self._map, offset, (counter + 2) & 0xffffffff)
+
+    @staticmethod
+    def _even_counter(counter):
+        # odd if a writer died mid-write, the slot is repaired by starting from the next even value
+        return (counter + 1) & 0xfffffffe if counter & 1 else counter
+
+    def _write_header(self, synced_seq):
+        HEADER.pack_into(self._map, 0, MAGIC, self.capacity, synced_seq, time.time())
+
+    @contextmanager
+    def _write_lock(self, blocking=True):
+        if not self._lock.acquire(blocking):
+            yield False
+            return
+        try:
+            try:
+                fcntl.flock(self._file.fileno(), fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+            except BlockingIOError:
+                yield False
+                return
+            try:
+                yield True
+            finally:
+                fcntl.flock(self._file.fileno(), fcntl.LOCK_UN)
+        finally:
+            self._lock.release()
+
+
+access_index = AccessIndex()
@@ -0,0 +1,181 @@
+"""
+Signed access tokens, verifiable without calling this service.
+
+GET /user/<id>/access/token issues a short-lived token carrying the user's access_until and revocation version, signed
+with HMAC-SHA256 over a secret shared with downstream services. This module has no dependencies outside the standard
+library, so downstream Python services can import (or vendor) it as is:
+
+    verifier = AccessTokenVerifier(secret, revocations_url="http://access-service/access/revocations")
+    if verifier.has_access(token):
+        ...
+
+Revocations (subscription deleted, payment failed) bump the user's revocation version. The verifier pulls the
+revocation list incrementally every `refresh_interval_seconds` and rejects tokens issued before the latest revocation,
+so a revoked token stops working within that interval instead of living until it expires. On Postgres a revocation
+can commit after one with a higher id was pulled, so the verifier pulls again from below ids it skipped over until
+they arrive or fall `overlap` ids behind.
+"""
+import base64
+import hashlib
+import hmac
+import json
+import threading
+import time
+import urllib.request
+from collections import namedtuple
+
+TOKEN_PREFIX = "v1"
+
+AccessClaims = namedtuple("AccessClaims", ["user_id", "access_until", "revocation_version", "issued_at", "expires_at"])
+
+
+class AccessTokenError(ValueError):
+    pass
+
+
+def _b64encode(data):
+    return base64.urlsafe_b64encode(data).rstrip(b"=").decode()
+
+
+def _b64decode(data):
+    return base64.urlsafe_b64decode(data + "=" * (-len(data) % 4))
+
+
+def _signature(secret, signed_part):
+    if isinstance(secret, str):
+        secret = secret.encode()
+    return hmac.new(secret, signed_part.encode(), hashlib.sha256).digest()
+
+
+def encode_access_token(secret, claims):
+    """
+    Sign AccessClaims into a `v1.<payload>.<signature>` token, timestamps are unix seconds
+    """
+    payload = json.dumps(claims._asdict(), separators=(",", ":"), sort_keys=True).encode()
+    signed_part = f"{TOKEN_PREFIX}.{_b64encode(payload)}"
+    return f"{signed_part}.{_b64encode(_signature(secret, signed_part))}"
+
+
+def decode_access_token(secret, token, now=None):
+    """
+    Check the token's signature and expiry and return its AccessClaims, raises AccessTokenError otherwise
+    """
+    try:
+        prefix, payload, signature = token.split(".")
+    except (AttributeError, ValueError):
+        raise AccessTokenError("Malformed access token")
+
+    if prefix != TOKEN_PREFIX:
+        raise AccessTokenError("Unsupported access token version")
+
+    try:
+        valid = hmac.compare_digest(_b64decode(signature), _signature(secret, f"{prefix}.{payload}"))
+        claims = AccessClaims(**json.loads(_b64decode(payload))) if valid else None
+    except (ValueError, TypeError):
+        raise AccessTokenError("Malformed access token")
+
+    if claims is None:
+        raise AccessTokenError("Invalid access token signature")
+    if claims.expires_at <= (time.time() if now is None else now):
+        raise AccessTokenError("Access token expired")
+
+    return claims
+
+
+class AccessTokenVerifier:
+    """
+    Verifies access tokens locally, against a revocation list pulled from GET /access/revocations.
+    Without a revocations_url the list is only updated by apply_revocations(), so revocations are then bounded by the
+    token lifetime alone.
+    """
+
+    def __init__(self, secret, revocations_url=None, refresh_interval_seconds=5.0, timeout_seconds=2.0, overlap=1000):
+        self.secret = secret
+        self.revocations_url = revocations_url
+        self.refresh_interval_seconds = refresh_interval_seconds
+        self.timeout_seconds = timeout_seconds
+        self.overlap = overlap
+        self.cursor = None
+        self._revocation_versions = {}  # user_id -> latest revocation version
+        self._max_id = 0
+        self._missing = set()  # ids skipped over, which may still commit
+        self._refreshed_at = None
+        self._lock = threading.Lock()
+        self._refresh_lock = threading.Lock()
+
+    def apply_revocations(self, body, since=None):
+        """
+        Merge a GET /access/revocations response body, pulled with `since` (None for the first pull), into the local
+        revocation list. Ids the response skipped over are kept as missing, and the cursor stays below the first of
+        them, so a revocation that commits late is pulled by a later refresh.
+        """
+        with self._lock:
+            ids = {revocation["id"] for revocation in body["revocations"]}
+            pulled_to = max(ids | {body["cursor"]})
+            pulled_from = pulled_to - self.overlap if since is None else max(since, pulled_to - self.overlap)
+
+            for revocation in body["revocations"]:
+                user_id = revocation["user_id"]
+                self._revocation_versions[user_id] = max(
+                    self._revocation_versions.get(user_id, 0), revocation["revocation_version"])
+
+            self._missing.update(range(max(pulled_from, 0) + 1, pulled_to + 1))
+            self._max_id = max(self._max_id, pulled_to)
+            self._missing = {id_ for id_ in self._missing if id_ not in ids and id_ > self._max_id - self.overlap}
+            self.cursor = min(self._missing) - 1 if self._missing else self._max_id
+
+    def refresh(self):
+        """
+        Pull revocations newer than the cursor, following pages until the list is caught up
+        """
+        since = self.cursor
+        while True:
+            url = self.revocations_url if since is None else f"{self.revocations_url}?since={since}"
+            with urllib.request.urlopen(url, timeout=self.timeout_seconds) as response:
+                body = json.load(response)
+            self.apply_revocations(body, since)
+            if not body.get("has_more"):
+                break
+            # the next page, the cursor may be lower while ids are missing
+            since = body["cursor"]
+        self._refreshed_at = time.monotonic()
+
+    def _is_refresh_due(self):
+        return self._refreshed_at is None or time.monotonic() - self._refreshed_at >= self.refresh_interval_seconds
+
+    def _refresh_if_due(self):
+        if not self.revocations_url or not self._is_refresh_due():
+            return
+        # one thread refreshes, the others keep verifying against the list we have
+        if not self._refresh_lock.acquire(blocking=False):
+            return
+        try:
+            if self._is_refresh_due():
+                self.refresh()
+        except (OSError, ValueError, KeyError, TypeError):
+            # unreachable or a malformed response, keep verifying against the list we have, the next call retries
+            self._refreshed_at = time.monotonic()
+        finally:
+            self._refresh_lock.release()
+
+    def verify(self, token, now=None):
+        """
+        Return the token's AccessClaims, raises AccessTokenError if it is invalid, expired or revoked
+        """
+        claims = decode_access_token(self.secret, token, now)
+        self._refresh_if_due()
+
+        if claims.revocation_version < self._revocation_versions.get(claims.user_id, 0):
+            raise AccessTokenError("Access token revoked")
+        return claims
+
+    def has_access(self, token, now=None):
+        """
+        Whether the token is valid and its user's access_until is in the future
+        """
+        now = time.time() if now is None else now
+        try:
+            claims = self.verify(token, now)
+        except AccessTokenError:
+            return False
+        return claims.access_until is not None and claims.access_until > now
@@ -0,0 +1,83 @@
+"""
+Admission control for the app.
+
+Routes are grouped into classes with their own concurrency budget (ADMISSION_LIMITS), so a burst of webhook
+redeliveries can't take the worker threads and database connections that access reads need. A request that can't get a
+slot within its class's ADMISSION_QUEUE_TIMEOUT_SECONDS is shed with a 503 and a Retry-After header. Stripe honors that
+by redelivering the event later.
+"""
+import threading
+import time
+from collections import defaultdict
+from functools import wraps
+
+from flask import current_app
+
+from helpers import ResponseHelper
+from metrics import metrics
+
+
+class AdmissionController:
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._conditions = {}
+        self._in_flight = defaultdict(int)
+
+    def limit(self, route_class):
+        """
+        Decorator putting a view into a route class
+        """
+        def decorator(view):
+            @wraps(view)
+            def admitted_view(*args, **kwargs):
+                limit = current_app.config["ADMISSION_LIMITS"].get(route_class)
+                if not limit:
+                    return view(*args, **kwargs)
+
+                if not self._acquire(route_class, limit,
+                                     current_app.config["ADMISSION_QUEUE_TIMEOUT_SECONDS"].get(route_class, 0)):
+                    metrics.admission_rejections.inc(route_class)
+                    response, status_code = ResponseHelper.error("Server busy, retry later", 503)
+                    response.headers["Retry-After"] = str(current_app.config["ADMISSION_RETRY_AFTER_SECONDS"])
+                    return response, status_code
+
+                try:
+                    return view(*args, **kwargs)
+                finally:
+                    self._release(route_class)
+
+            return admitted_view
+
+        return decorator
+
+    def _condition(self, route_class):
+        condition = self._conditions.get(route_class)
+        if condition is None:
+            with self._lock:
+                condition = self._conditions.setdefault(route_class, threading.Condition())
+        return condition
+
+    def _acquire(self, route_class, limit, timeout):
+        started = time.perf_counter()
+        condition = self._condition(route_class)
+
+        with condition:
+            admitted = condition.wait_for(lambda: self._in_flight[route_class] < limit, timeout)
+            if admitted:
+                self._in_flight[route_class] += 1
+
+        metrics.admission_queue_duration.observe(route_class, time.perf_counter() - started)
+        return admitted
+
+    def _release(self, route_class):
+        condition = self._condition(route_class)
+        with condition:
+            self._in_flight[route_class] -= 1
+            condition.notify()
+
+    def in_flight(self):
+        return dict(self._in_flight)
+
+
+admission_controller = AdmissionController()
@@ -3,19 +3,45 @@ Supernaut Take Home Task
 Nojus Adomaitis, 2025
 """
 from flask import Flask
-from config import Config
+
+from access_index import access_index
+from cache import access_cache, processed_event_filter
+from commands import run_webhook_workers, prune_processed_events, rebuild_access_index, replay_events, read_archive
+from config import get_config
+from database import init_engines, read_replica_router
+from event_archive import event_archive
+from handlers.stripe_webhook_handler import StripeWebhookHandler
+from metrics import metrics
 from models import db
+from profiling import request_profiler
 from routes import api_bp
+from stripe_client import stripe_client
 
 app = Flask(__name__)
-app.config.from_object(Config)
+app.config.from_object(get_config())
 
 db.init_app(app)
+init_engines(app)
+read_replica_router.init_app(app)
+access_cache.init_app(app)
+access_index.init_app(app)
+processed_event_filter.init_app(app, StripeWebhookHandler.load_processed_event_ids)
+event_archive.init_app(app)
+metrics.init_app(app, db)
+request_profiler.init_app(app, db)
+stripe_client.init_app(app)
 
 app.register_blueprint(api_bp)
 
+app.cli.add_command(run_webhook_workers)
+app.cli.add_command(prune_processed_events)
+app.cli.add_command(rebuild_access_index)
+app.cli.add_command(replay_events)
+app.cli.add_command(read_archive)
+
 if __name__ == "__main__":
     with app.app_context():
         db.create_all()
+    processed_event_filter.start_loading()
 
     app.run(debug=True)
@@ -0,0 +1,163 @@
+"""
+ASGI entry point for the app, next to the WSGI `app` in app.py. Run it with any ASGI server, e.g.
+`uvicorn asgi:application --workers 4`.
+
+GET /user/<id>/access is served on the event loop by UserAccessHandler.get_user_access_async, which loads cache misses
+through the async engines (see database.AsyncEngines). A request waiting on the database then costs a coroutine instead
+of an OS thread, so one process can hold thousands of concurrent access checks. With the shared access index, its
+reads stay on the event loop, but building and syncing it (synchronous queries) run in a worker thread.
+
+Every other route, POST /stripe/webhook included, runs the regular Flask app in a pool of ASGI_THREAD_POOL_SIZE
+threads. Webhooks are few compared to access checks, and their writes serialize on the database anyway, so they keep
+the exact same code path: admission control, group commit, the Stripe API fetch and the post-commit hooks. Streamed
+responses (GET /access/changes) hold a pool thread while open.
+"""
+import asyncio
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from werkzeug.datastructures import Headers
+from werkzeug.http import parse_date, parse_etags
+from werkzeug.test import EnvironBuilder
+
+from app import app
+from database import async_engines
+from handlers.user_access_handler import UserAccessHandler
+from metrics import metrics
+
+ACCESS_PATH = re.compile(r"/user/(\d+)/access")
+ACCESS_ROUTE = "/user/<int:user_id>/access"
+
+
+class AsgiApp:
+
+    def __init__(self, flask_app):
+        self.flask_app = flask_app
+        self._executor = None
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            return await self._lifespan(receive, send)
+        if scope["type"] != "http":
+            return
+
+        self._startup()
+        match = ACCESS_PATH.fullmatch(scope["path"])
+        if match and scope["method"] == "GET":
+            await self._get_user_access(int(match.group(1)), scope, send)
+        else:
+            await self._dispatch_to_flask(scope, receive, send)
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                self._startup()
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                await self._shutdown()
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    def _startup(self):
+        # also done on the first request, for servers that don't send lifespan events
+        if not async_engines.initialized:
+            async_engines.init_app(self.flask_app)
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(self.flask_app.config["ASGI_THREAD_POOL_SIZE"],
+                                                thread_name_prefix="asgi-flask")
+
+    async def _shutdown(self):
+        await async_engines.dispose()
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+
+    async def _get_user_access(self, user_id, scope, send):
+        started = time.perf_counter()
+        headers = Headers([(name.decode("latin-1"), value.decode("latin-1")) for name, value in scope["headers"]])
+
+        # an app context per request, contexts are task local so concurrent requests don't share it
+        with self.flask_app.app_context():
+            response = self.flask_app.make_response(await UserAccessHandler.get_user_access_async(
+                user_id, parse_etags(headers.get("If-None-Match")), parse_date(headers.get("If-Modified-Since"))))
+
+        await send({
+            "type": "http.response.start",
+            "status": response.status_code,
+            "headers": [(name.lower().encode("latin-1"), value.encode("latin-1")) for name, value in
+                        response.headers.to_wsgi_list()],
+        })
+        await send({"type": "http.response.body", "body": response.get_data()})
+        metrics.request_duration.observe(ACCESS_ROUTE, time.perf_counter() - started)
+
+    async def _dispatch_to_flask(self, scope, receive, send):
+        body = bytearray()
+        while True:
+            message = await receive()
+            if message["type"] == "http.disconnect":
+                return
+            body += message.get("body", b"")
+            if not message.get("more_body"):
+                break
+
+        loop = asyncio.get_running_loop()
+        status, headers, chunks = await loop.run_in_executor(self._executor, self._call_wsgi_app, scope, bytes(body))
+
+        await send({"type": "http.response.start", "status": status, "headers": headers})
+        try:
+            while True:
+                chunk = await loop.run_in_executor(self._executor, next, chunks, None)
+                if chunk is None:
+                    break
+                await send({"type": "http.response.body", "body": chunk, "more_body": True})
+            await send({"type": "http.response.body", "body": b""})
+        finally:
+            await loop.run_in_executor(self._executor, getattr(chunks, "close", lambda: None))
+
+    def _call_wsgi_app(self, scope, body):
+        """
+        Call the Flask app as a WSGI server would, returns the status, the ASGI headers and the body iterator
+        """
+        server = scope.get("server") or ("localhost", 80)
+        client = scope.get("client") or ("", 0)
+        environ = EnvironBuilder(
+            path=scope["path"],
+            base_url=f"{scope.get('scheme', 'http')}://{server[0]}:{server[1]}{scope.get('root_path', '')}",
+            query_string=scope["query_string"].decode("latin-1"),
+            method=scope["method"],
+            headers=Headers([(name.decode("latin-1"), value.decode("latin-1")) for name, value in scope["headers"]]),
+            data=body,
+            environ_base={"REMOTE_ADDR": client[0], "REMOTE_PORT": client[1]},
+        ).get_environ()
+
+        response_start = {}
+
+        def start_response(status, headers, exc_info=None):
+            response_start["status"] = int(status.split(" ", 1)[0])
+            response_start["headers"] = [(name.lower().encode("latin-1"), value.encode("latin-1"))
+                                         for name, value in headers]
+
+        iterable = self.flask_app.wsgi_app(environ, start_response)
+        chunks = iter(iterable)
+        if hasattr(iterable, "close"):
+            chunks = _ClosingIterator(chunks, iterable.close)
+        return response_start["status"], response_start["headers"], chunks
+
+
+class _ClosingIterator:
+    __slots__ = ("_iterator", "close")
+
+    def __init__(self, iterator, close):
+        self._iterator = iterator
+        self.close = close
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return next(self._iterator)
+
+
+application = AsgiApp(app)
@@ -0,0 +1,87 @@
+"""
+Benchmark: GET /user/<id>/access, ORM path vs the compiled Core path.
+
+Compares the previous implementation (db.session.get + ResponseHelper.success/jsonify) with
+UserAccessHandler.get_user_access, with the access cache disabled so every call hits the database, enabled, and with
+the shared access index.
+Handlers are called directly inside a request context, so the numbers exclude WSGI and HTTP overhead.
+
+Usage: python -m benchmarks.bench_access_path [--users 1000] [--calls 20000]
+"""
+import argparse
+import os
+import random
+import tempfile
+import time
+from datetime import datetime, timezone, timedelta
+
+os.environ.setdefault("DATABASE_URL", f"sqlite:///{tempfile.mkdtemp()}/bench_access_path.db")
+
+from app import app  # noqa: E402 -- DATABASE_URL must be set before the app is configured
+from access_index import access_index  # noqa: E402
+from cache import access_cache  # noqa: E402
+from handlers.user_access_handler import UserAccessHandler  # noqa: E402
+from helpers import ResponseHelper  # noqa: E402
+from models import db, User  # noqa: E402
+
+
+def orm_get_user_access(user_id):
+    """
+    The ORM implementation get_user_access had before the Core path, kept here as the baseline
+    """
+    user = db.session.get(User, user_id)
+    if not user:
+        return ResponseHelper.error("User not found", 404)
+
+    return ResponseHelper.success(UserAccessHandler._access_status(user.id, user.access_until))
+
+
+def run(handler, user_ids):
+    started = time.perf_counter()
+    for user_id in user_ids:
+        with app.test_request_context(f"/user/{user_id}/access"):
+            handler(user_id)
+            db.session.remove()  # what Flask-SQLAlchemy does at the end of every request
+    return (time.perf_counter() - started) / len(user_ids) * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--calls", type=int, default=20000)
+    args = parser.parse_args()
+
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        now = datetime.now(timezone.utc)
+        db.session.add_all([User(stripe_customer_id=f"cus_{i}", access_until=now + timedelta(days=i % 60 - 30))
+                            for i in range(args.users)])
+        db.session.commit()
+
+    rng = random.Random(1)
+    user_ids = [rng.randint(1, args.users) for _ in range(args.calls)]
+
+    results = []
+    access_cache.max_size = 0  # every call goes to the database
+    results.append(("ORM + jsonify (previous)", run(orm_get_user_access, user_ids)))
+    results.append(("Core + direct body, no cache", run(UserAccessHandler.get_user_access, user_ids)))
+    access_cache.max_size = args.users
+    access_cache.clear()
+    results.append(("Core + direct body, cached", run(UserAccessHandler.get_user_access, user_ids)))
+    access_cache.max_size = 0
+    access_index.open(os.path.join(tempfile.mkdtemp(), "access-index"), args.users + 1)
+    results.append(("Core + direct body, shared index", run(UserAccessHandler.get_user_access, user_ids)))
+    access_index.close()
+
+    baseline = results[0][1]
+    print(f"{'implementation':<34} {'us/call':>9} {'speedup':>8}")
+    for name, per_call in results:
+        print(f"{name:<34} {per_call:>9.1f} {baseline / per_call:>7.2f}x")
+
+    with app.app_context():
+        db.drop_all()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,79 @@
+"""
+Benchmark: webhook latency as the stripe_processed_event table grows.
+
+Fills the table with synthetic processed events in steps, and at every step measures per-event latency of new events
+(which skip the idempotency probe thanks to the processed event filter) and of redeliveries of known events.
+Latency should stay flat as the table grows.
+
+Usage: python -m benchmarks.bench_processed_events [--sizes 0,10000,100000,500000] [--events 500]
+"""
+import argparse
+import os
+import statistics
+import tempfile
+import time
+from datetime import datetime, timezone
+
+os.environ.setdefault("DATABASE_URL", f"sqlite:///{tempfile.mkdtemp()}/bench_processed_events.db")
+
+from app import app  # noqa: E402 -- DATABASE_URL must be set before the app is configured
+from cache import processed_event_filter  # noqa: E402
+from handlers.stripe_webhook_handler import StripeWebhookHandler  # noqa: E402
+from models import db, StripeProcessedEvent  # noqa: E402
+from tests.conftest import create_subscription_event  # noqa: E402
+
+
+def fill_table(target_size):
+    current_size = db.session.query(StripeProcessedEvent).count()
+    now = datetime.now(timezone.utc)
+    rows = [{"stripe_event_id": f"evt_filler_{i}", "processed_at": now} for i in range(current_size, target_size)]
+    for start in range(0, len(rows), 50000):
+        db.session.execute(db.insert(StripeProcessedEvent), rows[start:start + 50000])
+    db.session.commit()
+
+
+def measure(client, event_ids):
+    latencies = []
+    for event_id in event_ids:
+        event = create_subscription_event(event_id, "customer.subscription.updated", f"cus_{event_id[-2:]}")
+        started = time.perf_counter()
+        response = client.post("/stripe/webhook", data=event, content_type='application/json')
+        latencies.append((time.perf_counter() - started) * 1000)
+        assert response.status_code == 200, response.json
+    return latencies
+
+
+def summarize(latencies):
+    latencies = sorted(latencies)
+    return statistics.median(latencies), latencies[int(len(latencies) * 0.95) - 1]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", default="0,10000,100000,500000", help="Comma separated table sizes.")
+    parser.add_argument("--events", type=int, default=500, help="Events measured per table size.")
+    args = parser.parse_args()
+
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        client = app.test_client()
+
+        print(f"{'table rows':>12} {'new p50 ms':>11} {'new p95 ms':>11} {'dup p50 ms':>11} {'dup p95 ms':>11}")
+        for step, size in enumerate(int(size) for size in args.sizes.split(",")):
+            fill_table(size)
+            # simulate a restart, the filter is rebuilt at startup
+            processed_event_filter.clear()
+            processed_event_filter.load(StripeWebhookHandler.load_processed_event_ids())
+
+            new_ids = [f"evt_bench_{step}_{i:06d}" for i in range(args.events)]
+            new_p50, new_p95 = summarize(measure(client, new_ids))
+            dup_p50, dup_p95 = summarize(measure(client, new_ids))
+
+            print(f"{size:>12} {new_p50:>11.3f} {new_p95:>11.3f} {dup_p50:>11.3f} {dup_p95:>11.3f}")
+
+        db.drop_all()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+"""
+Benchmark: a burst of invoice.paid subscription fetches against the local fake Stripe API (tests/fake_stripe.py).
+
+Compares a naive fetcher (a new connection per request, no cache, no coalescing) with stripe_client.StripeClient,
+with many threads fetching a small set of subscriptions at once, like the renewals at the start of a billing period.
+The client's pool caps concurrent requests to Stripe at --pool-size, so with fewer connections than threads the first
+fetch of each subscription may queue for a connection -- that's the price of staying under Stripe's rate limits.
+
+Usage: python -m benchmarks.bench_subscription_fetch [--fetches 2000] [--subscriptions 200] [--threads 32]
+       [--latency-ms 20] [--pool-size 10]
+"""
+import argparse
+import http.client
+import json
+import random
+import statistics
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+
+from stripe_client import StripeClient
+from tests.fake_stripe import FakeStripeServer
+
+
+def naive_fetch(base_url, subscription_id):
+    url = urlsplit(base_url)
+    connection = http.client.HTTPConnection(url.hostname, url.port, timeout=10)
+    try:
+        connection.request("GET", f"/v1/subscriptions/{subscription_id}", headers={"Authorization": "Bearer sk_test"})
+        return json.loads(connection.getresponse().read())
+    finally:
+        connection.close()
+
+
+def run(fetch, subscription_ids, threads):
+    def timed(subscription_id):
+        started = time.perf_counter()
+        fetch(subscription_id)
+        return time.perf_counter() - started
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        latencies = sorted(executor.map(timed, subscription_ids))
+    elapsed = time.perf_counter() - started
+    return elapsed, statistics.median(latencies), latencies[int(len(latencies) * 0.99) - 1]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--fetches", type=int, default=2000)
+    parser.add_argument("--subscriptions", type=int, default=200)
+    parser.add_argument("--threads", type=int, default=32)
+    parser.add_argument("--latency-ms", type=float, default=20)
+    parser.add_argument("--pool-size", type=int, default=10)
+    args = parser.parse_args()
+
+    server = FakeStripeServer(args.latency_ms / 1000, generate_subscriptions=True)
+    base_url = server.start()
+
+    rng = random.Random(1)
+    subscription_ids = [f"sub_{rng.randrange(args.subscriptions)}" for _ in range(args.fetches)]
+
+    client = StripeClient(api_key="sk_test", base_url=base_url, pool_size=args.pool_size)
+
+    results = []
+    for name, fetch in (("new connection per fetch", lambda subscription_id: naive_fetch(base_url, subscription_id)),
+                        ("pooled + cached + coalesced", client.get_subscription)):
+        requests_before = server.requests
+        elapsed, p50, p99 = run(fetch, subscription_ids, args.threads)
+        results.append((name, elapsed, p50, p99, server.requests - requests_before))
+
+    client.close()
+    server.stop()
+
+    print(f"{'fetcher':<28} {'total s':>8} {'p50 ms':>8} {'p99 ms':>8} {'requests':>9}")
+    for name, elapsed, p50, p99, requests in results:
+        print(f"{name:<28} {elapsed:>8.2f} {p50 * 1000:>8.1f} {p99 * 1000:>8.1f} {requests:>9}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,265 @@
+"""
+End-to-end load test: replays a synthetic Stripe event stream against a locally started server.
+
+Webhook senders POST a realistic mix of events to /stripe/webhook (with configurable duplicate and redelivery rates and
+customer cardinality) while readers concurrently poll /user/<id>/access. Throughput and p50/p95/p99 latency are
+reported per route and per event type, and written as JSON so runs can be compared between commits.
+
+Usage:
+    python -m benchmarks.load_test --events 5000 --output before.json
+    python -m benchmarks.load_test --events 5000 --output after.json --compare before.json
+"""
+import argparse
+import http.client
+import json
+import os
+import random
+import subprocess
+import tempfile
+import threading
+import time
+import zlib
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+os.environ.setdefault("DATABASE_URL", f"sqlite:///{tempfile.mkdtemp()}/load_test.db")
+
+from werkzeug.serving import make_server, WSGIRequestHandler  # noqa: E402
+
+from app import app  # noqa: E402 -- DATABASE_URL must be set before the app is configured
+from models import db  # noqa: E402
+from tests.conftest import create_subscription_event, create_invoice_event, create_bare_event  # noqa: E402
+
+# relative frequency of event types in the stream, roughly what a subscription business sees
+EVENT_MIX = {
+    "customer.subscription.created": 10,
+    "customer.subscription.updated": 30,
+    "invoice.paid": 35,
+    "invoice.payment_failed": 5,
+    "customer.subscription.deleted": 5,
+    "charge.succeeded": 15,  # irrelevant event type, ignored by the handler
+}
+SUBSCRIPTION_STATUSES = ["active"] * 8 + ["trialing", "past_due", "canceled", "unpaid"]
+
+
+def build_event_stream(events, customers, duplicate_rate, redelivery_rate, seed):
+    """
+    Build a list of (event_type, payload) tuples. Duplicates are sent right after the original (concurrent
+    redelivery), redeliveries repeat a random earlier event (Stripe retrying later).
+    """
+    rng = random.Random(seed)
+    event_types = list(EVENT_MIX)
+    weights = list(EVENT_MIX.values())
+    stream = []
+
+    for index in range(events):
+        if stream and rng.random() < redelivery_rate:
+            stream.append(rng.choice(stream))
+            continue
+
+        event_type = rng.choices(event_types, weights)[0]
+        event_id = f"evt_load_{seed}_{index}"
+        customer_id = f"cus_load_{rng.randrange(customers)}"
+
+        if event_type.startswith("customer.subscription.") and event_type != "customer.subscription.deleted":
+            period_end = int(time.time()) + rng.randrange(1, 60) * 86400
+            payload = create_subscription_event(event_id, event_type, customer_id, rng.choice(SUBSCRIPTION_STATUSES),
+                                                period_end, subscription_id=f"sub_{customer_id}",
+                                                created=int(time.time()) + index)
+        elif event_type.startswith("invoice."):
+            payload = create_invoice_event(event_id, event_type, customer_id, f"sub_{customer_id}")
+        else:
+            payload = create_bare_event(event_id, event_type, customer_id)
+
+        stream.append((event_type, payload))
+        if rng.random() < duplicate_rate:
+            stream.append((event_type, payload))
+
+    return stream
+
+
+class QuietRequestHandler(WSGIRequestHandler):
+    protocol_version = "HTTP/1.1"  # keep-alive, so connection setup isn't part of the measured latency
+
+    def log_request(self, *args, **kwargs):
+        pass
+
+
+class LoadTestServer:
+    """
+    The app served by a threaded werkzeug server on a free local port
+    """
+
+    def __init__(self):
+        self.server = make_server("127.0.0.1", 0, app, threaded=True, request_handler=QuietRequestHandler)
+        self.port = self.server.server_port
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.server.shutdown()
+
+
+class Recorder:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.latencies = defaultdict(list)  # series name -> latencies in ms
+        self.errors = defaultdict(int)
+
+    def record(self, series, latency_ms, ok):
+        with self._lock:
+            for name in series:
+                self.latencies[name].append(latency_ms)
+                if not ok:
+                    self.errors[name] += 1
+
+
+def percentile(sorted_values, fraction):
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * fraction))]
+
+
+def request(connection, method, path, body=None):
+    headers = {"Content-Type": "application/json"} if body else {}
+    started = time.perf_counter()
+    connection.request(method, path, body=body, headers=headers)
+    response = connection.getresponse()
+    response_body = response.read()
+    return (time.perf_counter() - started) * 1000, response.status, response_body
+
+
+def run_webhook_sender(port, stream, recorder, user_ids):
+    connection = http.client.HTTPConnection("127.0.0.1", port)
+    for event_type, payload in stream:
+        latency, status, body = request(connection, "POST", "/stripe/webhook", payload)
+        recorder.record(["route:/stripe/webhook", f"event:{event_type}"], latency, status < 500)
+
+        message = json.loads(body).get("message", "")
+        if "user id " in message:
+            user_ids.append(int(message.split("user id ")[1]))
+    connection.close()
+
+
+def run_access_reader(port, stop_event, recorder, user_ids, seed):
+    rng = random.Random(seed)
+    connection = http.client.HTTPConnection("127.0.0.1", port)
+    while not stop_event.is_set():
+        if not user_ids:
+            time.sleep(0.001)
+            continue
+        latency, status, _ = request(connection, "GET", f"/user/{rng.choice(user_ids)}/access")
+        recorder.record(["route:/user/<id>/access"], latency, status in (200, 404))
+    connection.close()
+
+
+def summarize(recorder, elapsed):
+    summary = {}
+    for name, latencies in sorted(recorder.latencies.items()):
+        latencies = sorted(latencies)
+        summary[name] = {
+            "requests": len(latencies),
+            "errors": recorder.errors[name],
+            "throughput_rps": round(len(latencies) / elapsed, 1),
+            "p50_ms": round(percentile(latencies, 0.50), 3),
+            "p95_ms": round(percentile(latencies, 0.95), 3),
+            "p99_ms": round(percentile(latencies, 0.99), 3),
+        }
+    return summary
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_report(summary, baseline=None):
+    header = f"{'series':<45} {'requests':>9} {'errors':>7} {'rps':>9} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}"
+    print(header)
+    print("-" * len(header))
+    for name, stats in summary.items():
+        line = (f"{name:<45} {stats['requests']:>9} {stats['errors']:>7} {stats['throughput_rps']:>9} "
+                f"{stats['p50_ms']:>9} {stats['p95_ms']:>9} {stats['p99_ms']:>9}")
+        if baseline and name in baseline:
+            before = baseline[name]
+            line += (f"   rps {_delta(before['throughput_rps'], stats['throughput_rps'])}"
+                     f"  p99 {_delta(before['p99_ms'], stats['p99_ms'])}")
+        print(line)
+
+
+def _delta(before, after):
+    if not before:
+        return "n/a"
+    return f"{(after - before) / before * 100:+.1f}%"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--events", type=int, default=2000, help="Number of distinct events in the stream.")
+    parser.add_argument("--customers", type=int, default=200, help="Customer cardinality.")
+    parser.add_argument("--duplicate-rate", type=float, default=0.05, help="Share of events sent twice in a row.")
+    parser.add_argument("--redelivery-rate", type=float, default=0.05,
+                        help="Share of the stream that repeats a random earlier event.")
+    parser.add_argument("--webhook-workers", type=int, default=4, help="Concurrent webhook senders.")
+    parser.add_argument("--access-workers", type=int, default=8, help="Concurrent access readers.")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="Write the JSON report to this file.")
+    parser.add_argument("--compare", help="JSON report of an earlier run to compare against.")
+    args = parser.parse_args()
+
+    stream = build_event_stream(args.events, args.customers, args.duplicate_rate, args.redelivery_rate, args.seed)
+    # each customer's events go to the same sender, so they are delivered in order like Stripe (mostly) does
+    partitions = defaultdict(list)
+    for event_type, payload in stream:
+        customer_id = json.loads(payload)["data"]["object"]["customer"]
+        partitions[zlib.crc32(customer_id.encode()) % args.webhook_workers].append((event_type, payload))
+
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+
+    recorder = Recorder()
+    user_ids = []
+    stop_event = threading.Event()
+
+    with LoadTestServer() as server, ThreadPoolExecutor(args.webhook_workers + args.access_workers) as executor:
+        started = time.perf_counter()
+        readers = [executor.submit(run_access_reader, server.port, stop_event, recorder, user_ids, args.seed + index)
+                   for index in range(args.access_workers)]
+        senders = [executor.submit(run_webhook_sender, server.port, partition, recorder, user_ids)
+                   for partition in partitions.values()]
+
+        for sender in senders:
+            sender.result()
+        stop_event.set()
+        for reader in readers:
+            reader.result()
+        elapsed = time.perf_counter() - started
+
+    report = {
+        "commit": git_commit(),
+        "parameters": vars(args),
+        "elapsed_seconds": round(elapsed, 3),
+        "results": summarize(recorder, elapsed),
+    }
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            baseline = json.load(baseline_file)["results"]
+
+    print_report(report["results"], baseline)
+    if args.output:
+        with open(args.output, "w") as output_file:
+            json.dump(report, output_file, indent=2)
+
+    with app.app_context():
+        db.drop_all()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,223 @@
+"""
+In-process caches for the app
+"""
+import hashlib
+import math
+import os
+import threading
+import time
+from collections import OrderedDict, namedtuple
+
+# what the access cache stores per user, has_access is derived from access_until on every read
+AccessState = namedtuple("AccessState", ["access_until", "version", "updated_at"])
+
+
+class AccessCache:
+    """
+    LRU + TTL cache of users' AccessState, keyed by user id.
+    Only timestamps are cached -- has_access is recomputed by the caller on every hit, so an entry never goes stale
+    just because time has passed. Entries are invalidated by the webhook handler after its commit succeeds; the TTL
+    bounds staleness for changes committed by other processes.
+    """
+
+    MISS = object()
+
+    def __init__(self, max_size=10000, ttl_seconds=30.0):
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        self._entries = OrderedDict()  # user_id -> (state, expires_at)
+        self._lock = threading.Lock()
+        self._generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def init_app(self, app):
+        self.max_size = app.config["ACCESS_CACHE_MAX_SIZE"]
+        self.ttl_seconds = app.config["ACCESS_CACHE_TTL_SECONDS"]
+        self.clear()
+
+    def generation(self):
+        """
+        Current invalidation generation, read it before loading a value from the database and pass it to set()
+        """
+        return self._generation
+
+    def get(self, user_id):
+        """
+        Return the cached AccessState or AccessCache.MISS
+        """
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is None:
+                self.misses += 1
+                return AccessCache.MISS
+
+            state, expires_at = entry
+            if expires_at <= time.monotonic():
+                del self._entries[user_id]
+                self.evictions += 1
+                self.misses += 1
+                return AccessCache.MISS
+
+            self._entries.move_to_end(user_id)
+            self.hits += 1
+            return state
+
+    def set(self, user_id, state, generation):
+        """
+        Cache a value loaded from the database. The value is dropped if any invalidation happened since the load
+        started, otherwise a read racing with a webhook commit could cache the pre-commit value.
+        """
+        if self.max_size <= 0:
+            return
+
+        with self._lock:
+            if generation != self._generation:
+                return
+
+            self._entries[user_id] = (state, time.monotonic() + self.ttl_seconds)
+            self._entries.move_to_end(user_id)
+
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, *user_ids):
+        """
+        Drop entries for users whose row has changed, must be called only after the change is committed
+        """
+        with self._lock:
+            self._generation += 1
+            for user_id in user_ids:
+                if self._entries.pop(user_id, None) is not None:
+                    self.invalidations += 1
+
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+            self._entries.clear()
+            self.hits = self.misses = self.evictions = self.invalidations = 0
+
+    def stats(self):
+        return {
+            "size": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "invalidations": self.invalidations,
+        }
+
+
+access_cache = AccessCache()
+
+
+class ProcessedEventFilter:
+    """
+    Bloom filter of processed Stripe event ids, rebuilt from the database by a background thread at startup.
+    A negative answer means this process has never seen the id, so brand-new events can skip the database probe and
+    go straight to the claim. Until the filter is loaded every answer is positive, so requests never wait for the
+    rebuild. It is only advisory -- ids claimed by other processes are missing here, and the ON CONFLICT claim in the
+    webhook handler stays the source of truth.
+    """
+
+    def __init__(self, capacity=1000000, error_rate=0.01):
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self._lock = threading.Lock()
+        self._app = None
+        self._load_event_ids = None
+        self._reset()
+        os.register_at_fork(after_in_child=self._after_fork)
+
+    def init_app(self, app, load_event_ids):
+        """
+        Start rebuilding the filter from `load_event_ids()`, called in an app context
+        """
+        self.capacity = app.config["PROCESSED_EVENT_FILTER_CAPACITY"]
+        self.error_rate = app.config["PROCESSED_EVENT_FILTER_ERROR_RATE"]
+        self._app = app
+        self._load_event_ids = load_event_ids
+        self.clear()
+        self.start_loading()
+
+    def _reset(self):
+        # standard sizing: m = -n * ln(p) / ln(2)^2 bits, k = m / n * ln(2) hash functions
+        self._bits_count = max(8, int(-self.capacity * math.log(self.error_rate) / math.log(2) ** 2))
+        self._hash_count = max(1, round(self._bits_count / max(self.capacity, 1) * math.log(2)))
+        self._bits = bytearray((self._bits_count + 7) // 8) if self.capacity > 0 else None
+        self._loaded = False
+
+    @property
+    def enabled(self):
+        return self._bits is not None
+
+    def _positions(self, event_id):
+        # double hashing, k positions from a single digest
+        digest = hashlib.blake2b(event_id.encode(), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        return [(h1 + i * h2) % self._bits_count for i in range(self._hash_count)]
+
+    def add(self, *event_ids):
+        if not self.enabled:
+            return
+        for event_id in event_ids:
+            for position in self._positions(event_id):
+                self._bits[position >> 3] |= 1 << (position & 7)
+
+    def might_contain(self, event_id):
+        """
+        False means the id was definitely never added, True means it probably was (or the filter is disabled or not
+        loaded yet)
+        """
+        if not self.enabled or not self._loaded:
+            return True
+        return all(self._bits[position >> 3] & (1 << (position & 7)) for position in self._positions(event_id))
+
+    @property
+    def loaded(self):
+        return self._loaded
+
+    def load(self, event_ids):
+        """
+        Add all `event_ids`, then start answering. Ids added meanwhile by committed webhooks are kept. A clear()
+        during the load discards it.
+        """
+        if not self.enabled:
+            return
+        bits = self._bits
+        for event_id in event_ids:
+            self.add(event_id)
+        with self._lock:
+            if self._bits is bits:
+                self._loaded = True
+
+    def start_loading(self):
+        """
+        Load the filter in a background thread, if it has a loader and isn't loaded yet
+        """
+        if self._load_event_ids is None or self._loaded or not self.enabled:
+            return
+        threading.Thread(target=self._load_in_background, name="processed-event-filter", daemon=True).start()
+
+    def _load_in_background(self):
+        try:
+            with self._app.app_context():
+                self.load(self._load_event_ids())
+        except Exception as e:
+            # e.g. the table doesn't exist yet, the filter then stays unloaded and every probe goes to the database
+            self._app.logger.warning(f"Failed to load the processed event filter: {type(e).__name__}")
+
+    def _after_fork(self):
+        # a preloading server forks after init_app, the loader thread didn't survive if it hadn't finished yet
+        self._lock = threading.Lock()
+        self.start_loading()
+
+    def clear(self):
+        with self._lock:
+            self._reset()
+
+
+processed_event_filter = ProcessedEventFilter()
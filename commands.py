@@ -0,0 +1,125 @@
+"""
+CLI commands for the app
+"""
+import json
+import time
+from datetime import timezone
+
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+
+from access_index import access_index
+from event_archive import ArchiveReader
+from handlers.access_index_handler import AccessIndexHandler
+from handlers.event_replay_handler import EventReplayHandler, CheckpointMismatchError
+from handlers.event_retention_handler import EventRetentionHandler
+from handlers.webhook_queue_handler import WebhookQueueWorkerPool
+
+
+@click.command("webhook-workers")
+@with_appcontext
+def run_webhook_workers():
+    """
+    Run the webhook queue worker pool in the foreground (async webhook mode)
+    """
+    pool = WebhookQueueWorkerPool(current_app._get_current_object())
+    pool.start()
+    click.echo(f"Started {pool.workers} webhook workers, press Ctrl+C to stop")
+
+    try:
+        pool.join()
+    except KeyboardInterrupt:
+        click.echo("Stopping webhook workers")
+        pool.stop()
+
+
+@click.command("prune-events")
+@click.option("--retention-days", type=float, default=None,
+              help="Override PROCESSED_EVENT_RETENTION_DAYS.")
+@click.option("--chunk-size", type=int, default=1000, show_default=True, help="Rows deleted per transaction.")
+@with_appcontext
+def prune_processed_events(retention_days, chunk_size):
+    """
+    Delete processed Stripe events older than the retention window
+    """
+    if retention_days is None:
+        retention_days = current_app.config["PROCESSED_EVENT_RETENTION_DAYS"]
+
+    deleted = EventRetentionHandler.prune_processed_events(retention_days, chunk_size)
+    click.echo(f"Deleted {deleted} processed events older than {retention_days} days")
+
+
+@click.command("rebuild-access-index")
+@with_appcontext
+def rebuild_access_index():
+    """
+    Rebuild the shared access index from the User table, e.g. from a gunicorn on_starting hook
+    """
+    if not access_index.enabled:
+        raise click.ClickException("The access index is disabled, set ACCESS_INDEX_ENABLED")
+
+    AccessIndexHandler.rebuild_access_index()
+    click.echo(f"Rebuilt the access index at {access_index.path}")
+
+
+@click.command("replay-events")
+@click.argument("export", type=click.File("r"))
+@click.option("--checkpoint", default=None,
+              help="Checkpoint file to resume from, defaults to <export>.checkpoint (required when reading stdin).")
+@click.option("--partitions", type=int, default=16, show_default=True,
+              help="Customer partitions, only one is held in memory at a time.")
+@click.option("--batch-size", type=int, default=5000, show_default=True, help="Events per transaction.")
+@click.option("--progress-interval", type=float, default=5, show_default=True,
+              help="Seconds between progress reports.")
+@with_appcontext
+def replay_events(export, checkpoint, partitions, batch_size, progress_interval):
+    """
+    Replay a JSONL export of Stripe events through the webhook handler, per customer in created order
+    """
+    if checkpoint is None:
+        if export.name == "<stdin>":
+            raise click.UsageError("--checkpoint is required when reading the export from stdin")
+        checkpoint = f"{export.name}.checkpoint"
+
+    last_report = time.monotonic()
+
+    def report_progress(stats):
+        nonlocal last_report
+        if time.monotonic() - last_report >= progress_interval:
+            last_report = time.monotonic()
+            click.echo(f"Replayed {stats.replayed}/{stats.total} events "
+                       f"({stats.replayed / stats.total:.0%}), {stats.events_per_second:.0f} events/s")
+
+    try:
+        stats = EventReplayHandler.replay_events(export, checkpoint, partitions, batch_size, report_progress)
+    except CheckpointMismatchError as e:
+        raise click.ClickException(str(e))
+    except Exception as e:
+        raise click.ClickException(f"Replay failed: {e} -- run it again to resume from {checkpoint}")
+
+    click.echo(f"Replayed {stats.replayed} events: {stats.processed} processed, {stats.duplicates} duplicates, "
+               f"{stats.failed} failed, {stats.ignored} ignored, {stats.invalid} invalid, "
+               f"{stats.events_per_second:.0f} events/s")
+
+
+@click.command("read-archive")
+@click.option("--directory", default=None, help="Archive directory, defaults to EVENT_ARCHIVE_DIR.")
+@click.option("--event-id", default=None, help="Only this event, found through the segment indexes.")
+@click.option("--since", type=click.DateTime(), default=None, help="Only events received at or after (UTC).")
+@click.option("--until", type=click.DateTime(), default=None, help="Only events received before (UTC).")
+@click.option("--records", is_flag=True, help="Print the archive records, with the time each event was received.")
+@with_appcontext
+def read_archive(directory, event_id, since, until, records):
+    """
+    Print archived webhook events as JSON lines, e.g. to pipe into `flask replay-events - --checkpoint ...`
+    """
+    reader = ArchiveReader(directory or current_app.config["EVENT_ARCHIVE_DIR"])
+    if event_id is not None:
+        found = reader.find(event_id)
+    else:
+        found = reader.records(since.replace(tzinfo=timezone.utc).timestamp() if since else None,
+                               until.replace(tzinfo=timezone.utc).timestamp() if until else None)
+
+    for record in found:
+        click.echo(json.dumps(record if records else record["event"], separators=(",", ":")))
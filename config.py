@@ -1,8 +1,168 @@
 """
 Configuration settings for the app
 """
+import os
 
 
 class Config:
-    SQLALCHEMY_DATABASE_URI = 'sqlite:///supernaut.db'  # sqlite here for simplicity
+    SQLALCHEMY_DATABASE_URI = os.environ.get("DATABASE_URL", 'sqlite:///supernaut.db')  # sqlite here for simplicity
     SQLALCHEMY_TRACK_MODIFICATIONS = False
+
+    # optional read replica for the read-only endpoints, see database.ReadReplicaRouter
+    DATABASE_REPLICA_URL = os.environ.get("DATABASE_REPLICA_URL")
+    SQLALCHEMY_BINDS = {"replica": DATABASE_REPLICA_URL} if DATABASE_REPLICA_URL else {}
+    # reads of a user go to the primary for this long after a webhook changed it, 0 disables the pinning
+    READ_YOUR_WRITES_SECONDS = 5
+
+    # ASGI app (see asgi.py): options for the async engines, and the threads serving the routes that stay synchronous
+    SQLALCHEMY_ASYNC_ENGINE_OPTIONS = {}
+    ASGI_THREAD_POOL_SIZE = 16
+
+    # upper bound for the number of events accepted by POST /stripe/webhook/batch
+    WEBHOOK_BATCH_MAX_EVENTS = 1000
+
+    # in-process LRU + TTL cache in front of GET /user/<id>/access, a max size of 0 disables it
+    ACCESS_CACHE_MAX_SIZE = 10000
+    ACCESS_CACHE_TTL_SECONDS = 30
+
+    # upper bound for how long clients and CDNs may cache GET /user/<id>/access, since revocations can come any time
+    ACCESS_HTTP_MAX_AGE_SECONDS = 60
+
+    # signed access tokens (GET /user/<id>/access/token), the endpoint is disabled without a secret
+    ACCESS_TOKEN_SECRET = os.environ.get("ACCESS_TOKEN_SECRET")
+    ACCESS_TOKEN_TTL_SECONDS = 300
+    ACCESS_REVOCATIONS_PAGE_SIZE = 1000
+
+    # GET /access/changes: how often a stream polls for changes committed by other processes (changes committed in
+    # this process wake it up immediately), how many changes are read per query, the keep-alive interval, and for how
+    # many seqs a skipped seq is watched for a late commit (on Postgres a lower seq can commit after a higher one)
+    ACCESS_CHANGES_POLL_INTERVAL_SECONDS = 1.0
+    ACCESS_CHANGES_PAGE_SIZE = 1000
+    ACCESS_CHANGES_KEEPALIVE_SECONDS = 15
+    ACCESS_CHANGES_OVERLAP = 1000
+
+    # host-wide access index shared by all worker processes through a memory-mapped file, see access_index.py
+    ACCESS_INDEX_ENABLED = os.environ.get("ACCESS_INDEX_ENABLED", "").lower() in ("1", "true")
+    # None derives a path in the temp directory from the instance path and the database URI, see access_index.py
+    ACCESS_INDEX_PATH = os.environ.get("ACCESS_INDEX_PATH")
+    ACCESS_INDEX_CAPACITY = int(os.environ.get("ACCESS_INDEX_CAPACITY", 1 << 20))  # user ids below this are indexed
+    ACCESS_INDEX_SYNC_INTERVAL_SECONDS = 1.0
+    ACCESS_INDEX_SYNC_OVERLAP = 1000
+
+    # Stripe API client (see stripe_client.py), used by invoice.paid for subscriptions the local store doesn't know.
+    # Disabled without an API key.
+    STRIPE_API_KEY = os.environ.get("STRIPE_API_KEY")
+    STRIPE_API_BASE_URL = os.environ.get("STRIPE_API_BASE_URL", "https://api.stripe.com")
+    STRIPE_API_TIMEOUT_SECONDS = 2.0
+    STRIPE_API_POOL_SIZE = 10
+    STRIPE_SUBSCRIPTION_CACHE_TTL_SECONDS = 60
+    STRIPE_CIRCUIT_FAILURE_THRESHOLD = 5
+    STRIPE_CIRCUIT_RESET_SECONDS = 30
+
+    # upper bound for the number of ids accepted by /users/access
+    BULK_ACCESS_MAX_IDS = 5000
+
+    # admission control (see admission.py): concurrent requests per route class, how long a request may wait for a
+    # slot before it is shed with a 503, and the Retry-After sent with it. A limit of 0 disables the class's limit.
+    ADMISSION_LIMITS = {"webhook": 16, "access": 64}
+    ADMISSION_QUEUE_TIMEOUT_SECONDS = {"webhook": 0.05, "access": 1.0}
+    ADMISSION_RETRY_AFTER_SECONDS = 5
+
+    # async webhook mode: the endpoint only enqueues events, `flask webhook-workers` processes them
+    WEBHOOK_ASYNC_MODE = False
+    WEBHOOK_QUEUE_WORKERS = 4
+    WEBHOOK_QUEUE_POLL_INTERVAL_SECONDS = 0.5
+    WEBHOOK_QUEUE_BATCH_SIZE = 100
+    WEBHOOK_QUEUE_MAX_ATTEMPTS = 5
+
+    # group commit: concurrent webhook requests are applied in one transaction with one commit, see group_commit.py
+    WEBHOOK_GROUP_COMMIT_ENABLED = False
+    WEBHOOK_GROUP_COMMIT_MAX_WAIT_MS = 5
+    WEBHOOK_GROUP_COMMIT_MAX_EVENTS = 100
+
+    # write coalescing: webhook requests for the same customer arriving within the window are applied together, in
+    # created order, with one write of the user row (takes precedence over group commit)
+    WEBHOOK_COALESCING_ENABLED = False
+    WEBHOOK_COALESCE_WINDOW_MS = 100
+    WEBHOOK_COALESCE_MAX_EVENTS = 20
+
+    # archive of raw webhook payloads in compressed segment files, written off the request path (see event_archive.py)
+    EVENT_ARCHIVE_ENABLED = os.environ.get("EVENT_ARCHIVE_ENABLED", "").lower() in ("1", "true")
+    EVENT_ARCHIVE_DIR = os.environ.get("EVENT_ARCHIVE_DIR", "event-archive")
+    EVENT_ARCHIVE_SEGMENT_MAX_BYTES = 64 * 1024 * 1024  # uncompressed
+    EVENT_ARCHIVE_SEGMENT_MAX_SECONDS = 3600
+    EVENT_ARCHIVE_QUEUE_SIZE = 100000
+
+    # processed event ids are kept for idempotency, Stripe stops retrying after ~3 days so a week leaves a margin
+    PROCESSED_EVENT_RETENTION_DAYS = 7
+    # in-memory bloom filter letting new event ids skip the idempotency probe, a capacity of 0 disables it
+    PROCESSED_EVENT_FILTER_CAPACITY = 1000000
+    PROCESSED_EVENT_FILTER_ERROR_RATE = 0.01
+
+    # opt-in per-request profiling (see profiling.py), for requests with the header or within the sample rate
+    PROFILING_ENABLED = os.environ.get("PROFILING_ENABLED", "").lower() in ("1", "true")
+    PROFILING_SAMPLE_RATE = float(os.environ.get("PROFILING_SAMPLE_RATE", 0))
+    PROFILING_HEADER = "X-Debug-Profile"
+    PROFILING_HEADER_TOKEN = os.environ.get("PROFILING_HEADER_TOKEN")  # if set, the header must carry this value
+    PROFILING_OUTPUT_DIR = os.environ.get("PROFILING_OUTPUT_DIR", "profiles")
+
+    # PRAGMAs applied to every new SQLite connection (see database.py), empty for other databases
+    SQLITE_PRAGMAS = {}
+
+
+class SQLiteConfig(Config):
+    """
+    Single box profile. WAL lets readers run concurrently with the (single) writer, and synchronous=NORMAL only
+    fsyncs on checkpoints, which is still durable against application crashes in WAL mode.
+    """
+    SQLITE_PRAGMAS = {
+        "journal_mode": os.environ.get("SQLITE_JOURNAL_MODE", "WAL"),
+        "synchronous": os.environ.get("SQLITE_SYNCHRONOUS", "NORMAL"),
+        "busy_timeout": int(os.environ.get("SQLITE_BUSY_TIMEOUT_MS", 5000)),
+        "mmap_size": int(os.environ.get("SQLITE_MMAP_SIZE", 256 * 1024 * 1024)),
+    }
+
+
+class PostgresConfig(Config):
+    """
+    Postgres cluster profile, with a pooled engine configured from the environment.
+    """
+    SQLALCHEMY_DATABASE_URI = os.environ.get("DATABASE_URL", "postgresql://localhost/supernaut")
+    SQLALCHEMY_ENGINE_OPTIONS = {
+        "pool_size": int(os.environ.get("DB_POOL_SIZE", 10)),
+        "max_overflow": int(os.environ.get("DB_MAX_OVERFLOW", 10)),
+        "pool_timeout": float(os.environ.get("DB_POOL_TIMEOUT_SECONDS", 5)),
+        "pool_recycle": int(os.environ.get("DB_POOL_RECYCLE_SECONDS", 1800)),
+        "pool_pre_ping": True,
+        "connect_args": {
+            "options": f"-c statement_timeout={int(os.environ.get('DB_STATEMENT_TIMEOUT_MS', 5000))}",
+        },
+    }
+    # asyncpg takes the statement timeout as a server setting instead of libpq options
+    SQLALCHEMY_ASYNC_ENGINE_OPTIONS = {
+        **{name: value for name, value in SQLALCHEMY_ENGINE_OPTIONS.items() if name != "connect_args"},
+        "connect_args": {
+            "server_settings": {"statement_timeout": str(int(os.environ.get("DB_STATEMENT_TIMEOUT_MS", 5000)))},
+        },
+    }
+
+
+PROFILES = {
+    "sqlite": SQLiteConfig,
+    "postgres": PostgresConfig,
+}
+
+
+def get_config(profile=None):
+    """
+    Get the configuration profile, from the argument or the DATABASE_PROFILE environment variable. Without either,
+    the profile is picked from the DATABASE_URL scheme, falling back to SQLite.
+    """
+    profile = profile or os.environ.get("DATABASE_PROFILE")
+    if not profile:
+        profile = "postgres" if os.environ.get("DATABASE_URL", "").startswith("postgres") else "sqlite"
+
+    if profile not in PROFILES:
+        raise ValueError(f"Unknown database profile {profile!r}, expected one of {', '.join(PROFILES)}")
+
+    return PROFILES[profile]
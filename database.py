@@ -0,0 +1,140 @@
+"""
+Database engine setup for the app
+"""
+import threading
+import time
+
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import create_async_engine
+
+from models import db
+
+# async driver used by the ASGI app for each sync driver, other URLs are used as they are
+ASYNC_DRIVERS = {
+    "sqlite": "sqlite+aiosqlite",
+    "sqlite+pysqlite": "sqlite+aiosqlite",
+    "postgresql": "postgresql+asyncpg",
+    "postgresql+psycopg2": "postgresql+asyncpg",
+}
+
+
+def init_engines(app):
+    """
+    Register connection events on the app's engines. Must be called after db.init_app(app).
+    """
+    pragmas = app.config["SQLITE_PRAGMAS"]
+
+    with app.app_context():
+        for engine in db.engines.values():
+            if engine.dialect.name == "sqlite" and pragmas:
+                event.listen(engine, "connect", _sqlite_pragmas_listener(pragmas))
+
+
+def _sqlite_pragmas_listener(pragmas):
+    def set_sqlite_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas.items():
+            cursor.execute(f"PRAGMA {name}={value}")
+        cursor.close()
+
+    return set_sqlite_pragmas
+
+
+class ReadReplicaRouter:
+    """
+    Routes read-only queries to the "replica" bind (SQLALCHEMY_BINDS, configured from DATABASE_REPLICA_URL), or to the
+    primary if there is no replica. Writes always go to the primary through db.session.
+
+    Replicas lag behind the primary. So for READ_YOUR_WRITES_SECONDS after a webhook commits a change to a user, that
+    user's reads go to the primary. Otherwise the access cache, invalidated by the commit, could be refilled with the
+    replica's stale row. Only changes committed by this process are tracked, so the window should cover the usual
+    replication lag plus the access cache TTL.
+    """
+
+    def __init__(self):
+        self.window_seconds = 0
+        self._recent_writes = {}  # user_id -> monotonic time until which its reads go to the primary
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        self.window_seconds = app.config["READ_YOUR_WRITES_SECONDS"]
+        self.clear()
+
+    def read_engine(self, user_ids=()):
+        """
+        Engine for a read-only query about `user_ids` (or about no user in particular)
+        """
+        replica = db.engines.get("replica")
+        if replica is None or any(self.recently_written(user_id) for user_id in user_ids):
+            return db.engine
+        return replica
+
+    def recently_written(self, user_id):
+        deadline = self._recent_writes.get(user_id)
+        return deadline is not None and deadline > time.monotonic()
+
+    def record_writes(self, user_ids):
+        """
+        Pin reads of these users to the primary for the read-your-writes window, call after the commit
+        """
+        if not self.window_seconds or not user_ids:
+            return
+
+        now = time.monotonic()
+        with self._lock:
+            for user_id in user_ids:
+                self._recent_writes[user_id] = now + self.window_seconds
+            if len(self._recent_writes) > 100000:
+                self._recent_writes = {user_id: deadline for user_id, deadline in self._recent_writes.items()
+                                       if deadline > now}
+
+    def clear(self):
+        with self._lock:
+            self._recent_writes = {}
+
+
+read_replica_router = ReadReplicaRouter()
+
+
+class AsyncEngines:
+    """
+    Async counterparts of the app's engines for the ASGI app (see asgi.py). They are created from the same URLs with
+    each dialect's async driver (aiosqlite, asyncpg) and routed like ReadReplicaRouter. SQLite needs a database file,
+    since an in-memory database isn't shared between engines.
+    """
+
+    def __init__(self):
+        self._engines = {}
+
+    def init_app(self, app):
+        options = app.config["SQLALCHEMY_ASYNC_ENGINE_OPTIONS"]
+        pragmas = app.config["SQLITE_PRAGMAS"]
+
+        with app.app_context():
+            for bind_key, engine in db.engines.items():
+                url = engine.url.set(drivername=ASYNC_DRIVERS.get(engine.url.drivername, engine.url.drivername))
+                async_engine = create_async_engine(url, **options)
+                if async_engine.dialect.name == "sqlite" and pragmas:
+                    event.listen(async_engine.sync_engine, "connect", _sqlite_pragmas_listener(pragmas))
+                self._engines[bind_key] = async_engine
+
+    @property
+    def initialized(self):
+        return bool(self._engines)
+
+    def read_engine(self, user_ids=()):
+        """
+        Async engine for a read-only query about `user_ids`, see ReadReplicaRouter.read_engine
+        """
+        replica = self._engines.get("replica")
+        if replica is None or any(read_replica_router.recently_written(user_id) for user_id in user_ids):
+            return self._engines[None]
+        return replica
+
+    async def dispose(self):
+        engines, self._engines = self._engines, {}
+        for engine in engines.values():
+            await engine.dispose()
+
+
+async_engines = AsyncEngines()
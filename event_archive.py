@@ -0,0 +1,255 @@
+"""
+Archive of raw Stripe webhook payloads, for audits and reprocessing, kept out of the database so the hot tables stay
+small.
+
+Webhook requests only pay for an in-memory enqueue. A background writer thread drains the queue and appends the events
+to gzip compressed, append-only segment files in EVENT_ARCHIVE_DIR. It rotates to a new segment after
+EVENT_ARCHIVE_SEGMENT_MAX_BYTES of uncompressed data or EVENT_ARCHIVE_SEGMENT_MAX_SECONDS. Every process writes its own
+segments, named `events-<UTC start time>-<pid>-<n>.jsonl.gz`.
+
+Each batch the writer drains becomes one gzip member of JSON lines ({"received_at": ..., "event": ...}). Concatenated
+members are still a valid gzip file (`zcat` reads a segment), and each member can be decompressed on its own, so the
+`.idx` file next to a segment maps every event id to the byte offset of its member. A member is only indexed once it
+is completely written, and readers stop at a member the writer hasn't finished.
+
+If the writer falls behind by EVENT_ARCHIVE_QUEUE_SIZE events, new events are dropped and counted in the
+event_archive_dropped_events_total metric rather than slowing webhooks down. So are the batches the writer fails to
+write (disk full, permissions), which are logged, and the writer carries on with a new segment.
+"""
+import atexit
+import glob
+import json
+import logging
+import os
+import queue
+import threading
+import time
+import zlib
+from datetime import datetime, timezone
+
+from metrics import metrics
+
+SEGMENT_GLOB = "events-*.jsonl.gz"
+GZIP_WBITS = 16 + zlib.MAX_WBITS
+CLOSE_TIMEOUT_SECONDS = 10
+
+logger = logging.getLogger(__name__)
+
+
+class EventArchive:
+
+    def __init__(self):
+        self.directory = None
+        self.segment_max_bytes = 0
+        self.segment_max_seconds = 0
+        self._queue = None
+        self._thread = None
+        self._pid = None
+        self._lock = threading.Lock()
+        self._segment_count = 0
+
+    @property
+    def enabled(self):
+        return self._queue is not None
+
+    def init_app(self, app):
+        self.close()
+        if app.config["EVENT_ARCHIVE_ENABLED"]:
+            self.open(app.config["EVENT_ARCHIVE_DIR"], app.config["EVENT_ARCHIVE_SEGMENT_MAX_BYTES"],
+                      app.config["EVENT_ARCHIVE_SEGMENT_MAX_SECONDS"], app.config["EVENT_ARCHIVE_QUEUE_SIZE"])
+
+    def open(self, directory, segment_max_bytes=64 * 1024 * 1024, segment_max_seconds=3600, queue_size=100000):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.segment_max_bytes = segment_max_bytes
+        self.segment_max_seconds = segment_max_seconds
+        self._queue = queue.Queue(queue_size)
+
+    def append(self, event_data, raw=None):
+        """
+        Queue an event for the archive, from the request thread. `raw` is the request body it was parsed from, which
+        is archived as received if it fits on one line.
+        """
+        if self._queue is None:
+            return
+
+        self._ensure_writer()
+        try:
+            self._queue.put_nowait((time.time(), event_data, raw))
+        except queue.Full:
+            metrics.event_archive_dropped.inc()
+
+    def close(self):
+        """
+        Write everything queued so far and stop the writer, waiting at most CLOSE_TIMEOUT_SECONDS so a stuck writer
+        can't hang the shutdown
+        """
+        if self._thread is not None and self._pid == os.getpid() and self._thread.is_alive():
+            deadline = time.monotonic() + CLOSE_TIMEOUT_SECONDS
+            try:
+                self._queue.put(None, timeout=CLOSE_TIMEOUT_SECONDS)
+            except queue.Full:
+                logger.warning("Event archive writer is stuck, %d queued events are lost", self._queue.qsize())
+            else:
+                self._thread.join(max(deadline - time.monotonic(), 0))
+        self._queue = self._thread = None
+
+    def _ensure_writer(self):
+        # started on first use, and again in a forked worker, which doesn't inherit the thread
+        if self._thread is None or self._pid != os.getpid() or not self._thread.is_alive():
+            with self._lock:
+                if self._thread is None or self._pid != os.getpid() or not self._thread.is_alive():
+                    self._pid = os.getpid()
+                    self._thread = threading.Thread(target=self._write_segments, name="event-archive",
+                                                    daemon=True)
+                    self._thread.start()
+
+    def _write_segments(self):
+        events = self._queue  # close() may drop it while a stuck writer still runs
+        segment = None
+        try:
+            while True:
+                batch = [events.get()]
+                while len(batch) < 1000:
+                    try:
+                        batch.append(events.get_nowait())
+                    except queue.Empty:
+                        break
+
+                stop = None in batch
+                batch = [item for item in batch if item is not None]
+                if batch:
+                    try:
+                        if segment is None or segment.is_full(self.segment_max_bytes, self.segment_max_seconds):
+                            segment = self._close_quietly(segment)
+                            segment = self._new_segment()
+                        segment.write_member(batch)
+                        metrics.event_archive_written.inc(amount=len(batch))
+                    except Exception:
+                        logger.exception("Failed to archive %d events", len(batch))
+                        metrics.event_archive_dropped.inc(amount=len(batch))
+                        # the segment may end in a partial member, which readers stop at, so start a new one
+                        segment = self._close_quietly(segment)
+                if stop:
+                    return
+        finally:
+            self._close_quietly(segment)
+
+    @staticmethod
+    def _close_quietly(segment):
+        if segment is not None:
+            try:
+                segment.close()
+            except Exception:
+                logger.exception("Failed to close event archive segment %s", segment.path)
+        return None
+
+    def _new_segment(self):
+        self._segment_count += 1
+        started = datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%S")
+        return _Segment(os.path.join(self.directory,
+                                     f"events-{started}-{os.getpid()}-{self._segment_count:06d}.jsonl.gz"))
+
+
+class _Segment:
+
+    def __init__(self, path):
+        self.path = path
+        self.opened_at = time.monotonic()
+        self.uncompressed_bytes = 0
+        self._file = open(path, "ab")
+        self._index = open(f"{path[:-len('.jsonl.gz')]}.idx", "a")
+
+    def is_full(self, max_bytes, max_seconds):
+        return self.uncompressed_bytes >= max_bytes or time.monotonic() - self.opened_at >= max_seconds
+
+    def write_member(self, batch):
+        lines = []
+        for received_at, event_data, raw in batch:
+            if raw is not None and b"\n" not in raw:
+                event_json = raw.decode()
+            else:
+                event_json = json.dumps(event_data, separators=(",", ":"))
+            lines.append('{"received_at":%.6f,"event":%s}\n' % (received_at, event_json))
+        data = "".join(lines).encode()
+
+        compressor = zlib.compressobj(6, zlib.DEFLATED, GZIP_WBITS)
+        offset = self._file.tell()
+        self._file.write(compressor.compress(data) + compressor.flush())
+        self._file.flush()
+
+        self._index.write("".join(f"{event_data.get('id')}\t{offset}\n" for _, event_data, _ in batch
+                                  if isinstance(event_data, dict)))
+        self._index.flush()
+        self.uncompressed_bytes += len(data)
+
+    def close(self):
+        self._file.close()
+        self._index.close()
+
+
+class ArchiveReader:
+    """
+    Streams archived events back out, for replays (see `flask read-archive`) or debugging
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def segments(self):
+        # names start with the UTC start time, so they sort chronologically
+        return sorted(glob.glob(os.path.join(self.directory, SEGMENT_GLOB)))
+
+    def records(self, since=None, until=None):
+        """
+        Every archived record ({"received_at": ..., "event": ...}), segment by segment. `since` and `until` (unix
+        seconds) filter on the time the webhook was received.
+        """
+        for path in self.segments():
+            for member in self._read_members(path):
+                for line in filter(None, member.split(b"\n")):
+                    record = json.loads(line)
+                    if (since is None or record["received_at"] >= since) and (
+                            until is None or record["received_at"] < until):
+                        yield record
+
+    def find(self, event_id):
+        """
+        Every archived record of an event (Stripe may have delivered it more than once), found through the indexes
+        """
+        records = []
+        for path in self.segments():
+            with open(f"{path[:-len('.jsonl.gz')]}.idx") as index:
+                offsets = sorted({int(offset) for indexed_id, offset in
+                                  (line.rstrip("\n").split("\t") for line in index) if indexed_id == event_id})
+
+            for offset in offsets:
+                member = next(self._read_members(path, offset), b"")
+                records.extend(record for record in map(json.loads, filter(None, member.split(b"\n")))
+                               if record["event"].get("id") == event_id)
+        return records
+
+    @staticmethod
+    def _read_members(path, offset=0, chunk_size=1024 * 1024):
+        """
+        Decompressed gzip members from `offset` on. A member still being written (truncated) ends the segment.
+        """
+        with open(path, "rb") as file:
+            file.seek(offset)
+            pending = b""
+            while True:
+                decompressor = zlib.decompressobj(GZIP_WBITS)
+                data = []
+                while not decompressor.eof:
+                    chunk = pending or file.read(chunk_size)
+                    pending = b""
+                    if not chunk:
+                        return
+                    data.append(decompressor.decompress(chunk))
+                pending = decompressor.unused_data
+                yield b"".join(data)
+
+
+event_archive = EventArchive()
+# don't lose what is still queued when the process exits normally
+atexit.register(event_archive.close)
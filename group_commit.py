@@ -0,0 +1,90 @@
+"""
+Group commit for concurrent webhook transactions.
+
+Every commit pays for a sync to disk (the WAL fsync on SQLite, or on Postgres with synchronous_commit on), which caps
+the webhook throughput of a single database at a few hundred commits per second. The GroupCommitter lets concurrent
+requests share one: the first request to arrive becomes the leader. It waits up to `max_wait_seconds` for up to
+`max_size` requests to join, then applies all of their work in one transaction on its own thread. Then it hands
+each follower its result.
+
+Groups can also be keyed, e.g. by customer for write coalescing: requests only join a group of their own key, and the
+groups of different keys are led and committed independently.
+"""
+import threading
+
+
+class PendingWork:
+    """
+    One request's work in a group. commit_group sets either `result` or `error`.
+    """
+    __slots__ = ("payload", "result", "error", "done")
+
+    def __init__(self, payload):
+        self.payload = payload
+        self.result = None
+        self.error = None
+        self.done = False
+
+
+class GroupCommitter:
+
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._pending = {}  # key -> queued PendingWork
+        self._leaders = set()  # keys with an active leader
+        self.groups = 0  # number of groups committed, mostly for tests and benchmarks
+
+    def submit(self, payload, commit_group, max_wait_seconds, max_size, key=None):
+        """
+        Queue the payload and block until its group is committed. `commit_group(works)` is called by the leader with
+        a list of PendingWork of the same key and must set each one's result or error. Returns the result or raises
+        the error.
+        """
+        work = PendingWork(payload)
+
+        with self._condition:
+            self._pending.setdefault(key, []).append(work)
+            self._condition.notify_all()
+
+            while not work.done and key in self._leaders:
+                self._condition.wait()
+            if not work.done:
+                self._leaders.add(key)
+
+        if not work.done:
+            self._lead(work, commit_group, max_wait_seconds, max_size, key)
+
+        if work.error is not None:
+            raise work.error
+        return work.result
+
+    def _lead(self, work, commit_group, max_wait_seconds, max_size, key):
+        try:
+            # the leader's own work may not make the first group if more than max_size requests were queued before it
+            while not work.done:
+                with self._condition:
+                    self._condition.wait_for(lambda: len(self._pending[key]) >= max_size, max_wait_seconds)
+                    group, self._pending[key] = self._pending[key][:max_size], self._pending[key][max_size:]
+                    if not self._pending[key]:
+                        del self._pending[key]
+
+                try:
+                    commit_group(group)
+                except Exception as e:
+                    for pending in group:
+                        pending.error = e
+
+                with self._condition:
+                    for pending in group:
+                        pending.done = True
+                    self.groups += 1
+                    self._condition.notify_all()
+        finally:
+            with self._condition:
+                # a waiting follower takes over whatever has been queued meanwhile
+                self._leaders.discard(key)
+                self._condition.notify_all()
+
+
+webhook_group_committer = GroupCommitter()
+webhook_coalescer = GroupCommitter()
@@ -0,0 +1,128 @@
+"""
+Access change feed handler for the app
+"""
+import json
+import threading
+import time
+
+from flask import Response, current_app, stream_with_context
+from sqlalchemy import bindparam, func, select
+
+from database import read_replica_router
+from models import db, AccessChange
+
+CHANGES_QUERY = (
+    select(AccessChange.seq, AccessChange.user_id, AccessChange.access_until, AccessChange.version)
+    .where(AccessChange.seq > bindparam("cursor"))
+    .order_by(AccessChange.seq)
+    .limit(bindparam("limit"))
+)
+
+LATE_CHANGES_QUERY = (
+    select(AccessChange.seq, AccessChange.user_id, AccessChange.access_until, AccessChange.version)
+    .where(AccessChange.seq.in_(bindparam("seqs", expanding=True)))
+    .order_by(AccessChange.seq)
+)
+
+
+class AccessChangeNotifier:
+    """
+    Wakes up the change streams of this process when a webhook commits, so they don't wait for the next poll
+    """
+
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._generation = 0
+
+    def generation(self):
+        return self._generation
+
+    def notify(self):
+        with self._condition:
+            self._generation += 1
+            self._condition.notify_all()
+
+    def wait(self, generation, timeout):
+        """
+        Wait until notify() is called after `generation` was read, or until the timeout
+        """
+        with self._condition:
+            self._condition.wait_for(lambda: self._generation != generation, timeout)
+
+
+access_change_notifier = AccessChangeNotifier()
+
+
+class AccessChangeHandler:
+
+    @staticmethod
+    def stream_changes(cursor=None, follow=True):
+        """
+        Server-sent events with every access change after `cursor`. Each event id is a cursor reconnecting clients
+        resume from with Last-Event-ID. Without a cursor the stream starts at the current end of the log.
+        With follow=False the stream ends once it has caught up, instead of waiting for new changes.
+        """
+        if cursor is None:
+            cursor = db.session.scalar(select(func.max(AccessChange.seq)),
+                                       bind_arguments={"bind": read_replica_router.read_engine()}) or 0
+        db.session.remove()  # the stream can stay open for hours, don't hold on to a session meanwhile
+
+        config = current_app.config
+        generator = AccessChangeHandler._generate_events(
+            cursor, follow, config["ACCESS_CHANGES_PAGE_SIZE"], config["ACCESS_CHANGES_POLL_INTERVAL_SECONDS"],
+            config["ACCESS_CHANGES_KEEPALIVE_SECONDS"], config["ACCESS_CHANGES_OVERLAP"])
+
+        return Response(stream_with_context(generator), mimetype="text/event-stream",
+                        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+    @staticmethod
+    def _generate_events(cursor, follow, page_size, poll_interval, keepalive_seconds, overlap):
+        """
+        On Postgres a lower seq can commit after a higher one was streamed, so seqs skipped over stay `missing` and
+        are read again on every poll until they show up, or until they are more than `overlap` seqs behind (the
+        transaction was rolled back). Event ids stay below the first missing seq, so a client that reconnects doesn't
+        skip a late change either. It may get changes again that it already has instead, which are the same
+        (user_id, version).
+        """
+        # tells EventSource clients how long to wait before reconnecting
+        yield f"retry: {int(poll_interval * 1000)}\n\n"
+        last_sent = time.monotonic()
+        missing = set()
+
+        while True:
+            generation = access_change_notifier.generation()
+            with read_replica_router.read_engine().connect() as connection:
+                late_changes = connection.execute(LATE_CHANGES_QUERY, {"seqs": sorted(missing)}).all() \
+                    if missing else []
+                changes = connection.execute(CHANGES_QUERY, {"cursor": cursor, "limit": page_size}).all()
+
+            for change in late_changes + changes:
+                if change.seq > cursor:
+                    missing.update(range(max(cursor + 1, change.seq - overlap), change.seq))
+                    cursor = change.seq
+                else:
+                    missing.discard(change.seq)
+                missing = {seq for seq in missing if seq > cursor - overlap}
+
+                event_id = min(missing) - 1 if missing else cursor
+                yield f"id: {event_id}\ndata: {AccessChangeHandler._change_json(change)}\n\n"
+                last_sent = time.monotonic()
+
+            if len(changes) == page_size:
+                continue  # still catching up
+            if not follow:
+                return
+
+            if time.monotonic() - last_sent >= keepalive_seconds:
+                yield ": keep-alive\n\n"
+                last_sent = time.monotonic()
+
+            access_change_notifier.wait(generation, poll_interval)
+
+    @staticmethod
+    def _change_json(change):
+        return json.dumps({
+            "user_id": change.user_id,
+            "access_until": change.access_until.isoformat() if change.access_until else None,
+            "version": change.version,
+        }, separators=(",", ":"))
@@ -0,0 +1,91 @@
+"""
+Access index handler for the app, feeds the shared access index (see access_index.py) from the database
+"""
+from flask import current_app
+from sqlalchemy import bindparam, func, select
+
+from access_index import access_index
+from models import db, User, AccessChange
+
+INDEX_USERS_QUERY = select(User.id, User.access_until, User.version, User.updated_at).where(
+    User.id < bindparam("capacity"))
+INDEX_USERS_BY_ID_QUERY = select(User.id, User.access_until, User.version, User.updated_at).where(
+    User.id.in_(bindparam("user_ids", expanding=True)))
+INDEX_CHANGES_QUERY = (
+    select(AccessChange.seq, AccessChange.user_id, AccessChange.access_until, AccessChange.version,
+           AccessChange.updated_at)
+    .where(AccessChange.seq > bindparam("after_seq"))
+    .order_by(AccessChange.seq)
+)
+
+
+class AccessIndexHandler:
+
+    @staticmethod
+    def get_access_state(user_id):
+        """
+        The user's AccessState from the shared index, or AccessCache.MISS. Builds the index if no process has yet, and
+        catches up with the change log every ACCESS_INDEX_SYNC_INTERVAL_SECONDS (skipped if another process is at it).
+        """
+        AccessIndexHandler.maintain_access_index()
+        return access_index.get(user_id)
+
+    @staticmethod
+    def is_maintenance_due():
+        """
+        Whether maintain_access_index has work to do, i.e. would query the database
+        """
+        return access_index.synced_seq() < 0 or access_index.is_sync_due(
+            current_app.config["ACCESS_INDEX_SYNC_INTERVAL_SECONDS"])
+
+    @staticmethod
+    def maintain_access_index():
+        """
+        Build the index if no process has yet, and catch up with the change log every
+        ACCESS_INDEX_SYNC_INTERVAL_SECONDS (skipped if another process is at it)
+        """
+        access_index.ensure_built(AccessIndexHandler._load_users, AccessIndexHandler._load_max_seq)
+
+        if access_index.is_sync_due(current_app.config["ACCESS_INDEX_SYNC_INTERVAL_SECONDS"]):
+            AccessIndexHandler.sync_access_index(blocking=False)
+
+    @staticmethod
+    def sync_access_index(blocking=True):
+        """
+        Apply the changes committed since the last sync, always read from the primary
+        """
+        access_index.sync(AccessIndexHandler._load_changes, current_app.config["ACCESS_INDEX_SYNC_OVERLAP"], blocking)
+
+    @staticmethod
+    def write_users(user_ids):
+        """
+        Write the slots of users a commit just changed, read back from the primary. Much cheaper than a sync, which
+        also reads ACCESS_INDEX_SYNC_OVERLAP changes again, and is left to the periodic sync on reads.
+        """
+        user_ids = [user_id for user_id in user_ids if 0 <= user_id < access_index.capacity]
+        if not user_ids:
+            return
+
+        with db.engine.connect() as connection:
+            rows = connection.execute(INDEX_USERS_BY_ID_QUERY, {"user_ids": user_ids}).all()
+        access_index.write(rows)
+
+    @staticmethod
+    def rebuild_access_index():
+        access_index.rebuild(AccessIndexHandler._load_users, AccessIndexHandler._load_max_seq)
+
+    @staticmethod
+    def _load_users():
+        with db.engine.connect() as connection:
+            yield from connection.execute(INDEX_USERS_QUERY.execution_options(yield_per=10000),
+                                          {"capacity": access_index.capacity})
+
+    @staticmethod
+    def _load_max_seq():
+        with db.engine.connect() as connection:
+            return connection.scalar(select(func.max(AccessChange.seq))) or 0
+
+    @staticmethod
+    def _load_changes(after_seq):
+        with db.engine.connect() as connection:
+            return connection.execute(INDEX_CHANGES_QUERY, {"after_seq": after_seq}).all()
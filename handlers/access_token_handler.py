@@ -0,0 +1,80 @@
+"""
+Access token handler for the app
+"""
+import time
+from datetime import datetime, timezone, timedelta
+
+from flask import current_app
+from sqlalchemy import func, select
+
+from access_tokens import AccessClaims, encode_access_token
+from database import read_replica_router
+from helpers import ResponseHelper, DateTimeNaiveHelper
+from models import db, User, AccessRevocation
+
+
+class AccessTokenHandler:
+
+    @staticmethod
+    def issue_access_token(user_id):
+        """
+        Issue a short-lived signed token with the user's access, which downstream services verify locally with
+        access_tokens.AccessTokenVerifier instead of calling GET /user/<id>/access on every request
+        """
+        secret = current_app.config["ACCESS_TOKEN_SECRET"]
+        if not secret:
+            return ResponseHelper.error("Access tokens are not configured", 503)
+
+        row = db.session.execute(
+            select(User.access_until, User.revocation_version).where(User.id == user_id),
+            bind_arguments={"bind": read_replica_router.read_engine([user_id])}).first()
+        if not row:
+            return ResponseHelper.error("User not found", 404)
+
+        access_until = DateTimeNaiveHelper.make_timezone_aware(row.access_until)
+        issued_at = int(time.time())
+        claims = AccessClaims(
+            user_id=user_id,
+            access_until=int(access_until.timestamp()) if access_until else None,
+            revocation_version=row.revocation_version,
+            issued_at=issued_at,
+            expires_at=issued_at + current_app.config["ACCESS_TOKEN_TTL_SECONDS"],
+        )
+
+        return ResponseHelper.success({
+            "token": encode_access_token(secret, claims),
+            "expires_at": claims.expires_at,
+        })
+
+    @staticmethod
+    def get_revocations(since=None):
+        """
+        Revocations after the `since` cursor, oldest first and at most ACCESS_REVOCATIONS_PAGE_SIZE of them.
+        Without a cursor only revocations younger than the token lifetime are returned, since older ones can't affect
+        any token that is still valid -- so a new verifier doesn't have to download the whole history.
+        Ids are returned too: on Postgres an id can commit after a higher one was returned, and verifiers pull again
+        from below the ids they haven't seen (see AccessTokenVerifier.apply_revocations).
+        """
+        page_size = current_app.config["ACCESS_REVOCATIONS_PAGE_SIZE"]
+        bind_arguments = {"bind": read_replica_router.read_engine()}
+        query = select(AccessRevocation).order_by(AccessRevocation.id).limit(page_size)
+
+        if since is None:
+            cutoff = datetime.now(timezone.utc) - timedelta(seconds=current_app.config["ACCESS_TOKEN_TTL_SECONDS"])
+            query = query.where(AccessRevocation.revoked_at >= cutoff)
+            # cursor for the next pull if nothing was revoked recently
+            cursor = db.session.scalar(select(func.max(AccessRevocation.id)), bind_arguments=bind_arguments) or 0
+        else:
+            query = query.where(AccessRevocation.id > since)
+            cursor = since
+
+        revocations = db.session.scalars(query, bind_arguments=bind_arguments).all()
+        if revocations:
+            cursor = revocations[-1].id
+
+        return ResponseHelper.success({
+            "revocations": [{"id": revocation.id, "user_id": revocation.user_id,
+                             "revocation_version": revocation.revocation_version} for revocation in revocations],
+            "cursor": cursor,
+            "has_more": len(revocations) == page_size,
+        })
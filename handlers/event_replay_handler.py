@@ -0,0 +1,211 @@
+"""
+Offline replay of Stripe event exports (a disaster recovery dump, or the output of `stripe events list`) through the
+regular webhook handler, in large batch transactions instead of one POST /stripe/webhook per event.
+"""
+import json
+import os
+import tempfile
+import time
+import zlib
+
+from flask import current_app
+from sqlalchemy.exc import OperationalError, InterfaceError
+
+from handlers.stripe_webhook_handler import StripeWebhookHandler, RELEVANT_EVENTS
+from handlers.webhook_queue_handler import WebhookQueueHandler
+from metrics import metrics
+from models import db
+
+
+class CheckpointMismatchError(Exception):
+    pass
+
+
+class ReplayStats:
+
+    def __init__(self):
+        self.started = time.monotonic()
+        self.read = 0
+        self.invalid = 0
+        self.ignored = 0
+        self.total = 0  # relevant events to replay
+        self.replayed = 0  # relevant events done, in this run or (when resuming) an earlier one
+        self.processed = 0
+        self.duplicates = 0
+        self.failed = 0
+
+    @property
+    def events_per_second(self):
+        elapsed = time.monotonic() - self.started
+        return self.replayed / elapsed if elapsed > 0 else 0.0
+
+
+class EventReplayHandler:
+
+    @staticmethod
+    def replay_events(lines, checkpoint_path, partitions=16, batch_size=5000, on_progress=None):
+        """
+        Replay the Stripe events in `lines` (JSON lines, one event or one `stripe events list` page per line).
+
+        Each customer's events must be applied in `created` order, but exports aren't sorted that way
+        (`stripe events list` is newest first). So relevant events are first spilled into `partitions` temporary
+        files by customer, so that only one partition is held in memory at a time. Each partition is then sorted by
+        customer and `created` (ties keep the input order) and applied in transactions of `batch_size` events.
+
+        If a batch fails, it is rolled back and retried one event at a time. Events that still fail are counted as
+        failed, logged and skipped, so one bad event doesn't stop the replay for good. Database errors (connection
+        lost, database locked) stop the replay instead.
+
+        After every committed batch the position is written to `checkpoint_path`, and a replay of the same input
+        resumes from there. Events are still claimed for idempotency, so a batch committed just before a crash is
+        skipped as duplicates on resume. `on_progress(stats)` is called after every batch. Returns the ReplayStats.
+        """
+        stats = ReplayStats()
+
+        with tempfile.TemporaryDirectory(prefix="stripe-replay-") as directory:
+            sizes, digests = EventReplayHandler._partition_events(lines, directory, partitions, stats)
+            fingerprint = {"partition_sizes": sizes, "partition_digests": digests}
+            checkpoint = EventReplayHandler._load_checkpoint(checkpoint_path, fingerprint)
+            stats.replayed = sum(sizes[:checkpoint["partition"]]) + checkpoint["offset"]
+
+            for partition in range(checkpoint["partition"], partitions):
+                events = EventReplayHandler._load_partition(os.path.join(directory, str(partition)))
+                offset = checkpoint["offset"] if partition == checkpoint["partition"] else 0
+
+                for start in range(offset, len(events), batch_size):
+                    batch = events[start:start + batch_size]
+                    try:
+                        results = StripeWebhookHandler._process_event_batch(batch)
+                    except (OperationalError, InterfaceError):
+                        db.session.rollback()
+                        metrics.webhook_rollbacks.inc()
+                        raise
+                    except Exception:
+                        db.session.rollback()
+                        metrics.webhook_rollbacks.inc()
+                        results = EventReplayHandler._replay_one_by_one(batch)
+
+                    stats.replayed += len(batch)
+                    stats.processed += sum(result["status"] == "processed" for result in results)
+                    stats.duplicates += sum(result["status"] == "duplicate" for result in results)
+                    stats.failed += sum(result["status"] == "failed" for result in results)
+                    EventReplayHandler._save_checkpoint(checkpoint_path, fingerprint, partition,
+                                                        start + len(batch))
+                    if on_progress:
+                        on_progress(stats)
+
+                EventReplayHandler._save_checkpoint(checkpoint_path, fingerprint, partition + 1, 0)
+
+        return stats
+
+    @staticmethod
+    def _replay_one_by_one(batch):
+        """
+        Apply the events of a failed batch in their own transactions. An event that fails again gets a `failed`
+        result and is logged, the others are committed. Database errors (connection lost, database locked) aren't the
+        event's fault and are raised, so the replay stops and can be resumed.
+        """
+        results = []
+        for event_data in batch:
+            try:
+                results.extend(StripeWebhookHandler._process_event_batch([event_data]))
+            except (OperationalError, InterfaceError):
+                db.session.rollback()
+                metrics.webhook_rollbacks.inc()
+                raise
+            except Exception as e:
+                db.session.rollback()
+                metrics.webhook_rollbacks.inc()
+                current_app.logger.warning("Replay of event %s failed: %s", event_data["id"], e)
+                results.append(StripeWebhookHandler._batch_result(
+                    event_data["id"], "failed", f"Failed to process event: {str(e)}"))
+        return results
+
+    @staticmethod
+    def _partition_events(lines, directory, partitions, stats):
+        """
+        Spill relevant events into one file per partition, by the same stable customer hash as the webhook queue.
+        Returns the number of events per partition and a CRC of their ids, which identify the input in checkpoints.
+        """
+        files = [open(os.path.join(directory, str(partition)), "w") for partition in range(partitions)]
+        sizes = [0] * partitions
+        digests = [0] * partitions
+        try:
+            for event_data in EventReplayHandler._read_events(lines, stats):
+                stats.read += 1
+                if not isinstance(event_data, dict) or not event_data.get("id"):
+                    stats.invalid += 1
+                    continue
+                if event_data.get("type") not in RELEVANT_EVENTS:
+                    stats.ignored += 1
+                    continue
+
+                customer_id = StripeWebhookHandler._get_customer_id(event_data)
+                if not isinstance(customer_id, str):
+                    stats.invalid += 1
+                    continue
+
+                partition = WebhookQueueHandler._shard_key(customer_id) % partitions
+                files[partition].write(json.dumps(event_data, separators=(",", ":")) + "\n")
+                sizes[partition] += 1
+                digests[partition] = zlib.crc32(event_data["id"].encode(), digests[partition])
+        finally:
+            for file in files:
+                file.close()
+
+        stats.total = sum(sizes)
+        return sizes, digests
+
+    @staticmethod
+    def _read_events(lines, stats):
+        for line in lines:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                item = json.loads(line)
+            except ValueError:
+                stats.read += 1
+                stats.invalid += 1
+                continue
+
+            # a page of `stripe events list` output
+            if isinstance(item, dict) and item.get("object") == "list":
+                yield from item.get("data") or []
+            else:
+                yield item
+
+    @staticmethod
+    def _load_partition(path):
+        with open(path) as file:
+            events = [json.loads(line) for line in file]
+
+        # stable sort, so events created in the same second keep their input order
+        events.sort(key=lambda event_data: (StripeWebhookHandler._get_customer_id(event_data),
+                                            event_data.get("created") or 0))
+        return events
+
+    @staticmethod
+    def _load_checkpoint(checkpoint_path, fingerprint):
+        """
+        Where to resume: the partition and the number of its (sorted) events already committed. A checkpoint of a
+        different input or partition count is rejected, since its position would point at other events.
+        """
+        if not os.path.exists(checkpoint_path):
+            return {"partition": 0, "offset": 0}
+
+        with open(checkpoint_path) as file:
+            checkpoint = json.load(file)
+
+        if any(checkpoint.get(name) != value for name, value in fingerprint.items()):
+            raise CheckpointMismatchError(
+                f"Checkpoint {checkpoint_path} belongs to a different input or partition count")
+        return checkpoint
+
+    @staticmethod
+    def _save_checkpoint(checkpoint_path, fingerprint, partition, offset):
+        # written to a temporary file and renamed, so a crash never leaves a torn checkpoint
+        temporary_path = f"{checkpoint_path}.tmp"
+        with open(temporary_path, "w") as file:
+            json.dump({**fingerprint, "partition": partition, "offset": offset}, file)
+        os.replace(temporary_path, checkpoint_path)
@@ -0,0 +1,35 @@
+"""
+Retention handler for processed Stripe events
+"""
+from datetime import datetime, timezone, timedelta
+
+from sqlalchemy import delete, select
+
+from models import db, StripeProcessedEvent
+
+
+class EventRetentionHandler:
+
+    @staticmethod
+    def prune_processed_events(retention_days, chunk_size=1000, now=None):
+        """
+        Delete processed events older than the retention window, in chunks of `chunk_size` rows with a commit per
+        chunk, so the pruning job never holds a long write lock. Returns the number of deleted events.
+        Stripe stops retrying an event after about 3 days, so older ids are no longer needed for idempotency.
+        """
+        cutoff = (now or datetime.now(timezone.utc)) - timedelta(days=retention_days)
+        deleted = 0
+
+        while True:
+            event_ids = db.session.scalars(
+                select(StripeProcessedEvent.stripe_event_id)
+                .where(StripeProcessedEvent.processed_at < cutoff)
+                .limit(chunk_size)
+            ).all()
+            if not event_ids:
+                return deleted
+
+            db.session.execute(
+                delete(StripeProcessedEvent).where(StripeProcessedEvent.stripe_event_id.in_(event_ids)))
+            db.session.commit()
+            deleted += len(event_ids)
@@ -1,11 +1,23 @@
 """
 Stripe webhook event handlers for the app
 """
+import time
 from datetime import datetime, timezone, timedelta
 from enum import Enum
 
-from helpers import ResponseHelper
-from models import db, User, StripeProcessedEvent
+from flask import current_app
+from sqlalchemy import select
+
+from cache import access_cache, processed_event_filter
+from access_index import access_index
+from database import read_replica_router
+from group_commit import webhook_group_committer, webhook_coalescer
+from handlers.access_change_handler import access_change_notifier
+from handlers.access_index_handler import AccessIndexHandler
+from helpers import ResponseHelper, UpsertHelper, DateTimeNaiveHelper
+from metrics import metrics
+from models import db, User, StripeProcessedEvent, AccessRevocation, AccessChange, Subscription
+from stripe_client import stripe_client, StripeClient
 
 
 class StripeEventType(Enum):
@@ -36,54 +48,374 @@ class StripeWebhookHandler:
         """
         Main webhook event processor that handles idempotent events and delegates event handling to specific handlers
         """
+        started = time.perf_counter()
         event_id = event_data.get("id")
 
         if not event_id:
             return ResponseHelper.error("Invalid event data -- event id not found")
 
-        # check if event was already processed for idempotency
-        if db.session.get(StripeProcessedEvent, event_id):
+        # check if event was already processed for idempotency (the claim below is the authoritative check)
+        if StripeWebhookHandler._is_processed(event_id):
+            metrics.webhook_duplicates.inc()
             return ResponseHelper.success("Event already processed")
 
         # check if event type is relevant
         if event_data["type"] not in RELEVANT_EVENTS:
             return ResponseHelper.success("Event type not relevant, ignoring")
 
+        customer_id = StripeWebhookHandler._get_customer_id(event_data)
+        if not customer_id:
+            return ResponseHelper.error("Customer ID not found in event data")
+
+        StripeWebhookHandler._prefetch_subscriptions([event_data])
+
         try:
-            # mark event as processed
-            db.session.add(StripeProcessedEvent(stripe_event_id=event_id))
+            if current_app.config["WEBHOOK_COALESCING_ENABLED"]:
+                user_id = webhook_coalescer.submit(
+                    event_data, StripeWebhookHandler._commit_coalesced_events,
+                    current_app.config["WEBHOOK_COALESCE_WINDOW_MS"] / 1000,
+                    current_app.config["WEBHOOK_COALESCE_MAX_EVENTS"], key=customer_id)
+            elif current_app.config["WEBHOOK_GROUP_COMMIT_ENABLED"]:
+                user_id = webhook_group_committer.submit(
+                    event_data, StripeWebhookHandler._commit_event_group,
+                    current_app.config["WEBHOOK_GROUP_COMMIT_MAX_WAIT_MS"] / 1000,
+                    current_app.config["WEBHOOK_GROUP_COMMIT_MAX_EVENTS"])
+            else:
+                user_id = StripeWebhookHandler._apply_and_commit_event(event_data)
 
-            # get or create user, for the sake of this task, users get created here if they don't exist
-            user = StripeWebhookHandler._get_or_create_user(event_data)
-            if not user:
-                return ResponseHelper.error("Customer ID not found in event data")
+        except Exception as e:
+            db.session.rollback()
+            metrics.webhook_rollbacks.inc()
+            return ResponseHelper.error(f"Failed to process event: {str(e)}", 500)
 
-            # handle the specific event type
-            StripeWebhookHandler._handle_event_by_type(event_data, user)
+        if user_id is None:
+            metrics.webhook_duplicates.inc()
+            return ResponseHelper.success("Event already processed")
+
+        metrics.webhook_event_duration.observe(event_data["type"], time.perf_counter() - started)
+        return ResponseHelper.success(f"Event processed successfully for user id {user_id}")
+        # Adding the ID here into the response just so I could pull that user ID later
+
+    @staticmethod
+    def _apply_and_commit_event(event_data):
+        """
+        Apply the event in its own transaction. Returns the user id, or None if the event was already processed.
+        """
+        user = StripeWebhookHandler._apply_event(event_data)
+        if not user:
+            db.session.rollback()
+            return None
 
+        user_id = user.id  # read before commit, which expires the user
+        db.session.commit()
+        StripeWebhookHandler._after_commit([user_id], [event_data["id"]])
+        return user_id
+
+    @staticmethod
+    def _commit_event_group(works):
+        """
+        Apply the events of concurrent requests in one transaction with one commit (see group_commit.py), setting each
+        PendingWork's result to its user id (None if already processed). If an event fails, the transaction is rolled
+        back and retried without it, so the failure only rolls back that event.
+        """
+        metrics.webhook_group_commit_size.observe(None, len(works))
+        remaining = list(works)
+
+        while remaining:
+            failed = None
+            try:
+                user_ids = {}
+                for work in remaining:
+                    failed = work
+                    user = StripeWebhookHandler._apply_event(work.payload)
+                    # flushed per event, so an error raised at flush time (a constraint violation) is charged to the
+                    # event that caused it rather than to the next one, whose statements would autoflush it
+                    db.session.flush()
+                    user_ids[work] = user.id if user else None
+                failed = None
+                db.session.commit()
+
+            except Exception as e:
+                db.session.rollback()
+                if failed is None:
+                    # the commit itself failed, that can't be pinned on a single event
+                    raise
+                failed.error = e
+                remaining.remove(failed)
+                continue
+
+            for work, user_id in user_ids.items():
+                work.result = user_id
+            StripeWebhookHandler._after_commit(
+                [user_id for user_id in user_ids.values() if user_id is not None],
+                [work.payload["id"] for work, user_id in user_ids.items() if user_id is not None])
+            return
+
+    @staticmethod
+    def _commit_coalesced_events(works):
+        """
+        Apply a burst of events of one customer (see webhook_coalescer) in one transaction, in `created` order, with a
+        single write of the user row and at most one access change, and set each PendingWork's result to the user id
+        (None if already processed). Every event is still claimed. If the transaction fails, the events are retried
+        one by one, so a failure only rolls back its own event.
+        """
+        metrics.webhook_coalesce_size.observe(None, len(works))
+        # stable sort, so events created in the same second keep their arrival order
+        works = sorted(works, key=lambda work: work.payload.get("created") or 0)
+
+        try:
+            claimed_event_ids = StripeWebhookHandler._claim_events({work.payload["id"] for work in works})
+            # a redelivery within the burst is a duplicate of its first delivery
+            first_deliveries = {}
+            for work in works:
+                first_deliveries.setdefault(work.payload["id"], work)
+            claimed = [work for event_id, work in first_deliveries.items() if event_id in claimed_event_ids]
+            user_id = None
+            if claimed:
+                user = StripeWebhookHandler._get_or_create_user(claimed[0].payload)
+                # the user is only flushed at commit, not before the statements each event runs
+                with db.session.no_autoflush:
+                    StripeWebhookHandler._apply_events_to_user([work.payload for work in claimed], user)
+                user_id = user.id
             db.session.commit()
-            return ResponseHelper.success(f"Event processed successfully for user id {user.id}")
-            # Adding the ID here into the response just so I could pull that user ID later
+
+        except Exception:
+            db.session.rollback()
+            for work in works:
+                try:
+                    work.result = StripeWebhookHandler._apply_and_commit_event(work.payload)
+                except Exception as e:
+                    db.session.rollback()
+                    work.error = e
+            return
+
+        for work in claimed:
+            work.result = user_id
+        StripeWebhookHandler._after_commit([user_id] if user_id is not None else [], claimed_event_ids)
+
+    @staticmethod
+    def _after_commit(user_ids, event_ids):
+        """
+        Publish committed changes to the replica router, the in-process caches, the change streams and the access index
+        """
+        # only evict after the commit succeeded, so a concurrent read can't re-cache the old value
+        read_replica_router.record_writes(user_ids)
+        access_cache.invalidate(*user_ids)
+        processed_event_filter.add(*event_ids)
+        access_change_notifier.notify()
+        if access_index.enabled and user_ids:
+            AccessIndexHandler.write_users(user_ids)
+
+    @staticmethod
+    def _apply_event(event_data):
+        """
+        Claim the event and apply it to its user within the current transaction, the caller commits.
+        The event must have a customer ID. Returns the user, or None if the event was already processed.
+        """
+        # check if event was already processed for idempotency, and mark it as processed, in one statement
+        if not StripeWebhookHandler._claim_events([event_data["id"]]):
+            return None
+
+        # get or create user, for the sake of this task, users get created here if they don't exist
+        user = StripeWebhookHandler._get_or_create_user(event_data)
+
+        # handle the specific event type
+        StripeWebhookHandler._apply_event_to_user(event_data, user)
+        return user
+
+    @staticmethod
+    def _apply_event_to_user(event_data, user):
+        """
+        Handle the event for its user. If access_until changed, bump the user's version and append the change to the
+        access change log. Returns whether the user changed.
+        """
+        return StripeWebhookHandler._apply_events_to_user([event_data], user)
+
+    @staticmethod
+    def _apply_events_to_user(events, user):
+        """
+        Handle the events for their user, in list order. Events created before the newest event already applied to the
+        user are stale and skipped, so deliveries out of order can't roll the user back. The user was read by the user
+        upsert, which locks its row until commit, so its last_event_created can't change concurrently. If access_until
+        changed overall, bump the user's version once and append one change to the access change log. Returns whether
+        the user changed.
+        """
+        previous_access_until = DateTimeNaiveHelper.make_timezone_aware(user.access_until)
+        for event_data in events:
+            # Stripe's created has a one second resolution, events of the same second are applied in arrival order
+            created = event_data.get("created")
+            if created is not None and created < (user.last_event_created or 0):
+                metrics.webhook_stale_events.inc()
+                continue
+
+            StripeWebhookHandler._handle_event_by_type(event_data, user)
+            if created is not None:
+                user.last_event_created = created
+
+        if DateTimeNaiveHelper.make_timezone_aware(user.access_until) == previous_access_until:
+            return False
+
+        user.version = (user.version or 0) + 1
+        user.updated_at = datetime.now(timezone.utc)
+        db.session.add(AccessChange(user_id=user.id, access_until=user.access_until, version=user.version,
+                                    updated_at=user.updated_at))
+        return True
+
+    @staticmethod
+    def process_webhook_events(events):
+        """
+        Batch webhook event processor. Idempotency and users are resolved for the whole batch with set-based
+        statements, and all events are committed in a single transaction. Returns a per-event result.
+        """
+        if not isinstance(events, list):
+            return ResponseHelper.error("Invalid batch data -- expected a list of events")
+
+        max_events = current_app.config["WEBHOOK_BATCH_MAX_EVENTS"]
+        if len(events) > max_events:
+            return ResponseHelper.error(f"Batch too large -- at most {max_events} events are allowed")
+
+        try:
+            results = StripeWebhookHandler._process_event_batch(events)
 
         except Exception as e:
             db.session.rollback()
-            return ResponseHelper.error(f"Failed to process event: {str(e)}", 500)
+            metrics.webhook_rollbacks.inc()
+            return ResponseHelper.error(f"Failed to process event batch: {str(e)}", 500)
+
+        return ResponseHelper.success({"results": results})
+
+    @staticmethod
+    def _process_event_batch(events):
+        """
+        Apply a list of events in one transaction, in list order, and commit it. Returns a per-event result, and
+        raises if the transaction failed (the caller rolls back).
+        """
+        results = [None] * len(events)
+        batch_event_ids = set()
+        pending = []
+
+        for index, event_data in enumerate(events):
+            event_id = event_data.get("id") if isinstance(event_data, dict) else None
+
+            if not event_id:
+                results[index] = StripeWebhookHandler._batch_result(
+                    event_id, "invalid", "Invalid event data -- event id not found")
+            elif event_data.get("type") not in RELEVANT_EVENTS:
+                results[index] = StripeWebhookHandler._batch_result(
+                    event_id, "ignored", "Event type not relevant, ignoring")
+            elif not StripeWebhookHandler._get_customer_id(event_data):
+                results[index] = StripeWebhookHandler._batch_result(
+                    event_id, "invalid", "Customer ID not found in event data")
+            elif event_id in batch_event_ids:
+                # delivered twice within this batch
+                results[index] = StripeWebhookHandler._batch_result(event_id, "duplicate", "Event already processed")
+            else:
+                batch_event_ids.add(event_id)
+                pending.append((index, event_data))
+
+        StripeWebhookHandler._prefetch_subscriptions([event_data for _, event_data in pending])
+
+        # one statement for idempotency of the whole batch
+        claimed_event_ids = StripeWebhookHandler._claim_events(batch_event_ids)
+
+        users = StripeWebhookHandler._get_or_create_users(
+            {StripeWebhookHandler._get_customer_id(event_data) for _, event_data in pending
+             if event_data["id"] in claimed_event_ids})
+
+        # the statements run per event (subscription upserts and lookups) don't read pending ORM changes, so the
+        # users and change log rows are flushed once at commit instead of before every one of them
+        with db.session.no_autoflush:
+            for index, event_data in pending:
+                if event_data["id"] not in claimed_event_ids:
+                    results[index] = StripeWebhookHandler._batch_result(
+                        event_data["id"], "duplicate", "Event already processed")
+                    continue
+
+                user = users[StripeWebhookHandler._get_customer_id(event_data)]
+                StripeWebhookHandler._apply_event_to_user(event_data, user)
+
+                results[index] = StripeWebhookHandler._batch_result(
+                    event_data["id"], "processed", "Event processed successfully", user.id)
+
+        user_ids = [user.id for user in users.values()]
+        db.session.commit()
+
+        StripeWebhookHandler._after_commit(user_ids, claimed_event_ids)
+        metrics.webhook_duplicates.inc(amount=sum(result["status"] == "duplicate" for result in results))
+        return results
+
+    @staticmethod
+    def _batch_result(event_id, status, message, user_id=None):
+        return {"id": event_id, "status": status, "message": message, "user_id": user_id}
+
+    @staticmethod
+    def _get_customer_id(event_data):
+        return event_data.get("data", {}).get("object", {}).get("customer")
+
+    @staticmethod
+    def load_processed_event_ids():
+        """
+        All processed event ids, streamed to build the processed event filter
+        """
+        return db.session.scalars(select(StripeProcessedEvent.stripe_event_id).execution_options(yield_per=10000))
+
+    @staticmethod
+    def _is_processed(event_id):
+        """
+        Read-only idempotency probe. Ids that are definitely new according to the in-memory filter skip the database
+        entirely, and redeliveries of known ids are answered without taking a write lock for the claim.
+        """
+        if not processed_event_filter.might_contain(event_id):
+            return False
+
+        return db.session.get(StripeProcessedEvent, event_id) is not None
+
+    @staticmethod
+    def _claim_events(event_ids):
+        """
+        Mark events as processed with a single INSERT ... ON CONFLICT DO NOTHING and return the ids that were newly
+        claimed. Concurrent redeliveries of the same event can't both claim it, and neither fails with a primary key
+        violation -- the loser just doesn't get the id back.
+        """
+        if not event_ids:
+            return set()
+
+        statement = UpsertHelper.insert(db.session, StripeProcessedEvent).values(
+            [{"stripe_event_id": event_id} for event_id in event_ids]
+        ).on_conflict_do_nothing().returning(StripeProcessedEvent.stripe_event_id)
+
+        return set(db.session.scalars(statement))
+
+    @staticmethod
+    def _get_or_create_users(customer_ids):
+        """
+        Get existing users or create new ones for a set of Stripe customer IDs, with a single upsert statement
+        """
+        if not customer_ids:
+            return {}
+
+        statement = UpsertHelper.insert(db.session, User).values(
+            [{"stripe_customer_id": customer_id} for customer_id in customer_ids]
+        )
+        # a no-op update instead of DO NOTHING, so existing users are returned by the same statement
+        statement = statement.on_conflict_do_update(
+            index_elements=[User.stripe_customer_id],
+            set_={"stripe_customer_id": statement.excluded.stripe_customer_id},
+        ).returning(User)
+
+        users = db.session.scalars(statement, execution_options={"populate_existing": True})
+        return {user.stripe_customer_id: user for user in users}
 
     @staticmethod
     def _get_or_create_user(event_data):
         """
         Get existing user or create new one based on Stripe customer ID
         """
-        customer_id = event_data.get("data", {}).get("object", {}).get("customer")
+        customer_id = StripeWebhookHandler._get_customer_id(event_data)
         if not customer_id:
             return None
 
-        user = User.query.filter_by(stripe_customer_id=customer_id).first()
-        if not user:
-            user = User(stripe_customer_id=customer_id)
-            db.session.add(user)
-
-        return user
+        return StripeWebhookHandler._get_or_create_users({customer_id})[customer_id]
 
     @staticmethod
     def _handle_event_by_type(event_data, user):
@@ -92,6 +424,10 @@ class StripeWebhookHandler:
         """
         event_type = event_data["type"]
 
+        if event_type in [StripeEventType.SUBSCRIPTION_CREATED.value, StripeEventType.SUBSCRIPTION_UPDATED.value,
+                          StripeEventType.SUBSCRIPTION_DELETED.value]:
+            StripeWebhookHandler._store_subscription(event_data)
+
         if event_type in [StripeEventType.SUBSCRIPTION_CREATED.value, StripeEventType.SUBSCRIPTION_UPDATED.value]:
             StripeWebhookHandler._handle_subscription_event(event_data, user)
         elif event_type == StripeEventType.SUBSCRIPTION_DELETED.value:
@@ -118,7 +454,36 @@ class StripeWebhookHandler:
             # keep existing access until the end of the current period, a grace period could be implemented here
             pass
         else:  # canceled, unpaid, incomplete, incomplete_expired
-            user.access_until = datetime.now(timezone.utc)
+            StripeWebhookHandler._revoke_access(user)
+
+    @staticmethod
+    def _store_subscription(event_data):
+        """
+        Upsert the event's subscription into the local Subscription table, unless a newer event already updated it
+        """
+        subscription = event_data.get("data", {}).get("object", {})
+        if not subscription.get("id"):
+            return
+
+        current_period_end = subscription.get("current_period_end")
+        values = {
+            "id": subscription["id"],
+            "stripe_customer_id": subscription.get("customer"),
+            "status": subscription.get("status") or SubscriptionStatus.CANCELED.value,
+            "current_period_end": datetime.fromtimestamp(current_period_end, tz=timezone.utc)
+            if current_period_end else None,
+            "last_event_created": event_data.get("created") or 0,
+        }
+        if event_data["type"] == StripeEventType.SUBSCRIPTION_DELETED.value:
+            values["status"] = SubscriptionStatus.CANCELED.value
+
+        statement = UpsertHelper.insert(db.session, Subscription).values(values)
+        statement = statement.on_conflict_do_update(
+            index_elements=[Subscription.id],
+            set_={name: statement.excluded[name] for name in values if name != "id"},
+            where=Subscription.last_event_created <= statement.excluded.last_event_created,
+        )
+        db.session.execute(statement)
 
     @staticmethod
     def _is_active_subscription_status(status: str) -> bool:
@@ -130,7 +495,7 @@ class StripeWebhookHandler:
         Handle subscription deleted events
         """
         # instantly revoke access
-        user.access_until = datetime.now(timezone.utc)
+        StripeWebhookHandler._revoke_access(user)
 
     @staticmethod
     def _handle_payment_failed(user):
@@ -138,7 +503,16 @@ class StripeWebhookHandler:
         Handle failed payment events
         """
         # instantly revoke access, a grace period could be implemented here
+        StripeWebhookHandler._revoke_access(user)
+
+    @staticmethod
+    def _revoke_access(user):
+        """
+        End the user's access now, and record the revocation so access tokens issued before it stop verifying
+        """
         user.access_until = datetime.now(timezone.utc)
+        user.revocation_version = (user.revocation_version or 0) + 1
+        db.session.add(AccessRevocation(user_id=user.id, revocation_version=user.revocation_version))
 
     @staticmethod
     def _handle_invoice_paid(event_data, user):
@@ -149,8 +523,48 @@ class StripeWebhookHandler:
         subscription_id = invoice.get("subscription")
 
         if subscription_id:
-            # I believe that in this case, since the subscription object is not provided in the event,
-            # the Stripe API should be called to retrieve the subscription details (to find out the current_period_end)
-            # but for this task, I will assume that the subscription is active and set access until 30 days from now
+            # the subscription object is not provided in the event, so its period end comes from the local copy kept
+            # up to date by subscription events, or else from the Stripe API fetch made before the transaction
             # Invoice object (Stripe): https://docs.stripe.com/api/invoices/object?api-version=2025-05-28.basil
-            user.access_until = datetime.now(timezone.utc) + timedelta(days=30)
+            now = datetime.now(timezone.utc)
+            current_period_end = StripeWebhookHandler._local_period_ends([subscription_id]).get(subscription_id)
+            if not current_period_end or current_period_end <= now:
+                fetched = stripe_client.cached_subscription(subscription_id)
+                if fetched is not StripeClient.MISS:
+                    current_period_end = StripeClient.current_period_end(fetched)
+
+            if current_period_end and current_period_end > now:
+                user.access_until = current_period_end
+            else:
+                # unknown subscription, or the renewal's subscription.updated hasn't arrived yet and Stripe couldn't be
+                # asked -- assume a monthly period, the next subscription event corrects it
+                user.access_until = now + timedelta(days=30)
+
+    @staticmethod
+    def _prefetch_subscriptions(events):
+        """
+        Fetch the subscriptions of invoice.paid events the local store can't resolve from the Stripe API, before the
+        transaction starts, so no database lock is held while waiting on Stripe. _handle_invoice_paid only reads them
+        from the client's cache.
+        """
+        if not stripe_client.enabled:
+            return
+
+        subscription_ids = {event_data["data"]["object"]["subscription"] for event_data in events
+                            if event_data.get("type") == StripeEventType.INVOICE_PAID.value
+                            and event_data.get("data", {}).get("object", {}).get("subscription")}
+        if not subscription_ids:
+            return
+
+        now = datetime.now(timezone.utc)
+        period_ends = StripeWebhookHandler._local_period_ends(subscription_ids)
+        stripe_client.prefetch_subscriptions(
+            subscription_id for subscription_id in subscription_ids
+            if not period_ends.get(subscription_id) or period_ends[subscription_id] <= now)
+
+    @staticmethod
+    def _local_period_ends(subscription_ids):
+        rows = db.session.execute(
+            select(Subscription.id, Subscription.current_period_end).where(Subscription.id.in_(subscription_ids)))
+        return {subscription_id: DateTimeNaiveHelper.make_timezone_aware(current_period_end)
+                for subscription_id, current_period_end in rows}
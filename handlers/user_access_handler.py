@@ -1,28 +1,224 @@
 """
 User Access Handler for the app.
 """
+import asyncio
 
+from flask import Response, current_app
+from sqlalchemy import bindparam, select
+from werkzeug.http import http_date, parse_date
+
+from access_index import access_index
+from cache import access_cache, AccessCache, AccessState
+from database import async_engines, read_replica_router
+from handlers.access_index_handler import AccessIndexHandler
 from models import db, User
-from datetime import datetime, timezone
+from datetime import datetime, timezone, timedelta
 from helpers import ResponseHelper, DateTimeNaiveHelper
 
+# built once per process, so its compiled form is reused from the engine's compiled cache on every request
+ACCESS_QUERY = select(User.access_until, User.version, User.updated_at).where(User.id == bindparam("user_id"))
+
 
 class UserAccessHandler:
     @staticmethod
-    def get_user_access(user_id):
+    def get_user_access(user_id, if_none_match=None, if_modified_since=None):
+        """
+        Get user access status.
+        This is the hottest endpoint, so it skips the ORM (no session, identity map or object hydration) and runs the
+        precompiled Core query on a pooled connection, then writes the JSON body directly instead of using jsonify.
+        Conditional requests (If-None-Match / If-Modified-Since) are answered with a 304 without building the body.
+        The shared access index and the per-process cache are tried first.
+        """
+        state = UserAccessHandler._get_known_access_state(user_id)
+        if state is AccessCache.MISS:
+            generation = access_cache.generation()
+            with read_replica_router.read_engine([user_id]).connect() as connection:
+                row = connection.execute(ACCESS_QUERY, {"user_id": user_id}).first()
+            state = UserAccessHandler._cache_access_row(user_id, row, generation)
+
+        return UserAccessHandler._access_response(user_id, state, if_none_match, if_modified_since)
+
+    @staticmethod
+    async def get_user_access_async(user_id, if_none_match=None, if_modified_since=None):
+        """
+        get_user_access for the ASGI app (see asgi.py), with the same lookups and response. A miss is loaded through
+        the async engine, so a request waiting on the database doesn't hold a thread.
+        """
+        # building and syncing the shared index query the database synchronously, so they don't run on the event loop
+        if access_index.enabled and AccessIndexHandler.is_maintenance_due():
+            await asyncio.to_thread(AccessIndexHandler.maintain_access_index)
+
+        state = UserAccessHandler._get_known_access_state(user_id, maintain_index=False)
+        if state is AccessCache.MISS:
+            generation = access_cache.generation()
+            async with async_engines.read_engine([user_id]).connect() as connection:
+                row = (await connection.execute(ACCESS_QUERY, {"user_id": user_id})).first()
+            state = UserAccessHandler._cache_access_row(user_id, row, generation)
+
+        return UserAccessHandler._access_response(user_id, state, if_none_match, if_modified_since)
+
+    @staticmethod
+    def _get_known_access_state(user_id, maintain_index=True):
         """
-        Get user access status
+        The user's AccessState from the shared access index or the per-process cache, or AccessCache.MISS
         """
+        state = AccessCache.MISS
+        if access_index.enabled:
+            state = AccessIndexHandler.get_access_state(user_id) if maintain_index else access_index.get(user_id)
+        if state is AccessCache.MISS:
+            state = access_cache.get(user_id)
+        return state
 
-        user = db.session.get(User, user_id)
-        if not user:
+    @staticmethod
+    def _cache_access_row(user_id, row, generation):
+        if not row:
+            return None
+
+        state = AccessState(*row)
+        access_cache.set(user_id, state, generation)
+        return state
+
+    @staticmethod
+    def _access_response(user_id, state, if_none_match, if_modified_since):
+        if state is None:
             return ResponseHelper.error("User not found", 404)
 
-        access_status = {
-            "user_id": user.id,
-            "access_until": user.access_until.isoformat() if user.access_until else None,
-            "has_access": DateTimeNaiveHelper.make_timezone_aware(user.access_until) > datetime.now(
-                timezone.utc) if user.access_until else False
+        now = datetime.now(timezone.utc)
+        access_until = DateTimeNaiveHelper.make_timezone_aware(state.access_until)
+        has_access = access_until > now if access_until else False
+
+        headers = UserAccessHandler._caching_headers(state, access_until, has_access, now)
+        if UserAccessHandler._is_not_modified(headers, if_none_match, if_modified_since):
+            return Response(status=304, headers=headers)
+
+        if access_until:
+            body = '{"access_until":"%s","has_access":%s,"user_id":%d}\n' % (
+                state.access_until.isoformat(), "true" if has_access else "false", user_id)
+        else:
+            body = '{"access_until":null,"has_access":false,"user_id":%d}\n' % user_id
+
+        # same body as ResponseHelper.success(_access_status(...)) -- compact, with sorted keys
+        return Response(body, 200, headers=headers, mimetype="application/json")
+
+    @staticmethod
+    def _caching_headers(state, access_until, has_access, now):
+        """
+        The body only changes when a webhook bumps the user's version, or when access expires at access_until.
+        So the ETag is the version plus has_access, and responses may be cached until the earlier of expiry and
+        ACCESS_HTTP_MAX_AGE_SECONDS (which bounds how long a not yet known revocation can be served from cache).
+        """
+        max_age = current_app.config["ACCESS_HTTP_MAX_AGE_SECONDS"]
+        if has_access:
+            max_age = min(max_age, int((access_until - now).total_seconds()))
+
+        last_modified = DateTimeNaiveHelper.make_timezone_aware(state.updated_at)
+        if access_until and not has_access and (last_modified is None or access_until > last_modified):
+            last_modified = access_until  # expiring changed the body
+
+        headers = {
+            "ETag": f'"v{state.version}-{int(has_access)}"',
+            "Cache-Control": f"public, max-age={max_age}",
+            "Expires": http_date(now + timedelta(seconds=max_age)),
         }
+        if last_modified:
+            headers["Last-Modified"] = http_date(last_modified)
+        return headers
 
-        return ResponseHelper.success(access_status)
+    @staticmethod
+    def _is_not_modified(headers, if_none_match, if_modified_since):
+        if if_none_match:
+            # weak comparison, as RFC 9110 requires for If-None-Match
+            return if_none_match.contains_weak(headers["ETag"].strip('"'))
+        if if_modified_since and "Last-Modified" in headers:
+            return parse_date(headers["Last-Modified"]) <= if_modified_since
+        return False
+
+    @staticmethod
+    def get_users_access(user_ids=None, customer_ids=None):
+        """
+        Get access status for many users at once, either by user ids or by Stripe customer ids.
+        All ids are resolved with a single IN query, results are returned in request order.
+        """
+        if (user_ids is None) == (customer_ids is None):
+            return ResponseHelper.error("Exactly one of user_ids or stripe_customer_ids must be provided")
+
+        ids = user_ids if user_ids is not None else customer_ids
+        if not isinstance(ids, list):
+            return ResponseHelper.error("Ids must be provided as a list")
+
+        max_ids = current_app.config["BULK_ACCESS_MAX_IDS"]
+        if len(ids) > max_ids:
+            return ResponseHelper.error(f"Too many ids -- at most {max_ids} are allowed")
+
+        if user_ids is not None:
+            if not all(isinstance(user_id, int) and not isinstance(user_id, bool) for user_id in user_ids):
+                return ResponseHelper.error("User ids must be integers")
+            return ResponseHelper.success({"results": UserAccessHandler._get_access_by_user_ids(user_ids)})
+
+        if not all(isinstance(customer_id, str) for customer_id in customer_ids):
+            return ResponseHelper.error("Stripe customer ids must be strings")
+        return ResponseHelper.success({"results": UserAccessHandler._get_access_by_customer_ids(customer_ids)})
+
+    @staticmethod
+    def _get_access_by_user_ids(user_ids):
+        """
+        Serve what we can from the access index and cache, and load the rest with one IN query on the primary key
+        """
+        found = {}
+        for user_id in set(user_ids):
+            state = UserAccessHandler._get_known_access_state(user_id)
+            if state is not AccessCache.MISS:
+                found[user_id] = state.access_until
+
+        missing = set(user_ids) - found.keys()
+        if missing:
+            generation = access_cache.generation()
+            for user_id, access_until, version, updated_at in db.session.execute(
+                    select(User.id, User.access_until, User.version, User.updated_at).where(User.id.in_(missing)),
+                    bind_arguments={"bind": read_replica_router.read_engine(missing)}):
+                found[user_id] = access_until
+                access_cache.set(user_id, AccessState(access_until, version, updated_at), generation)
+
+        return [UserAccessHandler._access_status(user_id, found[user_id]) if user_id in found
+                else {"user_id": user_id, "error": "User not found"} for user_id in user_ids]
+
+    @staticmethod
+    def _get_access_by_customer_ids(customer_ids):
+        """
+        Resolve Stripe customer ids with one IN query on the unique stripe_customer_id index. User ids aren't known
+        before the query, so if the replica returns a recently changed user the query is repeated on the primary.
+        """
+        query = select(User.id, User.stripe_customer_id, User.access_until).where(
+            User.stripe_customer_id.in_(set(customer_ids)))
+
+        found = {}
+        if customer_ids:
+            engine = read_replica_router.read_engine()
+            while True:
+                found = {customer_id: (user_id, access_until) for user_id, customer_id, access_until in
+                         db.session.execute(query, bind_arguments={"bind": engine})}
+                if engine is db.engine or not any(
+                        read_replica_router.recently_written(user_id) for user_id, _ in found.values()):
+                    break
+                engine = db.engine
+
+        results = []
+        for customer_id in customer_ids:
+            if customer_id in found:
+                access_status = UserAccessHandler._access_status(*found[customer_id])
+                access_status["stripe_customer_id"] = customer_id
+                results.append(access_status)
+            else:
+                results.append({"stripe_customer_id": customer_id, "error": "User not found"})
+
+        return results
+
+    @staticmethod
+    def _access_status(user_id, access_until):
+        # has_access is always computed from the timestamp, so cached entries never go stale because of the clock
+        return {
+            "user_id": user_id,
+            "access_until": access_until.isoformat() if access_until else None,
+            "has_access": DateTimeNaiveHelper.make_timezone_aware(access_until) > datetime.now(
+                timezone.utc) if access_until else False
+        }
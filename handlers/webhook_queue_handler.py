@@ -0,0 +1,190 @@
+"""
+Durable webhook queue for the app. In async webhook mode the endpoint only validates and enqueues the raw event,
+and a pool of background workers drains the queue through the regular webhook handler.
+"""
+import json
+import threading
+import time
+import zlib
+
+from flask import current_app
+from sqlalchemy import select, update
+
+from handlers.stripe_webhook_handler import StripeWebhookHandler, RELEVANT_EVENTS
+from helpers import ResponseHelper, UpsertHelper
+from metrics import metrics
+from models import db, StripeWebhookQueueItem
+
+
+class WebhookQueueHandler:
+
+    @staticmethod
+    def enqueue_webhook_event(event_data):
+        """
+        Validate the event and durably enqueue it, so the webhook can be acknowledged without touching user data
+        """
+        event_id = event_data.get("id")
+
+        if not event_id:
+            return ResponseHelper.error("Invalid event data -- event id not found")
+
+        # redeliveries of processed events don't need to go through the queue again
+        if StripeWebhookHandler._is_processed(event_id):
+            return ResponseHelper.success("Event already processed")
+
+        if event_data.get("type") not in RELEVANT_EVENTS:
+            return ResponseHelper.success("Event type not relevant, ignoring")
+
+        customer_id = StripeWebhookHandler._get_customer_id(event_data)
+        if not customer_id:
+            return ResponseHelper.error("Customer ID not found in event data")
+
+        try:
+            # a redelivery of an event that is still waiting in the queue is a no-op
+            shard_key = WebhookQueueHandler._shard_key(customer_id)
+            queued = db.session.execute(UpsertHelper.insert(db.session, StripeWebhookQueueItem).values(
+                stripe_event_id=event_id,
+                stripe_customer_id=customer_id,
+                shard_key=shard_key,
+                shard=shard_key % current_app.config["WEBHOOK_QUEUE_WORKERS"],
+                payload=json.dumps(event_data),
+            ).on_conflict_do_nothing(index_elements=[StripeWebhookQueueItem.stripe_event_id])).rowcount
+            db.session.commit()
+
+        except Exception as e:
+            db.session.rollback()
+            return ResponseHelper.error(f"Failed to enqueue event: {str(e)}", 500)
+
+        if not queued:
+            return ResponseHelper.success("Event already queued")
+
+        return ResponseHelper.success("Event queued for processing", 202)
+
+    @staticmethod
+    def drain_shard(shard, limit, max_attempts):
+        """
+        Process up to `limit` queued events of one shard, oldest first, one transaction per event.
+        All events of a customer map to the same shard, so they are processed in order by a single worker. If an event
+        fails, the rest of that customer's events are left for the next pass so they can't overtake it.
+        The shard is stored with each event, so this reads the (shard, failed, id) index instead of scanning the queue.
+        Returns the number of events processed successfully.
+        """
+        items = db.session.scalars(
+            select(StripeWebhookQueueItem)
+            .where(StripeWebhookQueueItem.shard == shard, StripeWebhookQueueItem.failed.is_(False))
+            .order_by(StripeWebhookQueueItem.id)
+            .limit(limit)
+        ).all()
+
+        blocked_customers = set()
+        processed = 0
+
+        for item in items:
+            item_id, customer_id = item.id, item.stripe_customer_id
+            if customer_id in blocked_customers:
+                continue
+
+            try:
+                started = time.perf_counter()
+                event_data = json.loads(item.payload)
+                StripeWebhookHandler._prefetch_subscriptions([event_data])
+
+                # None if the event was already processed, then the queue item is just dropped
+                user = StripeWebhookHandler._apply_event(event_data)
+
+                db.session.delete(item)
+                user_id = user.id if user else None
+                db.session.commit()
+
+                if user_id is not None:
+                    StripeWebhookHandler._after_commit([user_id], [event_data["id"]])
+                    metrics.webhook_event_duration.observe(event_data["type"], time.perf_counter() - started)
+                else:
+                    metrics.webhook_duplicates.inc()
+                processed += 1
+
+            except Exception as e:
+                db.session.rollback()
+                metrics.webhook_rollbacks.inc()
+                blocked_customers.add(customer_id)
+                WebhookQueueHandler._record_failure(item_id, str(e), max_attempts)
+
+        return processed
+
+    @staticmethod
+    def reshard(shard_count):
+        """
+        Move queued events to their shard for `shard_count` workers, in case they were enqueued while
+        WEBHOOK_QUEUE_WORKERS had another value. Returns the number of events moved.
+        """
+        moved = db.session.execute(
+            update(StripeWebhookQueueItem)
+            .where(StripeWebhookQueueItem.shard != StripeWebhookQueueItem.shard_key % shard_count)
+            .values(shard=StripeWebhookQueueItem.shard_key % shard_count)
+        ).rowcount
+        db.session.commit()
+        return moved
+
+    @staticmethod
+    def _record_failure(item_id, error, max_attempts):
+        item = db.session.get(StripeWebhookQueueItem, item_id)
+        item.attempts += 1
+        item.last_error = error
+        # park the event once it keeps failing, so it doesn't block its customer forever
+        item.failed = item.attempts >= max_attempts
+        db.session.commit()
+
+    @staticmethod
+    def _shard_key(customer_id):
+        # stable across processes (unlike hash()), and kept within a signed 32-bit integer column
+        return zlib.crc32(customer_id.encode()) & 0x7fffffff
+
+
+class WebhookQueueWorkerPool:
+    """
+    Pool of worker threads draining the webhook queue, worker N owns shard N.
+    Run it in a single process (see the `flask webhook-workers` command), so each shard has exactly one consumer.
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self.workers = app.config["WEBHOOK_QUEUE_WORKERS"]
+        self.poll_interval = app.config["WEBHOOK_QUEUE_POLL_INTERVAL_SECONDS"]
+        self.batch_size = app.config["WEBHOOK_QUEUE_BATCH_SIZE"]
+        self.max_attempts = app.config["WEBHOOK_QUEUE_MAX_ATTEMPTS"]
+        self._stop_event = threading.Event()
+        self._threads = []
+
+    def start(self):
+        with self.app.app_context():
+            WebhookQueueHandler.reshard(self.workers)
+            db.session.remove()
+
+        self._stop_event.clear()
+        self._threads = [threading.Thread(target=self._run, args=(shard,), name=f"webhook-worker-{shard}", daemon=True)
+                         for shard in range(self.workers)]
+        for thread in self._threads:
+            thread.start()
+
+    def join(self):
+        for thread in self._threads:
+            thread.join()
+
+    def stop(self, timeout=None):
+        self._stop_event.set()
+        for thread in self._threads:
+            thread.join(timeout)
+
+    def _run(self, shard):
+        with self.app.app_context():
+            while not self._stop_event.is_set():
+                try:
+                    processed = WebhookQueueHandler.drain_shard(shard, self.batch_size, self.max_attempts)
+                except Exception:
+                    db.session.rollback()
+                    processed = 0
+                finally:
+                    db.session.remove()
+
+                if not processed:
+                    self._stop_event.wait(self.poll_interval)
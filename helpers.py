@@ -4,6 +4,7 @@ Helper functions for the app.
 
 from flask import jsonify
 from datetime import timezone
+from sqlalchemy.dialects import postgresql, sqlite
 
 
 class ResponseHelper:
@@ -12,14 +13,14 @@ class ResponseHelper:
     """
 
     @staticmethod
-    def success(message):
+    def success(message, status_code=200):
         """
         Generate a success response.
         """
         if isinstance(message, dict):
-            return jsonify(message), 200
+            return jsonify(message), status_code
 
-        return jsonify({"message": message}), 200
+        return jsonify({"message": message}), status_code
 
     @staticmethod
     def error(message, status_code=400):
@@ -43,3 +44,23 @@ class DateTimeNaiveHelper:
         if dt.tzinfo is None:
             return dt.replace(tzinfo=timezone.utc)
         return dt
+
+
+class UpsertHelper:
+    """
+    Helper class for building dialect specific INSERT ... ON CONFLICT statements.
+    """
+
+    @staticmethod
+    def insert(session, model):
+        """
+        Get an INSERT construct supporting on_conflict_do_nothing/on_conflict_do_update for the session's database.
+        Both SQLite and PostgreSQL share the same ON CONFLICT API in SQLAlchemy.
+        """
+        dialect = session.get_bind().dialect.name
+        if dialect == "postgresql":
+            return postgresql.insert(model)
+        if dialect == "sqlite":
+            return sqlite.insert(model)
+
+        raise NotImplementedError(f"Upserts are not supported for the {dialect} database")
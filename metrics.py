@@ -0,0 +1,230 @@
+"""
+Prometheus metrics for the app, exposed on GET /metrics.
+
+Every metric keeps per-thread slots: a thread only ever writes its own array, so observations need no lock, and the
+arrays are preallocated so an observation doesn't allocate. Slots are summed when /metrics is scraped.
+"""
+import threading
+import time
+from array import array
+from bisect import bisect_left
+
+from flask import request
+from sqlalchemy import event
+
+from cache import access_cache
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+STATEMENT_BUCKETS = (0, 1, 2, 3, 4, 5, 8, 12, 20, 50)
+GROUP_SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256)
+
+
+def _format_value(value):
+    # full precision, like the Prometheus client: {:g} keeps only 6 significant digits, so 1234567 became 1.23457e+06
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+class _ThreadSlots:
+    """
+    Per-thread arrays of `size` float slots, summed on read
+    """
+
+    def __init__(self, size):
+        self._size = size
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._threads = []  # (thread, slots), slots of finished threads are folded into _retired
+        self._retired = array("d", bytes(8 * size))
+
+    def get(self):
+        try:
+            return self._local.slots
+        except AttributeError:
+            slots = self._local.slots = array("d", bytes(8 * self._size))
+            with self._lock:
+                self._threads.append((threading.current_thread(), slots))
+                if len(self._threads) > 64:
+                    self._fold_finished_threads()
+            return slots
+
+    def total(self):
+        with self._lock:
+            self._fold_finished_threads()
+            totals = array("d", self._retired)
+            for _, slots in self._threads:
+                for index in range(self._size):
+                    totals[index] += slots[index]
+        return totals
+
+    def _fold_finished_threads(self):
+        alive = []
+        for thread, slots in self._threads:
+            if thread.is_alive():
+                alive.append((thread, slots))
+            else:
+                for index in range(self._size):
+                    self._retired[index] += slots[index]
+        self._threads = alive
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, documentation, label_name=None):
+        self.name = name
+        self.documentation = documentation
+        self.label_name = label_name
+        self._children = {}
+        self._lock = threading.Lock()
+
+    def labels(self, label):
+        """
+        Child metric for a label value, children are created once and cached
+        """
+        child = self._children.get(label)
+        if child is None:
+            with self._lock:
+                child = self._children.setdefault(label, self._new_child())
+        return child
+
+    def _label(self, label, extra=""):
+        labels = [f'{self.label_name}="{label}"'] if self.label_name else []
+        if extra:
+            labels.append(extra)
+        return "{" + ",".join(labels) + "}" if labels else ""
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        for label, child in sorted(self._children.items(), key=lambda item: str(item[0])):
+            lines.extend(self._render_child(label, child))
+        return lines
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def _new_child(self):
+        return _ThreadSlots(1)
+
+    def inc(self, label=None, amount=1):
+        self.labels(label).get()[0] += amount
+
+    def _render_child(self, label, child):
+        return [f"{self.name}{self._label(label)} {_format_value(child.total()[0])}"]
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, documentation, label_name=None, buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, label_name)
+        self.buckets = buckets
+
+    def _new_child(self):
+        # one slot per bucket, one for +Inf, then the sum
+        return _ThreadSlots(len(self.buckets) + 2)
+
+    def observe(self, label, value):
+        slots = self.labels(label).get()
+        slots[bisect_left(self.buckets, value)] += 1
+        slots[-1] += value
+
+    def _render_child(self, label, child):
+        totals = child.total()
+        lines = []
+        cumulative = 0
+        for index, bound in enumerate(self.buckets + (float("inf"),)):
+            cumulative += totals[index]
+            le = 'le="+Inf"' if bound == float("inf") else f'le="{bound:g}"'
+            lines.append(f"{self.name}_bucket{self._label(label, le)} {_format_value(cumulative)}")
+        lines.append(f"{self.name}_sum{self._label(label)} {_format_value(totals[-1])}")
+        lines.append(f"{self.name}_count{self._label(label)} {_format_value(cumulative)}")
+        return lines
+
+
+class Metrics:
+    """
+    All metrics of the app. init_app hooks request timing and SQL statement counting into the app.
+    """
+
+    def __init__(self):
+        self.request_duration = Histogram(
+            "http_request_duration_seconds", "Request latency per route.", "route")
+        self.statements_per_request = Histogram(
+            "db_statements_per_request", "SQL statements executed per request, per route.", "route",
+            STATEMENT_BUCKETS)
+        self.webhook_event_duration = Histogram(
+            "stripe_webhook_event_duration_seconds", "Processing latency per Stripe event type.", "event_type")
+        self.webhook_group_commit_size = Histogram(
+            "stripe_webhook_group_commit_size", "Events applied per group commit.", buckets=GROUP_SIZE_BUCKETS)
+        self.webhook_coalesce_size = Histogram(
+            "stripe_webhook_coalesce_size", "Events of one customer applied per coalesced write.",
+            buckets=GROUP_SIZE_BUCKETS)
+        self.admission_queue_duration = Histogram(
+            "admission_queue_duration_seconds", "Time requests waited for a slot, per route class.", "route_class")
+        self.admission_rejections = Counter(
+            "admission_rejections_total", "Requests shed with a 503 because their route class was saturated.",
+            "route_class")
+        self.webhook_duplicates = Counter(
+            "stripe_webhook_duplicate_events_total", "Events skipped because they were already processed.")
+        self.webhook_stale_events = Counter(
+            "stripe_webhook_stale_events_total",
+            "Events skipped because a newer event was already applied to their user.")
+        self.webhook_rollbacks = Counter(
+            "stripe_webhook_rollbacks_total", "Webhook transactions rolled back because of an error.")
+        self.stripe_api_request_duration = Histogram(
+            "stripe_api_request_duration_seconds", "Latency of requests to the Stripe API.")
+        self.stripe_api_requests = Counter(
+            "stripe_api_requests_total", "Stripe API fetches per outcome, circuit_open ones were never sent.",
+            "outcome")
+        self.event_archive_written = Counter(
+            "event_archive_written_events_total", "Webhook events written to the event archive.")
+        self.event_archive_dropped = Counter(
+            "event_archive_dropped_events_total",
+            "Webhook events dropped because the event archive writer fell behind or failed to write them.")
+        self._request_state = threading.local()
+
+    def init_app(self, app, db):
+        app.before_request(self._before_request)
+        app.after_request(self._after_request)
+
+        with app.app_context():
+            for engine in db.engines.values():
+                event.listen(engine, "before_cursor_execute", self._count_statement)
+
+    def _before_request(self):
+        self._request_state.started = time.perf_counter()
+        self._request_state.statements = 0
+
+    def _after_request(self, response):
+        started = getattr(self._request_state, "started", None)
+        if started is not None:
+            route = request.url_rule.rule if request.url_rule else "<unmatched>"
+            self.request_duration.observe(route, time.perf_counter() - started)
+            self.statements_per_request.observe(route, self._request_state.statements)
+            self._request_state.started = None
+        return response
+
+    def _count_statement(self, *args):
+        # statements outside of a request (workers, CLI) are not attributed to any route
+        if getattr(self._request_state, "started", None) is not None:
+            self._request_state.statements += 1
+
+    def render(self):
+        lines = []
+        for metric in (self.request_duration, self.statements_per_request, self.webhook_event_duration,
+                       self.webhook_group_commit_size, self.webhook_coalesce_size, self.admission_queue_duration,
+                       self.admission_rejections, self.webhook_duplicates, self.webhook_stale_events,
+                       self.webhook_rollbacks, self.stripe_api_request_duration, self.stripe_api_requests,
+                       self.event_archive_written, self.event_archive_dropped):
+            lines.extend(metric.render())
+
+        for name, value in access_cache.stats().items():
+            kind = "gauge" if name == "size" else "counter"
+            metric_name = f"access_cache_{name}" if kind == "gauge" else f"access_cache_{name}_total"
+            lines.extend([f"# TYPE {metric_name} {kind}", f"{metric_name} {value}"])
+
+        return "\n".join(lines) + "\n"
+
+
+metrics = Metrics()
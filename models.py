@@ -1,6 +1,8 @@
 """
 Database models for the app
 """
+from datetime import datetime, timezone
+
 from flask_sqlalchemy import SQLAlchemy
 
 db = SQLAlchemy()
@@ -10,7 +12,70 @@ class User(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     stripe_customer_id = db.Column(db.String(100), unique=True, nullable=False)
     access_until = db.Column(db.DateTime, nullable=True)
+    # bumped whenever a webhook changes access_until, used for ETags and by downstream caches
+    version = db.Column(db.Integer, nullable=False, default=0)
+    updated_at = db.Column(db.DateTime, nullable=True)
+    # bumped whenever access is revoked, access tokens issued with an older revocation version are rejected
+    revocation_version = db.Column(db.Integer, nullable=False, default=0)
+    # created timestamp of the newest Stripe event applied to the user, older events are skipped (see
+    # StripeWebhookHandler._apply_events_to_user)
+    last_event_created = db.Column(db.Integer, nullable=False, default=0)
+
+
+class Subscription(db.Model):
+    """
+    Local copy of the state of Stripe subscriptions, kept up to date by subscription events, so invoice events can be
+    resolved without calling the Stripe API. last_event_created keeps older, redelivered events from overwriting it.
+    """
+    id = db.Column(db.String(100), primary_key=True)  # Stripe subscription id
+    stripe_customer_id = db.Column(db.String(100), nullable=False, index=True)
+    status = db.Column(db.String(32), nullable=False)
+    current_period_end = db.Column(db.DateTime, nullable=True)
+    last_event_created = db.Column(db.Integer, nullable=False, default=0)
 
 
 class StripeProcessedEvent(db.Model):
     stripe_event_id = db.Column(db.String(100), primary_key=True)
+    processed_at = db.Column(db.DateTime, nullable=False, index=True, default=lambda: datetime.now(timezone.utc))
+
+
+class AccessRevocation(db.Model):
+    """
+    Append-only list of access revocations, pulled incrementally by access token verifiers (see access_tokens.py).
+    The autoincrement id is the cursor.
+    """
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, nullable=False)
+    revocation_version = db.Column(db.Integer, nullable=False)
+    revoked_at = db.Column(db.DateTime, nullable=False, index=True, default=lambda: datetime.now(timezone.utc))
+
+
+class AccessChange(db.Model):
+    """
+    Append-only log of access changes, one row per User version, streamed by GET /access/changes.
+    The autoincrement seq is the cursor clients resume from.
+    """
+    seq = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, nullable=False)
+    access_until = db.Column(db.DateTime, nullable=True)
+    version = db.Column(db.Integer, nullable=False)
+    updated_at = db.Column(db.DateTime, nullable=True)
+
+
+class StripeWebhookQueueItem(db.Model):
+    """
+    Raw webhook event waiting to be processed by the background workers (async webhook mode).
+    The autoincrement id defines the processing order within a customer. `shard` is `shard_key` modulo the number of
+    workers, stored so a worker reads only its own shard's rows through the index.
+    """
+    __table_args__ = (db.Index("ix_stripe_webhook_queue_item_shard_failed_id", "shard", "failed", "id"),)
+
+    id = db.Column(db.Integer, primary_key=True)
+    stripe_event_id = db.Column(db.String(100), unique=True, nullable=False)
+    stripe_customer_id = db.Column(db.String(100), nullable=False)
+    shard_key = db.Column(db.Integer, nullable=False)
+    shard = db.Column(db.Integer, nullable=False)
+    payload = db.Column(db.Text, nullable=False)
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    failed = db.Column(db.Boolean, nullable=False, default=False)
+    last_error = db.Column(db.Text, nullable=True)
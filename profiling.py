@@ -0,0 +1,149 @@
+"""
+Opt-in per-request profiling.
+
+With PROFILING_ENABLED, a request is profiled when it carries the PROFILING_HEADER (with PROFILING_HEADER_TOKEN as its
+value, if one is configured) or falls within PROFILING_SAMPLE_RATE. A profiled request runs under cProfile and has
+every SQL statement recorded with its duration. Two files are written to PROFILING_OUTPUT_DIR:
+
+- `<profile id>.collapsed`: collapsed stacks in microseconds, for flamegraph.pl / speedscope
+- `<profile id>.sql.log`: every statement with its duration, in execution order
+
+The profile id is returned in the X-Profile-Id response header. Requests that are not profiled only pay for a config
+lookup per request and a thread-local lookup per SQL statement.
+"""
+import cProfile
+import os
+import pstats
+import random
+import re
+import threading
+import time
+import uuid
+from collections import defaultdict
+
+from flask import current_app, request
+from sqlalchemy import event
+
+# deeper call paths are cut off at their top, estimated paths below this share of a second are folded into the parent
+MAX_STACK_DEPTH = 64
+MIN_PATH_SECONDS = 1e-6
+
+
+class _RequestProfile:
+    def __init__(self):
+        self.id = f"{time.strftime('%Y%m%dT%H%M%S')}-{uuid.uuid4().hex[:8]}"
+        self.profiler = cProfile.Profile()
+        self.statements = []  # (duration in seconds, statement)
+        self.started = time.perf_counter()
+
+
+class RequestProfiler:
+
+    def __init__(self):
+        self._local = threading.local()
+
+    def init_app(self, app, db):
+        app.before_request(self._before_request)
+        app.after_request(self._after_request)
+        app.teardown_request(self._teardown_request)
+
+        with app.app_context():
+            for engine in db.engines.values():
+                event.listen(engine, "before_cursor_execute", self._before_cursor_execute)
+                event.listen(engine, "after_cursor_execute", self._after_cursor_execute)
+
+    def _should_profile(self):
+        config = current_app.config
+        if not config["PROFILING_ENABLED"]:
+            return False
+
+        header = request.headers.get(config["PROFILING_HEADER"])
+        if header is not None and (not config["PROFILING_HEADER_TOKEN"] or header == config["PROFILING_HEADER_TOKEN"]):
+            return True
+
+        return random.random() < config["PROFILING_SAMPLE_RATE"]
+
+    def _before_request(self):
+        if not self._should_profile():
+            return
+
+        profile = self._local.profile = _RequestProfile()
+        profile.profiler.enable()
+
+    def _after_request(self, response):
+        profile = getattr(self._local, "profile", None)
+        if profile is not None:
+            response.headers["X-Profile-Id"] = profile.id
+        return response
+
+    def _teardown_request(self, exc):
+        profile = getattr(self._local, "profile", None)
+        if profile is None:
+            return
+
+        profile.profiler.disable()
+        self._local.profile = None
+        self._write_profile(profile, current_app.config["PROFILING_OUTPUT_DIR"])
+
+    def _before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        if getattr(self._local, "profile", None) is not None:
+            conn.info.setdefault("profiling_started", []).append(time.perf_counter())
+
+    def _after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        profile = getattr(self._local, "profile", None)
+        if profile is not None and conn.info.get("profiling_started"):
+            profile.statements.append((time.perf_counter() - conn.info["profiling_started"].pop(), statement))
+
+    def _write_profile(self, profile, output_dir):
+        os.makedirs(output_dir, exist_ok=True)
+        path = os.path.join(output_dir, profile.id)
+        elapsed = time.perf_counter() - profile.started
+
+        with open(f"{path}.collapsed", "w") as collapsed_file:
+            for stack, microseconds in sorted(collapsed_stacks(pstats.Stats(profile.profiler).stats).items()):
+                collapsed_file.write(f"{stack} {microseconds}\n")
+
+        with open(f"{path}.sql.log", "w") as sql_file:
+            sql_file.write(f"# {request.method} {request.path} {elapsed * 1000:.3f} ms, "
+                           f"{len(profile.statements)} statements, "
+                           f"{sum(duration for duration, _ in profile.statements) * 1000:.3f} ms in SQL\n")
+            for duration, statement in profile.statements:
+                sql_file.write(f"{duration * 1000:.3f} ms\t{' '.join(statement.split())}\n")
+
+
+def collapsed_stacks(stats):
+    """
+    Collapsed stacks ("root;caller;function" -> microseconds) from cProfile stats.
+    cProfile only records caller -> callee edges, not whole stacks. So a function's own time is split across its call
+    paths in proportion to the cumulative time each caller spent in it. This estimate is exact for call trees, but
+    only approximate when a function is reached through several paths.
+    """
+    stacks = defaultdict(float)
+
+    def walk(function, path, seconds):
+        callers = {caller: edge[3] for caller, edge in stats[function][4].items()
+                   if caller in stats and caller not in path}
+        total = sum(callers.values())
+
+        if not callers or not total or len(path) >= MAX_STACK_DEPTH or seconds < MIN_PATH_SECONDS:
+            stacks[";".join(_frame_name(frame) for frame in reversed(path))] += seconds
+            return
+
+        for caller, caller_seconds in callers.items():
+            walk(caller, path + (caller,), seconds * caller_seconds / total)
+
+    for function, (_, _, own_seconds, _, _) in stats.items():
+        if own_seconds > 0:
+            walk(function, (function,), own_seconds)
+
+    return {stack: round(seconds * 1e6) for stack, seconds in stacks.items() if round(seconds * 1e6) > 0}
+
+
+def _frame_name(frame):
+    filename, line, function = frame
+    if filename == "~":  # built-in
+        return re.sub(r"[;\s]+", "_", function)
+    return f"{os.path.basename(filename)}:{function}:{line}"
+
+
+request_profiler = RequestProfiler()
@@ -1,29 +1,136 @@
 """
 API routes for the app
 """
-from flask import Blueprint, request
+from flask import Blueprint, Response, current_app, request
 
+from admission import admission_controller
+from event_archive import event_archive
+from handlers.access_change_handler import AccessChangeHandler
+from handlers.access_token_handler import AccessTokenHandler
 from handlers.stripe_webhook_handler import StripeWebhookHandler
 from handlers.user_access_handler import UserAccessHandler
+from handlers.webhook_queue_handler import WebhookQueueHandler
+from helpers import ResponseHelper
+from metrics import metrics
 
 api_bp = Blueprint('api', __name__)
 
 
 @api_bp.route("/stripe/webhook", methods=["POST"])
+@admission_controller.limit("webhook")
 def handle_stripe_webhook():
     """
     Stripe webhook endpoint
     Note: the stripe-signature header should be verified in production, but for this task I will skip that, since
     I am not using the actual Stripe API in any way.
+    In async mode the event is only validated and queued here, and processed later by the webhook workers.
     """
     event_data = request.json
+    event_archive.append(event_data, request.get_data())
+    if current_app.config["WEBHOOK_ASYNC_MODE"]:
+        return WebhookQueueHandler.enqueue_webhook_event(event_data)
+
     return StripeWebhookHandler.process_webhook_event(event_data)
 
 
+@api_bp.route("/stripe/webhook/batch", methods=["POST"])
+@admission_controller.limit("webhook")
+def handle_stripe_webhook_batch():
+    """
+    Batch Stripe webhook endpoint, accepts a list of events and processes them in a single transaction.
+    Meant for replaying backlogs of redelivered events, where a commit per event is the bottleneck.
+    """
+    events = request.json
+    if event_archive.enabled and isinstance(events, list):
+        for event_data in events:
+            event_archive.append(event_data)
+
+    return StripeWebhookHandler.process_webhook_events(events)
+
+
 @api_bp.route("/user/<int:user_id>/access", methods=["GET"])
+@admission_controller.limit("access")
 def get_user_access(user_id):
     """
     Get user access status
     """
 
-    return UserAccessHandler.get_user_access(user_id)
+    return UserAccessHandler.get_user_access(user_id, request.if_none_match, request.if_modified_since)
+
+
+@api_bp.route("/user/<int:user_id>/access/token", methods=["GET"])
+@admission_controller.limit("access")
+def get_user_access_token(user_id):
+    """
+    Get a short-lived signed access token, verifiable without calling this service (see access_tokens.py)
+    """
+    return AccessTokenHandler.issue_access_token(user_id)
+
+
+@api_bp.route("/access/revocations", methods=["GET"])
+@admission_controller.limit("access")
+def get_access_revocations():
+    """
+    Get access revocations after the `since` cursor, pulled incrementally by access token verifiers
+    """
+    since = request.args.get("since")
+    if since is not None:
+        try:
+            since = int(since)
+        except ValueError:
+            return ResponseHelper.error("Cursor must be an integer")
+
+    return AccessTokenHandler.get_revocations(since)
+
+
+@api_bp.route("/access/changes", methods=["GET"])
+def get_access_changes():
+    """
+    Server-sent event stream of access changes. Clients resume from the `cursor` query parameter or the
+    Last-Event-ID header, `follow=0` ends the stream once it has caught up.
+    """
+    cursor = request.args.get("cursor", request.headers.get("Last-Event-ID"))
+    if cursor is not None:
+        try:
+            cursor = int(cursor)
+        except ValueError:
+            return ResponseHelper.error("Cursor must be an integer")
+
+    follow = request.args.get("follow", "1") != "0"
+    return AccessChangeHandler.stream_changes(cursor, follow)
+
+
+@api_bp.route("/users/access", methods=["GET", "POST"])
+@admission_controller.limit("access")
+def get_users_access():
+    """
+    Get access status for many users in one call.
+    GET takes comma separated `user_ids` or `stripe_customer_ids` query parameters, POST takes the same keys as JSON
+    lists (better suited for a few thousand ids).
+    """
+    if request.method == "POST":
+        body = request.get_json(silent=True)
+        if not isinstance(body, dict):
+            return ResponseHelper.error("Invalid request body -- expected a JSON object")
+        return UserAccessHandler.get_users_access(body.get("user_ids"), body.get("stripe_customer_ids"))
+
+    user_ids = request.args.get("user_ids")
+    customer_ids = request.args.get("stripe_customer_ids")
+
+    if user_ids is not None:
+        try:
+            user_ids = [int(user_id) for user_id in user_ids.split(",") if user_id]
+        except ValueError:
+            return ResponseHelper.error("User ids must be integers")
+    if customer_ids is not None:
+        customer_ids = [customer_id for customer_id in customer_ids.split(",") if customer_id]
+
+    return UserAccessHandler.get_users_access(user_ids, customer_ids)
+
+
+@api_bp.route("/metrics", methods=["GET"])
+def get_metrics():
+    """
+    Metrics in the Prometheus text exposition format
+    """
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
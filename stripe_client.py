@@ -0,0 +1,289 @@
+"""
+Stripe API client for the app, used to fetch subscriptions the local Subscription table doesn't know yet.
+
+Invoices come in bursts, since most renewals happen at the start of a billing period. So a fetch must not add tail
+latency to the webhook, and a slow Stripe API must not take every worker thread with it:
+- connections are pooled and kept alive, so a fetch doesn't pay for a TCP and TLS handshake
+- fetched subscriptions are cached for STRIPE_SUBSCRIPTION_CACHE_TTL_SECONDS
+- concurrent fetches of the same subscription share one in-flight request
+- every request has a timeout. After STRIPE_CIRCUIT_FAILURE_THRESHOLD consecutive failures the circuit opens, and
+  fetches fail immediately for STRIPE_CIRCUIT_RESET_SECONDS. Then a single trial request decides if it closes again.
+"""
+import http.client
+import json
+import queue
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from urllib.parse import quote, urlsplit
+
+from metrics import metrics
+
+
+class StripeAPIError(Exception):
+    pass
+
+
+class CircuitBreaker:
+    """
+    Consecutive failure counter. Open means requests are rejected without being sent, until reset_seconds have passed
+    since the last failure. Then the circuit is half open, and a single trial request is let through.
+    """
+
+    def __init__(self, failure_threshold=5, reset_seconds=30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._opened_at = None
+        self._trial_in_flight = False
+
+    @property
+    def state(self):
+        if self._opened_at is None:
+            return "closed"
+        return "open" if time.monotonic() - self._opened_at < self.reset_seconds else "half_open"
+
+    def allow(self):
+        with self._lock:
+            if self._opened_at is None:
+                return True
+            if time.monotonic() - self._opened_at < self.reset_seconds or self._trial_in_flight:
+                return False
+            self._trial_in_flight = True
+            return True
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+            self._trial_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            self._trial_in_flight = False
+            if self._failures >= self.failure_threshold:
+                self._opened_at = time.monotonic()
+
+
+class _InFlightFetch:
+    __slots__ = ("done", "result", "error")
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class StripeClient:
+    """
+    Subscription fetcher, enabled by STRIPE_API_KEY. get_subscription returns the subscription as a dict, or None if
+    Stripe doesn't know it, and raises StripeAPIError if it couldn't be fetched.
+    """
+
+    MISS = object()
+
+    def __init__(self, api_key=None, base_url="https://api.stripe.com", timeout_seconds=2.0, pool_size=10,
+                 cache_ttl_seconds=60.0, cache_max_size=10000):
+        self.api_key = api_key
+        self.base_url = base_url
+        self.timeout_seconds = timeout_seconds
+        self.pool_size = pool_size
+        self.cache_ttl_seconds = cache_ttl_seconds
+        self.cache_max_size = cache_max_size
+        self.circuit_breaker = CircuitBreaker()
+        self._idle_connections = queue.LifoQueue()
+        self._connection_slots = threading.BoundedSemaphore(pool_size)
+        self._cache = OrderedDict()  # subscription id -> (subscription or None, expires_at)
+        self._in_flight = {}
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        self.close()
+        self.api_key = app.config["STRIPE_API_KEY"]
+        self.base_url = app.config["STRIPE_API_BASE_URL"]
+        self.timeout_seconds = app.config["STRIPE_API_TIMEOUT_SECONDS"]
+        self.pool_size = app.config["STRIPE_API_POOL_SIZE"]
+        self.cache_ttl_seconds = app.config["STRIPE_SUBSCRIPTION_CACHE_TTL_SECONDS"]
+        self._connection_slots = threading.BoundedSemaphore(self.pool_size)
+        self.circuit_breaker = CircuitBreaker(app.config["STRIPE_CIRCUIT_FAILURE_THRESHOLD"],
+                                              app.config["STRIPE_CIRCUIT_RESET_SECONDS"])
+
+    @property
+    def enabled(self):
+        return bool(self.api_key)
+
+    def get_subscription(self, subscription_id):
+        cached = self.cached_subscription(subscription_id)
+        if cached is not StripeClient.MISS:
+            return cached
+
+        with self._lock:
+            fetch = self._in_flight.get(subscription_id)
+            leader = fetch is None
+            if leader:
+                fetch = self._in_flight[subscription_id] = _InFlightFetch()
+
+        if leader:
+            try:
+                fetch.result = self._fetch_subscription(subscription_id)
+                self._cache_subscription(subscription_id, fetch.result)
+            except StripeAPIError as e:
+                fetch.error = e
+            finally:
+                with self._lock:
+                    del self._in_flight[subscription_id]
+                fetch.done.set()
+
+        elif not fetch.done.wait(self.timeout_seconds * 2):
+            raise StripeAPIError(f"Timed out waiting for the in-flight fetch of {subscription_id}")
+
+        if fetch.error is not None:
+            raise fetch.error
+        return fetch.result
+
+    def prefetch_subscriptions(self, subscription_ids):
+        """
+        Fetch subscriptions concurrently (up to the pool size) into the cache, ignoring failures
+        """
+        def prefetch(subscription_id):
+            try:
+                self.get_subscription(subscription_id)
+            except StripeAPIError:
+                pass
+
+        subscription_ids = list(subscription_ids)
+        if len(subscription_ids) == 1:
+            prefetch(subscription_ids[0])
+        elif subscription_ids:
+            with ThreadPoolExecutor(max_workers=min(self.pool_size, len(subscription_ids))) as executor:
+                list(executor.map(prefetch, subscription_ids))
+
+    def cached_subscription(self, subscription_id):
+        """
+        The cached subscription (None if Stripe didn't know it), or StripeClient.MISS. Never makes a request.
+        """
+        with self._lock:
+            entry = self._cache.get(subscription_id)
+            if entry is None:
+                return StripeClient.MISS
+
+            subscription, expires_at = entry
+            if expires_at <= time.monotonic():
+                del self._cache[subscription_id]
+                return StripeClient.MISS
+
+            self._cache.move_to_end(subscription_id)
+            return subscription
+
+    @staticmethod
+    def current_period_end(subscription):
+        """
+        The subscription's current period end as an aware datetime. Since API version 2025-03-31.basil it's set on
+        each subscription item instead of on the subscription, then the latest one is used.
+        """
+        if not subscription:
+            return None
+
+        timestamp = subscription.get("current_period_end")
+        if timestamp is None:
+            timestamp = max((item.get("current_period_end") or 0
+                             for item in subscription.get("items", {}).get("data", [])), default=0) or None
+
+        return datetime.fromtimestamp(timestamp, tz=timezone.utc) if timestamp else None
+
+    def close(self):
+        with self._lock:
+            self._cache.clear()
+        while True:
+            try:
+                self._idle_connections.get_nowait().close()
+            except queue.Empty:
+                return
+
+    def _cache_subscription(self, subscription_id, subscription):
+        with self._lock:
+            self._cache[subscription_id] = (subscription, time.monotonic() + self.cache_ttl_seconds)
+            self._cache.move_to_end(subscription_id)
+            while len(self._cache) > self.cache_max_size:
+                self._cache.popitem(last=False)
+
+    def _fetch_subscription(self, subscription_id):
+        if not self.circuit_breaker.allow():
+            metrics.stripe_api_requests.inc("circuit_open")
+            raise StripeAPIError("Stripe API circuit is open")
+
+        started = time.perf_counter()
+        try:
+            status, body = self._request("GET", f"/v1/subscriptions/{quote(subscription_id, safe='')}")
+        except StripeAPIError:
+            metrics.stripe_api_requests.inc("error")
+            self.circuit_breaker.record_failure()
+            raise
+        finally:
+            metrics.stripe_api_request_duration.observe(None, time.perf_counter() - started)
+
+        if status == 404:
+            metrics.stripe_api_requests.inc("not_found")
+            self.circuit_breaker.record_success()
+            return None
+
+        if status != 200:
+            metrics.stripe_api_requests.inc("error")
+            self.circuit_breaker.record_failure()
+            raise StripeAPIError(f"Stripe API returned {status} for subscription {subscription_id}")
+
+        metrics.stripe_api_requests.inc("ok")
+        self.circuit_breaker.record_success()
+        try:
+            return json.loads(body)
+        except ValueError as e:
+            raise StripeAPIError(f"Invalid Stripe API response for subscription {subscription_id}") from e
+
+    def _request(self, method, path):
+        """
+        Send a request on a pooled keep-alive connection and return (status, body). A reused connection the server
+        has closed in the meantime is retried once on a new one.
+        """
+        if not self._connection_slots.acquire(timeout=self.timeout_seconds):
+            raise StripeAPIError("No Stripe API connection available")
+
+        try:
+            for attempt in range(2):
+                connection, reused = self._checkout_connection()
+                try:
+                    connection.request(method, path, headers={"Authorization": f"Bearer {self.api_key}"})
+                    response = connection.getresponse()
+                    body = response.read()
+                except (http.client.RemoteDisconnected, BrokenPipeError, ConnectionResetError) as e:
+                    connection.close()
+                    if reused and attempt == 0:
+                        continue
+                    raise StripeAPIError(f"Stripe API request failed: {e}") from e
+                except (OSError, http.client.HTTPException) as e:
+                    connection.close()
+                    raise StripeAPIError(f"Stripe API request failed: {e}") from e
+
+                if response.will_close:
+                    connection.close()
+                else:
+                    self._idle_connections.put(connection)
+                return response.status, body
+        finally:
+            self._connection_slots.release()
+
+    def _checkout_connection(self):
+        try:
+            return self._idle_connections.get_nowait(), True
+        except queue.Empty:
+            pass
+
+        url = urlsplit(self.base_url)
+        connection_class = http.client.HTTPSConnection if url.scheme == "https" else http.client.HTTPConnection
+        return connection_class(url.hostname, url.port, timeout=self.timeout_seconds), False
+
+
+stripe_client = StripeClient()
@@ -1,17 +1,22 @@
 import json
+from concurrent.futures import ThreadPoolExecutor
 from datetime import *
 
 import pytest
 
 from app import app, db
+from cache import access_cache, processed_event_filter
+from helpers import DateTimeNaiveHelper
+from handlers.stripe_webhook_handler import StripeWebhookHandler
 from models import User
 
 
-def create_subscription_event(event_id, event_type, customer_id, status="active", current_period_end=None):
+def create_subscription_event(event_id, event_type, customer_id, status="active", current_period_end=None,
+                              subscription_id=None, created=None):
     if current_period_end is None:
         current_period_end = int((datetime.now(timezone.utc) + timedelta(days=30)).timestamp())
 
-    return json.dumps({
+    event = {
         "id": event_id,
         "type": event_type,
         "data": {
@@ -21,11 +26,17 @@ def create_subscription_event(event_id, event_type, customer_id, status="active"
                 "current_period_end": current_period_end
             }
         }
-    })
+    }
+    if subscription_id:
+        event["data"]["object"]["id"] = subscription_id
+    if created:
+        event["created"] = created
 
+    return json.dumps(event)
 
-def create_bare_event(event_id, event_type, customer_id):
-    return json.dumps({
+
+def create_bare_event(event_id, event_type, customer_id, created=None):
+    event = {
         "id": event_id,
         "type": event_type,
         "data": {
@@ -33,7 +44,11 @@ def create_bare_event(event_id, event_type, customer_id):
                 "customer": customer_id
             }
         }
-    })
+    }
+    if created:
+        event["created"] = created
+
+    return json.dumps(event)
 
 
 def create_invoice_event(event_id, event_type, customer_id, subscription_id=None):
@@ -69,16 +84,45 @@ def get_30_days_later():
     return int((get_current_utc() + timedelta(days=30)).timestamp())
 
 
+def post_webhook(client, event):
+    """Post a webhook event and return the response"""
+    return client.post("/stripe/webhook", data=event, content_type='application/json')
+
+
+def post_event(client, event):
+    """Post a webhook event and return the id of the user it was applied to"""
+    return int(post_webhook(client, event).json["message"].split("user id ")[1])
+
+
+def access_until(customer_id="cus_123"):
+    """Timezone aware access_until of the customer's user"""
+    user = User.query.filter_by(stripe_customer_id=customer_id).one()
+    return DateTimeNaiveHelper.make_timezone_aware(user.access_until)
+
+
+def post_concurrently(client, events):
+    """Post webhook events from concurrent threads, each with its own test client"""
+    def post(event):
+        return client.application.test_client().post("/stripe/webhook", data=event,
+                                                     content_type='application/json')
+
+    with ThreadPoolExecutor(len(events)) as executor:
+        return list(executor.map(post, events))
+
+
 @pytest.fixture
 def client():
     """
     Create the test client for the app.
     """
     app.config['TESTING'] = True
+    access_cache.clear()
+    processed_event_filter.clear()
 
     with app.test_client() as client:
         with app.app_context():
             db.create_all()
+            processed_event_filter.load(StripeWebhookHandler.load_processed_event_ids())
             yield client
             db.session.remove()
             db.drop_all()
@@ -0,0 +1,124 @@
+"""
+Local stand-in for the Stripe subscriptions API, so tests and benchmarks run offline.
+
+Serves GET /v1/subscriptions/<id> over HTTP/1.1 keep-alive, in the shape of API version 2025-03-31.basil and later
+(the period end is set on the subscription items). Latency and failures can be injected, and requests and
+connections are counted.
+
+Usage: python -m tests.fake_stripe [--port 12111] [--latency-ms 50]
+Subscriptions sub_<n> are generated on the fly when run standalone.
+"""
+import argparse
+import json
+import threading
+import time
+from datetime import datetime, timezone, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+SUBSCRIPTIONS_PATH = "/v1/subscriptions/"
+
+
+class FakeStripeServer:
+
+    def __init__(self, latency_seconds=0.0, generate_subscriptions=False):
+        self.latency_seconds = latency_seconds
+        self.generate_subscriptions = generate_subscriptions
+        self.fail_with_status = None  # e.g. 500, answered to every request while set
+        self.subscriptions = {}
+        self.requests = 0
+        self.connections = 0
+        self._lock = threading.Lock()
+        self._server = None
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def add_subscription(self, subscription_id, customer_id, current_period_end, status="active"):
+        self.subscriptions[subscription_id] = {
+            "id": subscription_id,
+            "object": "subscription",
+            "customer": customer_id,
+            "status": status,
+            "items": {"object": "list", "data": [
+                {"id": f"si_{subscription_id}", "object": "subscription_item",
+                 "current_period_end": current_period_end},
+            ]},
+        }
+
+    def start(self, port=0):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def setup(self):
+                super().setup()
+                with server._lock:
+                    server.connections += 1
+
+            def do_GET(self):
+                with server._lock:
+                    server.requests += 1
+                if server.latency_seconds:
+                    time.sleep(server.latency_seconds)
+
+                if server.fail_with_status:
+                    return self._respond(server.fail_with_status, {"error": {"message": "Injected failure"}})
+                if not self.headers.get("Authorization", "").startswith("Bearer "):
+                    return self._respond(401, {"error": {"message": "Invalid API key"}})
+                if not self.path.startswith(SUBSCRIPTIONS_PATH):
+                    return self._respond(404, {"error": {"message": "Unrecognized request URL"}})
+
+                subscription = server._get_subscription(self.path[len(SUBSCRIPTIONS_PATH):])
+                if subscription is None:
+                    return self._respond(404, {"error": {"message": "No such subscription"}})
+                self._respond(200, subscription)
+
+            def _respond(self, status, body):
+                data = json.dumps(body).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, *args):
+                pass
+
+        self._server = ThreadingHTTPServer(("127.0.0.1", port), Handler)
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, args=(0.05,), daemon=True)
+        self._thread.start()
+        return self.url
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
+
+    def _get_subscription(self, subscription_id):
+        if subscription_id not in self.subscriptions and self.generate_subscriptions:
+            period_end = int((datetime.now(timezone.utc) + timedelta(days=30)).timestamp())
+            self.add_subscription(subscription_id, f"cus_{subscription_id}", period_end)
+        return self.subscriptions.get(subscription_id)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--port", type=int, default=12111)
+    parser.add_argument("--latency-ms", type=float, default=0)
+    args = parser.parse_args()
+
+    server = FakeStripeServer(args.latency_ms / 1000, generate_subscriptions=True)
+    print(f"Fake Stripe API on {server.start(args.port)}, set STRIPE_API_BASE_URL to it")
+    try:
+        server._thread.join()
+    except KeyboardInterrupt:
+        server.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,82 @@
+from unittest.mock import patch
+
+from tests.conftest import *
+from cache import AccessCache, AccessState
+
+
+class TestAccessCache:
+    def test_lru_eviction(self):
+        cache = AccessCache(max_size=2, ttl_seconds=60)
+        cache.set(1, None, cache.generation())
+        cache.set(2, None, cache.generation())
+        cache.get(1)  # 1 is now the most recently used entry
+        cache.set(3, None, cache.generation())
+
+        assert cache.get(2) is AccessCache.MISS
+        assert cache.get(1) is None
+        assert cache.stats()["evictions"] == 1
+
+    def test_ttl_expiry(self):
+        cache = AccessCache(max_size=10, ttl_seconds=0)
+        cache.set(1, None, cache.generation())
+
+        assert cache.get(1) is AccessCache.MISS
+        assert cache.stats()["evictions"] == 1
+
+    def test_set_dropped_after_invalidation(self):
+        cache = AccessCache(max_size=10, ttl_seconds=60)
+        generation = cache.generation()
+        cache.invalidate(1)  # a webhook committed while the value was being loaded
+        cache.set(1, None, generation)
+
+        assert cache.get(1) is AccessCache.MISS
+
+    def test_access_endpoint_hits_cache(self, client):
+        user_id = create_user(client, get_current_utc() + timedelta(days=10))
+
+        client.get(f"/user/{user_id}/access")
+        with patch('handlers.user_access_handler.db.session.get') as mock_get:
+            response = client.get(f"/user/{user_id}/access")
+            mock_get.assert_not_called()
+
+        assert response.json["has_access"]
+        assert access_cache.stats()["hits"] == 1
+        assert access_cache.stats()["misses"] == 1
+
+    def test_has_access_recomputed_on_hit(self, client):
+        user_id = create_user(client, get_current_utc() + timedelta(days=10))
+        client.get(f"/user/{user_id}/access")
+
+        # simulate the cached timestamp passing without the entry being touched
+        access_cache.invalidate()
+        access_cache.set(user_id, AccessState(datetime.utcnow() - timedelta(seconds=1), 0, None),
+                         access_cache.generation())
+
+        response = client.get(f"/user/{user_id}/access")
+        assert not response.json["has_access"]
+
+    def test_webhook_commit_invalidates_entry(self, client):
+        event = create_subscription_event("evt_123", "customer.subscription.created", "cus_123")
+        response = client.post("/stripe/webhook", data=event, content_type='application/json')
+        user_id = int(response.json["message"].split("user id ")[1])
+
+        assert client.get(f"/user/{user_id}/access").json["has_access"]
+
+        delete_event = create_bare_event("evt_124", "customer.subscription.deleted", "cus_123")
+        client.post("/stripe/webhook", data=delete_event, content_type='application/json')
+
+        assert not client.get(f"/user/{user_id}/access").json["has_access"]
+        assert access_cache.stats()["invalidations"] == 1
+
+    def test_failed_commit_keeps_entry(self, client):
+        user_id = create_user(client, get_current_utc() + timedelta(days=10))
+        client.get(f"/user/{user_id}/access")
+
+        delete_event = create_bare_event("evt_124", "customer.subscription.deleted", "cus_123")
+        with patch('app.db.session.commit') as mock_commit:
+            mock_commit.side_effect = Exception("Database error")
+            response = client.post("/stripe/webhook", data=delete_event, content_type='application/json')
+
+        assert response.status_code == 500
+        assert access_cache.stats()["invalidations"] == 0
+        assert client.get(f"/user/{user_id}/access").json["has_access"]
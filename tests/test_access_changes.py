@@ -0,0 +1,118 @@
+from tests.conftest import *
+import threading
+import time
+
+from handlers.access_change_handler import AccessChangeHandler
+from models import AccessChange
+
+
+def parse_events(body):
+    events = []
+    for block in body.strip().split("\n\n"):
+        fields = dict(line.split(": ", 1) for line in block.split("\n") if not line.startswith(":"))
+        if "data" in fields:
+            events.append((int(fields["id"]), json.loads(fields["data"])))
+    return events
+
+
+class TestAccessChanges:
+    def test_changes_are_logged(self, client):
+        user_id = post_event(client, create_subscription_event("evt_123", "customer.subscription.created",
+                                                               "cus_123"))
+        post_event(client, create_invoice_event("evt_124", "invoice.paid", "cus_123"))  # no subscription, no change
+        post_event(client, create_bare_event("evt_125", "customer.subscription.deleted", "cus_123"))
+
+        response = client.get("/access/changes?cursor=0&follow=0")
+        assert response.status_code == 200
+        assert response.mimetype == "text/event-stream"
+
+        events = parse_events(response.get_data(as_text=True))
+        assert [(change["user_id"], change["version"]) for _, change in events] == [(user_id, 1), (user_id, 2)]
+        assert events[0][0] < events[1][0]
+        assert events[1][1]["access_until"] == db.session.get(User, user_id).access_until.isoformat()
+
+    def test_batch_changes_are_logged(self, client):
+        events = [json.loads(create_subscription_event(f"evt_{index}", "customer.subscription.created",
+                                                       f"cus_{index}")) for index in range(3)]
+        client.post("/stripe/webhook/batch", json=events)
+
+        assert AccessChange.query.count() == 3
+
+    def test_resume_from_cursor(self, client):
+        for index in range(3):
+            post_event(client, create_subscription_event(f"evt_{index}", "customer.subscription.created",
+                                                         f"cus_{index}"))
+        events = parse_events(client.get("/access/changes?cursor=0&follow=0").get_data(as_text=True))
+
+        resumed = parse_events(client.get(f"/access/changes?cursor={events[0][0]}&follow=0").get_data(as_text=True))
+        assert resumed == events[1:]
+
+        resumed = parse_events(client.get("/access/changes?follow=0",
+                                          headers={"Last-Event-ID": str(events[1][0])}).get_data(as_text=True))
+        assert resumed == events[2:]
+
+    def test_paging(self, client, monkeypatch):
+        monkeypatch.setitem(client.application.config, "ACCESS_CHANGES_PAGE_SIZE", 2)
+        for index in range(5):
+            post_event(client, create_subscription_event(f"evt_{index}", "customer.subscription.created",
+                                                         f"cus_{index}"))
+
+        assert len(parse_events(client.get("/access/changes?cursor=0&follow=0").get_data(as_text=True))) == 5
+
+    def test_without_cursor_starts_at_end(self, client):
+        post_event(client, create_subscription_event("evt_123", "customer.subscription.created", "cus_123"))
+
+        assert parse_events(client.get("/access/changes?follow=0").get_data(as_text=True)) == []
+
+    def test_invalid_cursor(self, client):
+        assert client.get("/access/changes?cursor=abc").status_code == 400
+
+    def test_live_change_is_pushed(self, client, monkeypatch):
+        monkeypatch.setitem(client.application.config, "ACCESS_CHANGES_POLL_INTERVAL_SECONDS", 5)
+        response = client.get("/access/changes", buffered=False)
+        chunks = iter(response.response)
+        assert next(chunks).startswith(b"retry:")
+
+        def post_later():
+            time.sleep(0.1)
+            post_event(client.application.test_client(),
+                       create_subscription_event("evt_123", "customer.subscription.created", "cus_123"))
+
+        poster = threading.Thread(target=post_later)
+        poster.start()
+        started = time.monotonic()
+        chunk = next(chunks)
+        poster.join()
+        response.close()
+
+        # woken up by the commit, not by the next poll
+        assert time.monotonic() - started < 2
+        assert parse_events(chunk.decode())[0][1]["version"] == 1
+
+    def test_change_committed_late_is_not_skipped(self, client):
+        # seq 2 is taken by a transaction that commits after seq 3
+        db.session.add_all([AccessChange(seq=1, user_id=1, version=1), AccessChange(seq=3, user_id=3, version=1)])
+        db.session.commit()
+        events = AccessChangeHandler._generate_events(0, True, 1000, 0.01, 15, 1000)
+        next(events)
+
+        streamed = [parse_events(next(events)) for _ in range(2)]
+        assert streamed == [[(1, {"user_id": 1, "access_until": None, "version": 1})],
+                            [(1, {"user_id": 3, "access_until": None, "version": 1})]]
+
+        db.session.add(AccessChange(seq=2, user_id=2, version=1))
+        db.session.commit()
+        assert parse_events(next(events)) == [(3, {"user_id": 2, "access_until": None, "version": 1})]
+        events.close()
+
+        # a client that reconnected with the id of seq 3 still gets seq 2
+        resumed = parse_events(client.get("/access/changes?cursor=1&follow=0").get_data(as_text=True))
+        assert [change["user_id"] for _, change in resumed] == [2, 3]
+
+    def test_rolled_back_seq_is_given_up(self, client):
+        db.session.add_all([AccessChange(seq=1, user_id=1, version=1), AccessChange(seq=3, user_id=3, version=1),
+                            AccessChange(seq=4, user_id=4, version=1)])
+        db.session.commit()
+
+        events = parse_events("".join(AccessChangeHandler._generate_events(0, False, 1000, 0.01, 15, 2)))
+        assert [event_id for event_id, _ in events] == [1, 1, 4]
@@ -0,0 +1,63 @@
+from tests.conftest import *
+from werkzeug.http import http_date
+
+
+class TestAccessHttpCaching:
+    def test_caching_headers(self, client):
+        user_id = post_event(client, create_subscription_event("evt_123", "customer.subscription.created",
+                                                               "cus_123"))
+
+        response = client.get(f"/user/{user_id}/access")
+        assert response.status_code == 200
+        assert response.headers["ETag"] == '"v1-1"'
+        assert response.headers["Cache-Control"] == "public, max-age=60"
+        assert "Expires" in response.headers
+        assert "Last-Modified" in response.headers
+
+    def test_max_age_capped_by_expiry(self, client):
+        user_id = create_user(client, get_current_utc() + timedelta(seconds=10))
+
+        response = client.get(f"/user/{user_id}/access")
+        assert response.cache_control.max_age <= 10
+
+    def test_if_none_match_returns_304_without_body(self, client):
+        user_id = create_user(client, get_current_utc() + timedelta(days=10))
+        etag = client.get(f"/user/{user_id}/access").headers["ETag"]
+
+        response = client.get(f"/user/{user_id}/access", headers={"If-None-Match": etag})
+        assert response.status_code == 304
+        assert response.data == b""
+        assert response.headers["ETag"] == etag
+
+        response = client.get(f"/user/{user_id}/access", headers={"If-None-Match": f"W/{etag}"})
+        assert response.status_code == 304
+
+    def test_webhook_change_invalidates_etag(self, client):
+        user_id = post_event(client, create_subscription_event("evt_123", "customer.subscription.created",
+                                                               "cus_123"))
+        etag = client.get(f"/user/{user_id}/access").headers["ETag"]
+
+        post_event(client, create_bare_event("evt_124", "customer.subscription.deleted", "cus_123"))
+
+        response = client.get(f"/user/{user_id}/access", headers={"If-None-Match": etag})
+        assert response.status_code == 200
+        assert response.headers["ETag"] == '"v2-0"'
+        assert not response.json["has_access"]
+
+    def test_unchanged_access_keeps_version(self, client):
+        user_id = post_event(client, create_subscription_event("evt_123", "customer.subscription.created",
+                                                               "cus_123"))
+        post_event(client, create_invoice_event("evt_124", "invoice.paid", "cus_123"))  # no subscription, no change
+
+        assert db.session.get(User, user_id).version == 1
+
+    def test_expired_access_last_modified(self, client):
+        expired_at = get_current_utc() - timedelta(hours=1)
+        user_id = create_user(client, expired_at)
+
+        response = client.get(f"/user/{user_id}/access")
+        assert response.headers["Last-Modified"] == http_date(expired_at)
+        assert response.headers["ETag"] == '"v0-0"'
+
+        response = client.get(f"/user/{user_id}/access", headers={"If-Modified-Since": http_date(get_current_utc())})
+        assert response.status_code == 304
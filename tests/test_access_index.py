@@ -0,0 +1,176 @@
+from unittest.mock import patch
+
+from tests.conftest import *
+import fcntl
+import os
+import tempfile
+
+from sqlalchemy import update
+
+from access_index import AccessIndex, access_index, HEADER, SLOT, COUNTER
+from cache import AccessCache
+from handlers.access_index_handler import AccessIndexHandler
+
+
+@pytest.fixture
+def index_client(client, tmp_path):
+    access_index.open(str(tmp_path / "access-index"), 1024)
+    yield client
+    access_index.close()
+
+
+class TestAccessIndex:
+    def test_built_from_users_on_first_use(self, index_client):
+        user_id = create_user(index_client, get_current_utc() + timedelta(days=1))
+        assert access_index.synced_seq() == -1
+
+        response = index_client.get(f"/user/{user_id}/access")
+        assert response.json["has_access"]
+        assert access_index.synced_seq() == 0
+        assert access_index.get(user_id).access_until == db.session.get(User, user_id).access_until
+
+    def test_served_without_database(self, index_client):
+        user_id = create_user(index_client, get_current_utc() + timedelta(days=1))
+        index_client.get(f"/user/{user_id}/access")
+
+        # a change the index doesn't know about isn't seen, so the response came from the index
+        db.session.execute(update(User).values(access_until=None))
+        db.session.commit()
+        access_cache.clear()
+        assert index_client.get(f"/user/{user_id}/access").json["has_access"]
+
+    def test_webhook_commit_updates_index(self, index_client):
+        user_id = post_event(index_client, create_subscription_event("evt_123", "customer.subscription.created",
+                                                                     "cus_123"))
+        index_client.get(f"/user/{user_id}/access")
+        post_event(index_client, create_bare_event("evt_124", "customer.subscription.deleted", "cus_123"))
+
+        state = access_index.get(user_id)
+        user = db.session.get(User, user_id)
+        assert (state.access_until, state.version, state.updated_at) == (user.access_until, 2, user.updated_at)
+        assert not index_client.get(f"/user/{user_id}/access").json["has_access"]
+
+    def test_body_matches_database_path(self, index_client):
+        user_id = post_event(index_client, create_subscription_event("evt_123", "customer.subscription.created",
+                                                                     "cus_123"))
+        from_index = index_client.get(f"/user/{user_id}/access")
+
+        access_index.close()
+        access_cache.clear()
+        from_database = index_client.get(f"/user/{user_id}/access")
+
+        assert from_index.data == from_database.data
+        assert from_index.headers["ETag"] == from_database.headers["ETag"]
+        assert from_index.headers["Last-Modified"] == from_database.headers["Last-Modified"]
+
+    def test_shared_between_processes(self, index_client, tmp_path):
+        other_process = AccessIndex()
+        other_process.open(str(tmp_path / "access-index"), 1024)
+        try:
+            user_id = post_event(index_client, create_subscription_event(
+                "evt_123", "customer.subscription.created", "cus_123"))
+            index_client.get(f"/user/{user_id}/access")
+
+            assert other_process.get(user_id).version == 1
+        finally:
+            other_process.close()
+
+    def test_forked_process_reopens_the_file(self, index_client):
+        locked_read, locked_write = os.pipe()
+        done_read, done_write = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            with access_index._write_lock():
+                os.write(locked_write, b"x")
+                os.read(done_read, 1)
+            os._exit(0)
+
+        try:
+            os.read(locked_read, 1)
+            # the child locked its own open file description, so its flock excludes this process
+            with pytest.raises(BlockingIOError):
+                fcntl.flock(access_index._file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        finally:
+            os.write(done_write, b"x")
+            os.waitpid(pid, 0)
+            for fd in (locked_read, locked_write, done_read, done_write):
+                os.close(fd)
+
+    def test_default_path_per_database(self, client):
+        app = client.application
+        path = AccessIndex.default_path(app)
+        assert path.startswith(tempfile.gettempdir())
+        assert path == AccessIndex.default_path(app)
+
+        with patch.dict(app.config, {"SQLALCHEMY_DATABASE_URI": "sqlite:///other.db"}):
+            assert AccessIndex.default_path(app) != path
+
+    def test_webhook_commit_writes_only_its_users(self, index_client):
+        user_id = post_event(index_client, create_subscription_event("evt_123", "customer.subscription.created",
+                                                                     "cus_123"))
+        index_client.get(f"/user/{user_id}/access")
+        synced_seq = access_index.synced_seq()
+        counter = COUNTER.unpack_from(access_index._map, HEADER.size + user_id * SLOT.size)[0]
+
+        post_event(index_client, create_subscription_event("evt_124", "customer.subscription.created", "cus_124"))
+
+        # the new user is written, the change log is left to the periodic sync
+        assert access_index.get(user_id + 1).version == 1
+        assert access_index.synced_seq() == synced_seq
+        assert COUNTER.unpack_from(access_index._map, HEADER.size + user_id * SLOT.size)[0] == counter
+
+        # and the sync doesn't rewrite slots that already have a change's version
+        AccessIndexHandler.sync_access_index()
+        assert access_index.synced_seq() > synced_seq
+        assert COUNTER.unpack_from(access_index._map, HEADER.size + user_id * SLOT.size)[0] == counter
+
+    def test_writer_killed_mid_write(self, index_client):
+        user_id = post_event(index_client, create_subscription_event("evt_123", "customer.subscription.created",
+                                                                     "cus_123"))
+        index_client.get(f"/user/{user_id}/access")
+        offset = HEADER.size + user_id * SLOT.size
+        COUNTER.pack_into(access_index._map, offset, COUNTER.unpack_from(access_index._map, offset)[0] + 1)
+
+        # a miss instead of spinning forever, served from the database
+        assert access_index.get(user_id) is AccessCache.MISS
+        assert index_client.get(f"/user/{user_id}/access").json["has_access"]
+
+        # the next write repairs the slot
+        post_event(index_client, create_bare_event("evt_124", "customer.subscription.deleted", "cus_123"))
+        assert access_index.get(user_id).version == 2
+
+    def test_never_goes_back_to_older_version(self, index_client):
+        user_id = post_event(index_client, create_subscription_event("evt_123", "customer.subscription.created",
+                                                                     "cus_123"))
+        post_event(index_client, create_bare_event("evt_124", "customer.subscription.deleted", "cus_123"))
+        AccessIndexHandler.get_access_state(user_id)
+
+        access_index.sync(lambda after_seq: [(1, user_id, None, 1, None)], overlap=0)
+        assert access_index.get(user_id).version == 2
+
+    def test_ids_above_capacity_fall_back(self, index_client):
+        user = User(id=5000, stripe_customer_id="cus_big", access_until=get_current_utc() + timedelta(days=1))
+        db.session.add(user)
+        db.session.commit()
+
+        assert access_index.get(5000) is AccessCache.MISS
+        assert index_client.get("/user/5000/access").json["has_access"]
+
+    def test_recreated_on_capacity_change(self, index_client, tmp_path):
+        user_id = create_user(index_client, get_current_utc() + timedelta(days=1))
+        AccessIndexHandler.rebuild_access_index()
+
+        resized = AccessIndex()
+        resized.open(str(tmp_path / "access-index"), 2048)
+        try:
+            assert resized.synced_seq() == -1
+            assert resized.get(user_id) is AccessCache.MISS
+        finally:
+            resized.close()
+
+    def test_rebuild_command(self, index_client):
+        user_id = create_user(index_client, get_current_utc() + timedelta(days=1))
+
+        result = index_client.application.test_cli_runner().invoke(args=["rebuild-access-index"])
+        assert result.exit_code == 0, result.output
+        assert access_index.get(user_id) is not AccessCache.MISS
@@ -0,0 +1,187 @@
+from unittest.mock import patch
+
+from tests.conftest import *
+import io
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from access_tokens import AccessClaims, AccessTokenVerifier, AccessTokenError, decode_access_token, encode_access_token
+from models import AccessRevocation
+
+SECRET = "test-secret"
+
+
+@pytest.fixture
+def token_client(client, monkeypatch):
+    monkeypatch.setitem(client.application.config, "ACCESS_TOKEN_SECRET", SECRET)
+    return client
+
+
+class TestAccessTokens:
+    def test_issue_token(self, token_client):
+        user_id = post_event(token_client, create_subscription_event(
+            "evt_123", "customer.subscription.created", "cus_123", current_period_end=get_30_days_later()))
+
+        response = token_client.get(f"/user/{user_id}/access/token")
+        assert response.status_code == 200
+
+        claims = decode_access_token(SECRET, response.json["token"])
+        assert claims.user_id == user_id
+        assert claims.access_until == get_30_days_later()
+        assert claims.revocation_version == 0
+        assert claims.expires_at == response.json["expires_at"]
+        assert AccessTokenVerifier(SECRET).has_access(response.json["token"])
+
+    def test_not_configured(self, client, monkeypatch):
+        monkeypatch.setitem(client.application.config, "ACCESS_TOKEN_SECRET", None)
+        user_id = create_user(client, get_current_utc() + timedelta(days=1))
+
+        assert client.get(f"/user/{user_id}/access/token").status_code == 503
+
+    def test_user_not_found(self, token_client):
+        assert token_client.get("/user/999/access/token").status_code == 404
+
+    def test_no_access(self, token_client):
+        user_id = create_user(token_client, get_current_utc() - timedelta(days=1))
+        token = token_client.get(f"/user/{user_id}/access/token").json["token"]
+
+        assert not AccessTokenVerifier(SECRET).has_access(token)
+
+    def test_tampered_and_expired_tokens(self, token_client):
+        user_id = create_user(token_client, get_current_utc() + timedelta(days=1))
+        token = token_client.get(f"/user/{user_id}/access/token").json["token"]
+        verifier = AccessTokenVerifier(SECRET)
+
+        with pytest.raises(AccessTokenError, match="signature"):
+            AccessTokenVerifier("other-secret").verify(token)
+        with pytest.raises(AccessTokenError, match="Malformed"):
+            verifier.verify("not-a-token")
+        with pytest.raises(AccessTokenError, match="expired"):
+            verifier.verify(token, now=time.time() + 3600)
+
+
+class TestAccessRevocations:
+    def test_revocations_bump_version(self, token_client):
+        user_id = post_event(token_client, create_subscription_event("evt_123", "customer.subscription.created",
+                                                                     "cus_123"))
+        post_event(token_client, create_invoice_event("evt_124", "invoice.payment_failed", "cus_123"))
+        post_event(token_client, create_bare_event("evt_125", "customer.subscription.deleted", "cus_123"))
+
+        assert db.session.get(User, user_id).revocation_version == 2
+
+        body = token_client.get("/access/revocations").json
+        assert body["revocations"] == [
+            {"id": 1, "user_id": user_id, "revocation_version": 1},
+            {"id": 2, "user_id": user_id, "revocation_version": 2},
+        ]
+        assert not body["has_more"]
+
+        body = token_client.get(f"/access/revocations?since={body['cursor']}").json
+        assert body["revocations"] == []
+
+    def test_revoked_token_rejected(self, token_client):
+        user_id = post_event(token_client, create_subscription_event("evt_123", "customer.subscription.created",
+                                                                     "cus_123"))
+        token = token_client.get(f"/user/{user_id}/access/token").json["token"]
+
+        verifier = AccessTokenVerifier(SECRET)
+        verifier.apply_revocations(token_client.get("/access/revocations").json)
+        assert verifier.has_access(token)
+
+        post_event(token_client, create_bare_event("evt_124", "customer.subscription.deleted", "cus_123"))
+        verifier.apply_revocations(
+            token_client.get(f"/access/revocations?since={verifier.cursor}").json, verifier.cursor)
+
+        with pytest.raises(AccessTokenError, match="revoked"):
+            verifier.verify(token)
+
+        # a token issued after the revocation verifies again, but reports no access
+        token = token_client.get(f"/user/{user_id}/access/token").json["token"]
+        assert verifier.verify(token).revocation_version == 1
+        assert not verifier.has_access(token)
+
+    def test_paging(self, token_client, monkeypatch):
+        monkeypatch.setitem(token_client.application.config, "ACCESS_REVOCATIONS_PAGE_SIZE", 2)
+        for index in range(3):
+            post_event(token_client, create_bare_event(f"evt_{index}", "customer.subscription.deleted",
+                                                       f"cus_{index}"))
+
+        first = token_client.get("/access/revocations?since=0").json
+        assert len(first["revocations"]) == 2 and first["has_more"]
+
+        second = token_client.get(f"/access/revocations?since={first['cursor']}").json
+        assert len(second["revocations"]) == 1 and not second["has_more"]
+
+    def test_revocation_committed_late_is_pulled(self, token_client, monkeypatch):
+        monkeypatch.setitem(token_client.application.config, "ACCESS_REVOCATIONS_PAGE_SIZE", 1)
+        verifier = AccessTokenVerifier(SECRET, revocations_url="http://verifier.test/access/revocations")
+
+        def urlopen(url, timeout):
+            return io.BytesIO(token_client.get(url.removeprefix("http://verifier.test")).data)
+
+        db.session.add_all([AccessRevocation(id=1, user_id=1, revocation_version=1),
+                            AccessRevocation(id=3, user_id=3, revocation_version=1)])
+        db.session.commit()
+        with patch("access_tokens.urllib.request.urlopen", side_effect=urlopen):
+            verifier.refresh()
+            assert verifier.cursor == 1
+
+            # id 2 was assigned before id 3, but committed after id 3 was pulled
+            db.session.add(AccessRevocation(id=2, user_id=2, revocation_version=1))
+            db.session.commit()
+            verifier.refresh()
+            assert verifier.cursor == 3
+
+        now = int(time.time())
+        token = encode_access_token(SECRET, AccessClaims(2, now + 3600, 0, now, now + 60))
+        with pytest.raises(AccessTokenError, match="revoked"):
+            verifier.verify(token)
+
+    def test_skipped_ids_are_given_up_after_the_overlap(self, token_client):
+        db.session.add_all([AccessRevocation(id=id_, user_id=id_, revocation_version=1) for id_ in (1, 3)])
+        db.session.commit()
+        verifier = AccessTokenVerifier(SECRET, overlap=2)
+        verifier.apply_revocations(token_client.get("/access/revocations?since=0").json, 0)
+        assert verifier.cursor == 1
+
+        # id 2 was rolled back and never commits
+        db.session.add_all([AccessRevocation(id=id_, user_id=id_, revocation_version=1) for id_ in (4, 5)])
+        db.session.commit()
+        since = verifier.cursor
+        verifier.apply_revocations(token_client.get(f"/access/revocations?since={since}").json, since)
+        assert verifier.cursor == 5
+
+    def test_malformed_revocations_keep_the_old_list(self, token_client):
+        user_id = create_user(token_client, get_current_utc() + timedelta(days=1))
+        token = token_client.get(f"/user/{user_id}/access/token").json["token"]
+        verifier = AccessTokenVerifier(SECRET, revocations_url="http://verifier.test/access/revocations")
+
+        for body in (b"<html>Bad gateway</html>", b'{"revocations": [', b'{"has_more": false}', b"[]"):
+            verifier._refreshed_at = None
+            with patch("access_tokens.urllib.request.urlopen", return_value=io.BytesIO(body)):
+                assert verifier.has_access(token)
+
+    def test_one_thread_refreshes(self, token_client):
+        user_id = create_user(token_client, get_current_utc() + timedelta(days=1))
+        token = token_client.get(f"/user/{user_id}/access/token").json["token"]
+        verifier = AccessTokenVerifier(SECRET, revocations_url="http://verifier.test/access/revocations")
+        fetches = []
+        release = threading.Event()
+
+        def urlopen(url, timeout):
+            fetches.append(url)
+            release.wait(5)
+            return io.BytesIO(b'{"revocations": [], "cursor": 0, "has_more": false}')
+
+        with patch("access_tokens.urllib.request.urlopen", side_effect=urlopen), ThreadPoolExecutor(8) as executor:
+            results = [executor.submit(verifier.has_access, token) for _ in range(8)]
+            # the threads that didn't get to refresh verify against the current list without waiting
+            time.sleep(0.1)
+            release.set()
+            assert all(result.result() for result in results)
+
+        assert len(fetches) == 1
+
+    def test_invalid_cursor(self, client):
+        assert client.get("/access/revocations?since=abc").status_code == 400
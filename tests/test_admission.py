@@ -0,0 +1,80 @@
+from tests.conftest import *
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from unittest.mock import patch
+
+from admission import admission_controller
+from handlers.stripe_webhook_handler import StripeWebhookHandler
+from tests.test_metrics import sample
+
+
+@pytest.fixture
+def blocked_webhook(client, monkeypatch):
+    """
+    Limit webhooks to one at a time, and hold that one inside the handler until the test releases it
+    """
+    monkeypatch.setitem(client.application.config, "ADMISSION_LIMITS", {"webhook": 1, "access": 4})
+    entered, release = threading.Event(), threading.Event()
+    process_webhook_event = StripeWebhookHandler.process_webhook_event
+
+    def blocking_process(event_data):
+        entered.set()
+        release.wait(5)
+        return process_webhook_event(event_data)
+
+    with patch.object(StripeWebhookHandler, "process_webhook_event", side_effect=blocking_process), \
+            ThreadPoolExecutor(1) as executor:
+        event = create_subscription_event("evt_1", "customer.subscription.created", "cus_1")
+        in_flight = executor.submit(client.application.test_client().post, "/stripe/webhook", data=event,
+                                    content_type='application/json')
+        assert entered.wait(5)
+        yield
+        release.set()
+        assert in_flight.result().status_code == 200
+
+
+class TestAdmissionControl:
+    def test_saturated_webhooks_are_shed(self, client, blocked_webhook):
+        rejections = sample('admission_rejections_total{route_class="webhook"}')
+        event = create_subscription_event("evt_2", "customer.subscription.created", "cus_2")
+
+        response = client.post("/stripe/webhook", data=event, content_type='application/json')
+        assert response.status_code == 503
+        assert response.headers["Retry-After"] == "5"
+        assert sample('admission_rejections_total{route_class="webhook"}') == rejections + 1
+
+        response = client.post("/stripe/webhook/batch", json=[json.loads(event)])
+        assert response.status_code == 503
+
+    def test_access_reads_have_their_own_budget(self, client, blocked_webhook):
+        user_id = create_user(client, get_current_utc() + timedelta(days=1))
+
+        assert client.get(f"/user/{user_id}/access").status_code == 200
+        assert client.get(f"/users/access?user_ids={user_id}").status_code == 200
+
+    def test_slot_is_released(self, client, monkeypatch):
+        monkeypatch.setitem(client.application.config, "ADMISSION_LIMITS", {"webhook": 1})
+        for index in range(3):
+            event = create_subscription_event(f"evt_{index}", "customer.subscription.created", "cus_123")
+            assert client.post("/stripe/webhook", data=event, content_type='application/json').status_code == 200
+
+        assert admission_controller.in_flight()["webhook"] == 0
+
+    def test_slot_is_released_on_error(self, client, monkeypatch):
+        monkeypatch.setitem(client.application.config, "ADMISSION_LIMITS", {"webhook": 1})
+        client.post("/stripe/webhook", data="not json", content_type='application/json')
+
+        assert admission_controller.in_flight()["webhook"] == 0
+
+    def test_queued_request_is_admitted(self, client, monkeypatch):
+        monkeypatch.setitem(client.application.config, "ADMISSION_LIMITS", {"webhook": 1})
+        monkeypatch.setitem(client.application.config, "ADMISSION_QUEUE_TIMEOUT_SECONDS", {"webhook": 5})
+
+        events = [create_subscription_event(f"evt_{index}", "customer.subscription.created", f"cus_{index}")
+                  for index in range(4)]
+        with ThreadPoolExecutor(4) as executor:
+            responses = list(executor.map(lambda event: client.application.test_client().post(
+                "/stripe/webhook", data=event, content_type='application/json'), events))
+
+        assert [response.status_code for response in responses] == [200] * 4
+        assert 'admission_queue_duration_seconds_count{route_class="webhook"}' in client.get("/metrics").text
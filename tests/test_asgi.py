@@ -0,0 +1,149 @@
+from tests.conftest import *
+import asyncio
+import threading
+from unittest.mock import patch
+
+from access_index import access_index
+from asgi import application
+from handlers.access_index_handler import AccessIndexHandler
+from database import async_engines
+
+
+class AsgiClient:
+    """
+    Drives the ASGI application directly, lifespan events included, so no ASGI server is needed
+    """
+
+    async def __aenter__(self):
+        self._lifespan_receive = asyncio.Queue()
+        self._lifespan_send = asyncio.Queue()
+        self._lifespan = asyncio.create_task(
+            application({"type": "lifespan"}, self._lifespan_receive.get, self._lifespan_send.put))
+        await self._lifespan_receive.put({"type": "lifespan.startup"})
+        assert (await self._lifespan_send.get())["type"] == "lifespan.startup.complete"
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self._lifespan_receive.put({"type": "lifespan.shutdown"})
+        assert (await self._lifespan_send.get())["type"] == "lifespan.shutdown.complete"
+        await self._lifespan
+
+    async def request(self, method, path, body=b"", headers=()):
+        path, _, query_string = path.partition("?")
+        scope = {
+            "type": "http", "method": method, "path": path, "query_string": query_string.encode(),
+            "headers": [(name.lower().encode(), value.encode()) for name, value in headers],
+            "scheme": "http", "server": ("testserver", 80), "client": ("127.0.0.1", 50000), "root_path": "",
+        }
+        request_messages = [{"type": "http.request", "body": body, "more_body": False}]
+        response_messages = []
+
+        async def receive():
+            return request_messages.pop(0) if request_messages else {"type": "http.disconnect"}
+
+        async def send(message):
+            response_messages.append(message)
+
+        await application(scope, receive, send)
+        start = response_messages[0]
+        response_headers = {name.decode(): value.decode() for name, value in start["headers"]}
+        return start["status"], response_headers, b"".join(message.get("body", b"") for message in
+                                                           response_messages[1:])
+
+
+def run(coroutine_function):
+    async def with_client():
+        async with AsgiClient() as asgi_client:
+            return await coroutine_function(asgi_client)
+
+    return asyncio.run(with_client())
+
+
+class TestAsgi:
+    def test_access_matches_wsgi(self, client):
+        user_id = create_user(client, get_current_utc() + timedelta(days=1))
+        access_cache.clear()
+
+        status, headers, body = run(lambda asgi_client: asgi_client.request("GET", f"/user/{user_id}/access"))
+        from_wsgi = client.get(f"/user/{user_id}/access")
+
+        assert status == 200
+        assert body == from_wsgi.data
+        assert headers["etag"] == from_wsgi.headers["ETag"]
+        assert headers["content-type"] == "application/json"
+
+    def test_access_uses_async_driver(self, client):
+        async def check(asgi_client):
+            return async_engines.read_engine().dialect.driver
+
+        assert run(check) == "aiosqlite"
+
+    def test_unknown_user(self, client):
+        status, _, body = run(lambda asgi_client: asgi_client.request("GET", "/user/999/access"))
+
+        assert status == 404
+        assert json.loads(body) == {"error": "User not found"}
+
+    def test_conditional_request(self, client):
+        user_id = create_user(client, get_current_utc() + timedelta(days=1))
+        etag = client.get(f"/user/{user_id}/access").headers["ETag"]
+
+        status, _, body = run(lambda asgi_client: asgi_client.request(
+            "GET", f"/user/{user_id}/access", headers=[("If-None-Match", etag)]))
+        assert status == 304
+        assert body == b""
+
+    def test_webhook_is_served_by_the_flask_app(self, client):
+        event = create_subscription_event("evt_123", "customer.subscription.created", "cus_123")
+
+        async def post_then_check(asgi_client):
+            status, _, body = await asgi_client.request(
+                "POST", "/stripe/webhook", event.encode(), headers=[("Content-Type", "application/json")])
+            user_id = int(json.loads(body)["message"].split("user id ")[1])
+            return status, await asgi_client.request("GET", f"/user/{user_id}/access")
+
+        status, (access_status, _, access_body) = run(post_then_check)
+        assert status == 200
+        assert access_status == 200 and json.loads(access_body)["has_access"]
+
+    def test_other_routes_are_served_by_the_flask_app(self, client):
+        create_user(client, get_current_utc() + timedelta(days=1))
+
+        status, _, body = run(lambda asgi_client: asgi_client.request(
+            "GET", "/users/access?stripe_customer_ids=cus_123"))
+        assert status == 200
+        assert json.loads(body)["results"][0]["has_access"]
+
+    def test_concurrent_access_checks_dont_need_threads(self, client, monkeypatch):
+        user_id = create_user(client, get_current_utc() + timedelta(days=1))
+        monkeypatch.setattr(access_cache, "max_size", 0)
+        monkeypatch.setitem(client.application.config, "ASGI_THREAD_POOL_SIZE", 1)
+
+        async def check_concurrently(asgi_client):
+            return await asyncio.gather(*[asgi_client.request("GET", f"/user/{user_id}/access") for _ in range(200)])
+
+        responses = run(check_concurrently)
+        assert all(status == 200 and json.loads(body)["has_access"] for status, _, body in responses)
+
+    def test_access_index_is_maintained_off_the_event_loop(self, client, tmp_path):
+        user_id = create_user(client, get_current_utc() + timedelta(days=1))
+        access_index.open(str(tmp_path / "access-index"), 1024)
+        maintain_access_index = AccessIndexHandler.maintain_access_index
+        threads = []
+
+        def record_thread():
+            threads.append(threading.current_thread())
+            maintain_access_index()
+
+        try:
+            async def check(asgi_client):
+                return threading.current_thread(), await asgi_client.request("GET", f"/user/{user_id}/access")
+
+            with patch.object(AccessIndexHandler, "maintain_access_index", side_effect=record_thread):
+                loop_thread, (status, _, body) = run(check)
+
+            assert status == 200 and json.loads(body)["has_access"]
+            assert threads and loop_thread not in threads
+            assert access_index.get(user_id).version == 0
+        finally:
+            access_index.close()
@@ -0,0 +1,66 @@
+from tests.conftest import *
+
+
+def create_customer(client, customer_id, access_until):
+    user = User(stripe_customer_id=customer_id, access_until=access_until)
+
+    with client.application.app_context():
+        db.session.add(user)
+        db.session.commit()
+        return user.id
+
+
+class TestBulkUserAccess:
+    def test_post_by_user_ids(self, client):
+        active_id = create_customer(client, "cus_1", get_current_utc() + timedelta(days=10))
+        expired_id = create_customer(client, "cus_2", get_current_utc() - timedelta(days=1))
+
+        response = client.post("/users/access", json={"user_ids": [expired_id, 999, active_id]})
+        assert response.status_code == 200
+
+        results = response.json["results"]
+        assert [result["user_id"] for result in results] == [expired_id, 999, active_id]
+        assert not results[0]["has_access"]
+        assert results[1]["error"] == "User not found"
+        assert results[2]["has_access"]
+
+    def test_get_by_user_ids(self, client):
+        user_id = create_customer(client, "cus_1", get_current_utc() + timedelta(days=10))
+
+        response = client.get(f"/users/access?user_ids={user_id},{user_id}")
+        assert response.status_code == 200
+        assert len(response.json["results"]) == 2
+        assert response.json["results"][0] == client.get(f"/user/{user_id}/access").json
+
+    def test_get_by_customer_ids(self, client):
+        user_id = create_customer(client, "cus_1", None)
+
+        response = client.get("/users/access?stripe_customer_ids=cus_1,cus_missing")
+        assert response.status_code == 200
+
+        results = response.json["results"]
+        assert results[0] == {"user_id": user_id, "stripe_customer_id": "cus_1", "access_until": None,
+                              "has_access": False}
+        assert results[1] == {"stripe_customer_id": "cus_missing", "error": "User not found"}
+
+    def test_bulk_uses_access_cache(self, client):
+        user_id = create_customer(client, "cus_1", get_current_utc() + timedelta(days=10))
+
+        client.post("/users/access", json={"user_ids": [user_id]})
+        client.post("/users/access", json={"user_ids": [user_id]})
+        assert access_cache.stats()["hits"] == 1
+
+    def test_requires_exactly_one_id_kind(self, client):
+        assert client.post("/users/access", json={}).status_code == 400
+        assert client.post("/users/access", json={"user_ids": [1], "stripe_customer_ids": ["cus_1"]}).status_code == 400
+        assert client.get("/users/access").status_code == 400
+
+    def test_invalid_ids(self, client):
+        assert client.get("/users/access?user_ids=1,abc").status_code == 400
+        assert client.post("/users/access", json={"user_ids": ["1"]}).status_code == 400
+        assert client.post("/users/access", json={"stripe_customer_ids": "cus_1"}).status_code == 400
+
+    def test_too_many_ids(self, client, monkeypatch):
+        monkeypatch.setitem(client.application.config, "BULK_ACCESS_MAX_IDS", 2)
+        response = client.post("/users/access", json={"user_ids": [1, 2, 3]})
+        assert response.status_code == 400
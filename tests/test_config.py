@@ -0,0 +1,37 @@
+from sqlalchemy import text
+
+from tests.conftest import *
+from config import get_config, SQLiteConfig, PostgresConfig
+
+
+class TestConfig:
+    def test_profile_from_argument(self):
+        assert get_config("postgres") is PostgresConfig
+        assert get_config("sqlite") is SQLiteConfig
+
+    def test_profile_from_environment(self, monkeypatch):
+        monkeypatch.setenv("DATABASE_PROFILE", "postgres")
+        assert get_config() is PostgresConfig
+
+    def test_profile_from_database_url(self, monkeypatch):
+        monkeypatch.delenv("DATABASE_PROFILE", raising=False)
+        monkeypatch.setenv("DATABASE_URL", "postgresql://db.internal/supernaut")
+        assert get_config() is PostgresConfig
+
+        monkeypatch.delenv("DATABASE_URL")
+        assert get_config() is SQLiteConfig
+
+    def test_unknown_profile(self):
+        with pytest.raises(ValueError):
+            get_config("mysql")
+
+    def test_postgres_engine_options(self):
+        options = PostgresConfig.SQLALCHEMY_ENGINE_OPTIONS
+        assert options["pool_pre_ping"]
+        assert "statement_timeout" in options["connect_args"]["options"]
+
+    def test_sqlite_pragmas_applied(self, client):
+        with db.engine.connect() as connection:
+            assert connection.execute(text("PRAGMA journal_mode")).scalar() == "wal"
+            assert connection.execute(text("PRAGMA synchronous")).scalar() == 1  # NORMAL
+            assert connection.execute(text("PRAGMA busy_timeout")).scalar() == 5000
@@ -0,0 +1,147 @@
+from unittest.mock import patch
+
+from tests.conftest import *
+import gzip
+import threading
+import time
+
+from event_archive import ArchiveReader, event_archive
+from metrics import metrics
+
+
+@pytest.fixture
+def archive(tmp_path):
+    event_archive.open(str(tmp_path))
+    yield tmp_path
+    event_archive.close()
+
+
+def event(event_id, customer_id="cus_123"):
+    return create_subscription_event(event_id, "customer.subscription.created", customer_id)
+
+
+class TestEventArchive:
+    def test_webhooks_are_archived_as_received(self, client, archive):
+        body = event("evt_1")
+        client.post("/stripe/webhook", data=body, content_type="application/json")
+        event_archive.close()
+
+        records = list(ArchiveReader(str(archive)).records())
+        assert len(records) == 1
+        assert records[0]["event"] == json.loads(body)
+        assert records[0]["received_at"] <= datetime.now().timestamp()
+
+        # segments are plain gzip files of JSON lines
+        segment, = ArchiveReader(str(archive)).segments()
+        with gzip.open(segment, "rt") as file:
+            assert json.loads(file.readline())["event"]["id"] == "evt_1"
+
+    def test_pretty_printed_bodies_stay_on_one_line(self, client, archive):
+        client.post("/stripe/webhook", data=json.dumps(json.loads(event("evt_1")), indent=2),
+                    content_type="application/json")
+        event_archive.close()
+
+        assert [record["event"]["id"] for record in ArchiveReader(str(archive)).records()] == ["evt_1"]
+
+    def test_batches_are_archived(self, client, archive):
+        client.post("/stripe/webhook/batch", json=[json.loads(event("evt_1")), json.loads(event("evt_2", "cus_2"))])
+        event_archive.close()
+
+        assert [record["event"]["id"] for record in ArchiveReader(str(archive)).records()] == ["evt_1", "evt_2"]
+
+    def test_find_by_event_id(self, client, archive):
+        for i in range(20):
+            client.post("/stripe/webhook", data=event(f"evt_{i}", f"cus_{i}"), content_type="application/json")
+        # a redelivery is archived again
+        client.post("/stripe/webhook", data=event("evt_7", "cus_7"), content_type="application/json")
+        event_archive.close()
+
+        records = ArchiveReader(str(archive)).find("evt_7")
+        assert [record["event"]["id"] for record in records] == ["evt_7", "evt_7"]
+        assert ArchiveReader(str(archive)).find("evt_missing") == []
+
+    def test_segments_rotate(self, client, tmp_path):
+        event_archive.open(str(tmp_path), segment_max_bytes=1)
+        try:
+            for i in range(3):
+                event_archive.append(json.loads(event(f"evt_{i}")))
+                # let the writer drain each event on its own
+                time.sleep(0.05)
+        finally:
+            event_archive.close()
+
+        reader = ArchiveReader(str(tmp_path))
+        assert len(reader.segments()) == 3
+        assert [record["event"]["id"] for record in reader.records()] == ["evt_0", "evt_1", "evt_2"]
+        assert reader.find("evt_2")[0]["event"]["id"] == "evt_2"
+
+    def test_partially_written_member_is_skipped(self, client, archive):
+        event_archive.append(json.loads(event("evt_1")))
+        event_archive.close()
+
+        segment, = ArchiveReader(str(archive)).segments()
+        # a second member the writer is still in the middle of
+        with open(segment, "ab") as file:
+            file.write(gzip.compress(b'{"received_at":1,"event":{"id":"evt_2"}}\n')[:20])
+
+        assert [record["event"]["id"] for record in ArchiveReader(str(archive)).records()] == ["evt_1"]
+
+    def test_full_queue_drops_events(self, client, tmp_path):
+        event_archive.open(str(tmp_path), queue_size=1)
+        dropped = metrics.event_archive_dropped.labels(None).total()[0]
+        try:
+            with patch.object(event_archive, "_ensure_writer"):
+                event_archive.append(json.loads(event("evt_1")))
+                event_archive.append(json.loads(event("evt_2")))
+        finally:
+            event_archive._queue = None
+
+        assert metrics.event_archive_dropped.labels(None).total()[0] == dropped + 1
+
+    def test_write_errors_dont_stop_the_writer(self, client, archive):
+        dropped = metrics.event_archive_dropped.labels(None).total()[0]
+        with patch("event_archive._Segment.write_member", side_effect=OSError(28, "No space left on device")):
+            event_archive.append(json.loads(event("evt_1")))
+            time.sleep(0.05)
+
+        event_archive.append(json.loads(event("evt_2")))
+        event_archive.close()
+
+        assert metrics.event_archive_dropped.labels(None).total()[0] == dropped + 1
+        assert [record["event"]["id"] for record in ArchiveReader(str(archive)).records()] == ["evt_2"]
+
+    def test_close_doesnt_hang_on_a_stuck_writer(self, client, tmp_path, monkeypatch):
+        monkeypatch.setattr("event_archive.CLOSE_TIMEOUT_SECONDS", 0.1)
+        event_archive.open(str(tmp_path), queue_size=1)
+        release = threading.Event()
+
+        with patch("event_archive._Segment.write_member", side_effect=lambda batch: release.wait()):
+            event_archive.append(json.loads(event("evt_1")))
+            time.sleep(0.05)
+            event_archive.append(json.loads(event("evt_2")))  # fills the queue
+
+            started = time.monotonic()
+            event_archive.close()
+            assert time.monotonic() - started < 1
+            release.set()
+
+    def test_disabled_by_default(self, client):
+        assert not event_archive.enabled
+        assert client.post("/stripe/webhook", data=event("evt_1"), content_type="application/json").status_code == 200
+
+    def test_read_archive_command(self, client, archive):
+        for i in range(3):
+            client.post("/stripe/webhook", data=event(f"evt_{i}", f"cus_{i}"), content_type="application/json")
+        event_archive.close()
+        runner = client.application.test_cli_runner()
+
+        result = runner.invoke(args=["read-archive", "--directory", str(archive)])
+        assert result.exit_code == 0, result.output
+        assert [json.loads(line)["id"] for line in result.output.splitlines()] == ["evt_0", "evt_1", "evt_2"]
+
+        result = runner.invoke(args=["read-archive", "--directory", str(archive), "--event-id", "evt_1", "--records"])
+        assert [json.loads(line)["event"]["id"] for line in result.output.splitlines()] == ["evt_1"]
+
+        result = runner.invoke(args=["read-archive", "--directory", str(archive), "--since", "2000-01-01",
+                                     "--until", "2001-01-01"])
+        assert result.output == ""
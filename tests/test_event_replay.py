@@ -0,0 +1,140 @@
+from unittest.mock import patch
+
+from sqlalchemy.exc import OperationalError
+
+from tests.conftest import *
+import os
+
+from handlers.event_replay_handler import EventReplayHandler, CheckpointMismatchError
+from handlers.stripe_webhook_handler import StripeWebhookHandler
+from helpers import DateTimeNaiveHelper
+from models import StripeProcessedEvent
+
+
+def event(event_id, event_type, customer_id, created, **kwargs):
+    if event_type.startswith("invoice."):
+        event_data = json.loads(create_invoice_event(event_id, event_type, customer_id, **kwargs))
+    else:
+        event_data = json.loads(create_subscription_event(event_id, event_type, customer_id, **kwargs))
+    event_data["created"] = created
+    return event_data
+
+
+def customer_history(customer_id, created=1000):
+    return [
+        event(f"evt_{customer_id}_1", "customer.subscription.created", customer_id, created),
+        event(f"evt_{customer_id}_2", "invoice.payment_failed", customer_id, created + 10),
+        event(f"evt_{customer_id}_3", "customer.subscription.updated", customer_id, created + 20),
+    ]
+
+
+def has_access(customer_id):
+    access_until = DateTimeNaiveHelper.make_timezone_aware(
+        User.query.filter_by(stripe_customer_id=customer_id).one().access_until)
+    return access_until > get_current_utc()
+
+
+@pytest.fixture
+def export(tmp_path):
+    def write(events):
+        path = tmp_path / "events.jsonl"
+        path.write_text("\n".join(json.dumps(event_data) for event_data in events) + "\n")
+        return path
+
+    return write
+
+
+class TestEventReplay:
+    def test_events_are_applied_in_created_order(self, client, tmp_path):
+        # `stripe events list` is newest first
+        events = list(reversed(customer_history("cus_1") + customer_history("cus_2")))
+
+        stats = EventReplayHandler.replay_events(map(json.dumps, events), str(tmp_path / "checkpoint"), partitions=4)
+
+        assert (stats.total, stats.processed, stats.duplicates) == (6, 6, 0)
+        assert has_access("cus_1") and has_access("cus_2")
+
+    def test_events_list_pages_are_expanded(self, client, tmp_path):
+        page = {"object": "list", "data": list(reversed(customer_history("cus_1"))), "has_more": False}
+
+        stats = EventReplayHandler.replay_events([json.dumps(page)], str(tmp_path / "checkpoint"))
+        assert stats.processed == 3
+        assert has_access("cus_1")
+
+    def test_irrelevant_and_invalid_events_are_skipped(self, client, tmp_path):
+        lines = [
+            json.dumps(event("evt_1", "customer.subscription.created", "cus_1", 1000)),
+            json.dumps({"id": "evt_2", "type": "charge.succeeded", "data": {"object": {"customer": "cus_1"}}}),
+            json.dumps({"type": "invoice.paid"}),
+            "not json",
+        ]
+
+        stats = EventReplayHandler.replay_events(lines, str(tmp_path / "checkpoint"))
+        assert (stats.read, stats.processed, stats.ignored, stats.invalid) == (4, 1, 1, 2)
+
+    def test_already_processed_events_are_duplicates(self, client, tmp_path):
+        history = customer_history("cus_1")
+        client.post("/stripe/webhook", json=history[0])
+
+        stats = EventReplayHandler.replay_events(map(json.dumps, history), str(tmp_path / "checkpoint"))
+        assert (stats.processed, stats.duplicates) == (2, 1)
+
+    def test_resumes_from_checkpoint(self, client, tmp_path):
+        lines = [json.dumps(event_data) for event_data in customer_history("cus_1") + customer_history("cus_2")]
+        checkpoint = str(tmp_path / "checkpoint")
+        apply_event_to_user = StripeWebhookHandler._apply_event_to_user
+        calls = []
+
+        def fail_on_fourth_event(event_data, user):
+            calls.append(event_data["id"])
+            if len(calls) == 4:
+                raise OperationalError("UPDATE user", {}, Exception("database went away"))
+            return apply_event_to_user(event_data, user)
+
+        with patch.object(StripeWebhookHandler, "_apply_event_to_user", side_effect=fail_on_fourth_event):
+            with pytest.raises(OperationalError):
+                EventReplayHandler.replay_events(lines, checkpoint, partitions=1, batch_size=2)
+        assert StripeProcessedEvent.query.count() == 2
+
+        stats = EventReplayHandler.replay_events(lines, checkpoint, partitions=1, batch_size=2)
+        assert (stats.replayed, stats.processed, stats.duplicates) == (6, 4, 0)
+        assert StripeProcessedEvent.query.count() == 6
+        assert has_access("cus_1") and has_access("cus_2")
+
+        # a finished replay is a no-op
+        assert EventReplayHandler.replay_events(lines, checkpoint, partitions=1).processed == 0
+
+    def test_failing_event_is_skipped(self, client, tmp_path):
+        events = customer_history("cus_1") + customer_history("cus_2")
+        # active, but without a period end
+        del events[3]["data"]["object"]["current_period_end"]
+        checkpoint = str(tmp_path / "checkpoint")
+
+        stats = EventReplayHandler.replay_events(map(json.dumps, events), checkpoint, partitions=1)
+
+        assert (stats.replayed, stats.processed, stats.failed) == (6, 5, 1)
+        assert db.session.get(StripeProcessedEvent, "evt_cus_2_1") is None
+        assert StripeProcessedEvent.query.count() == 5
+        # the checkpoint moved past it
+        assert EventReplayHandler.replay_events(map(json.dumps, events), checkpoint, partitions=1).processed == 0
+
+    def test_checkpoint_of_other_input_is_rejected(self, client, tmp_path):
+        checkpoint = str(tmp_path / "checkpoint")
+        EventReplayHandler.replay_events(map(json.dumps, customer_history("cus_1")), checkpoint)
+
+        with pytest.raises(CheckpointMismatchError):
+            EventReplayHandler.replay_events(map(json.dumps, customer_history("cus_2")), checkpoint)
+
+    def test_replay_command(self, client, export):
+        path = export(list(reversed(customer_history("cus_1"))))
+
+        result = client.application.test_cli_runner().invoke(args=["replay-events", str(path)])
+        assert result.exit_code == 0, result.output
+        assert "Replayed 3 events: 3 processed" in result.output
+        assert os.path.exists(f"{path}.checkpoint")
+        assert has_access("cus_1")
+
+    def test_replay_command_needs_checkpoint_for_stdin(self, client):
+        result = client.application.test_cli_runner().invoke(args=["replay-events", "-"], input="")
+        assert result.exit_code != 0
+        assert "--checkpoint is required" in result.output
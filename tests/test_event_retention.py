@@ -0,0 +1,97 @@
+from unittest.mock import patch
+
+from tests.conftest import *
+import time
+from cache import ProcessedEventFilter
+from helpers import DateTimeNaiveHelper
+from handlers.event_retention_handler import EventRetentionHandler
+from models import StripeProcessedEvent
+
+
+class TestEventRetention:
+    def test_prune_deletes_only_expired_events(self, client):
+        now = get_current_utc()
+        db.session.add_all(
+            [StripeProcessedEvent(stripe_event_id=f"evt_old_{i}", processed_at=now - timedelta(days=10))
+             for i in range(5)] +
+            [StripeProcessedEvent(stripe_event_id="evt_new", processed_at=now - timedelta(days=1))])
+        db.session.commit()
+
+        deleted = EventRetentionHandler.prune_processed_events(retention_days=7, chunk_size=2)
+        assert deleted == 5
+        assert [event.stripe_event_id for event in StripeProcessedEvent.query.all()] == ["evt_new"]
+
+    def test_processed_at_is_recorded(self, client):
+        event = create_subscription_event("evt_123", "customer.subscription.created", "cus_123")
+        client.post("/stripe/webhook", data=event, content_type='application/json')
+
+        processed_at = DateTimeNaiveHelper.make_timezone_aware(StripeProcessedEvent.query.first().processed_at)
+        assert abs((processed_at - get_current_utc()).total_seconds()) < 5
+
+    def test_prune_command(self, client):
+        db.session.add(StripeProcessedEvent(stripe_event_id="evt_old",
+                                            processed_at=get_current_utc() - timedelta(days=30)))
+        db.session.commit()
+
+        result = client.application.test_cli_runner().invoke(args=["prune-events"])
+        assert "Deleted 1 processed events" in result.output
+        assert StripeProcessedEvent.query.count() == 0
+
+
+class TestProcessedEventFilter:
+    def test_no_false_negatives(self):
+        event_filter = ProcessedEventFilter(capacity=1000, error_rate=0.01)
+        event_ids = [f"evt_{i}" for i in range(1000)]
+        event_filter.load(event_ids)
+
+        assert all(event_filter.might_contain(event_id) for event_id in event_ids)
+        false_positives = sum(event_filter.might_contain(f"evt_new_{i}") for i in range(1000))
+        assert false_positives < 50
+
+    def test_disabled_filter_always_probes(self):
+        assert ProcessedEventFilter(capacity=0).might_contain("evt_123")
+
+    def test_new_event_skips_probe(self, client):
+        event = create_subscription_event("evt_123", "customer.subscription.created", "cus_123")
+
+        with patch('handlers.stripe_webhook_handler.db.session.get') as mock_get:
+            response = client.post("/stripe/webhook", data=event, content_type='application/json')
+            mock_get.assert_not_called()
+        assert response.status_code == 200
+
+    def test_filter_rebuilt_from_database(self, client):
+        db.session.add(StripeProcessedEvent(stripe_event_id="evt_123"))
+        db.session.commit()
+        processed_event_filter.clear()
+
+        processed_event_filter.start_loading()
+        deadline = time.monotonic() + 5
+        while not processed_event_filter.loaded and time.monotonic() < deadline:
+            time.sleep(0.01)
+
+        assert processed_event_filter.might_contain("evt_123")
+        event = create_subscription_event("evt_123", "customer.subscription.created", "cus_123")
+        response = client.post("/stripe/webhook", data=event, content_type='application/json')
+        assert response.json["message"] == "Event already processed"
+
+    def test_requests_dont_wait_for_the_filter(self, client):
+        processed_event_filter.clear()
+        db.session.add(StripeProcessedEvent(stripe_event_id="evt_123"))
+        db.session.commit()
+
+        # not loaded yet, so every id is probed in the database
+        assert processed_event_filter.might_contain("evt_new")
+        event = create_subscription_event("evt_123", "customer.subscription.created", "cus_123")
+        response = client.post("/stripe/webhook", data=event, content_type='application/json')
+        assert response.json["message"] == "Event already processed"
+
+    def test_clear_discards_a_load_in_progress(self):
+        event_filter = ProcessedEventFilter(capacity=1000, error_rate=0.01)
+
+        def event_ids():
+            yield "evt_1"
+            event_filter.clear()
+            yield "evt_2"
+
+        event_filter.load(event_ids())
+        assert not event_filter.loaded
@@ -0,0 +1,152 @@
+from tests.conftest import *
+from concurrent.futures import ThreadPoolExecutor
+from unittest.mock import patch
+
+from sqlalchemy import event
+
+from group_commit import GroupCommitter
+from handlers.stripe_webhook_handler import StripeWebhookHandler
+from models import StripeProcessedEvent
+
+
+@pytest.fixture
+def group_client(client, monkeypatch):
+    monkeypatch.setitem(client.application.config, "WEBHOOK_GROUP_COMMIT_ENABLED", True)
+    monkeypatch.setitem(client.application.config, "WEBHOOK_GROUP_COMMIT_MAX_WAIT_MS", 50)
+    return client
+
+
+class TestGroupCommitter:
+    def test_concurrent_work_shares_a_group(self):
+        committer = GroupCommitter()
+        groups = []
+
+        def commit_group(works):
+            groups.append([work.payload for work in works])
+            for work in works:
+                work.result = work.payload * 2
+
+        with ThreadPoolExecutor(8) as executor:
+            results = list(executor.map(lambda payload: committer.submit(payload, commit_group, 0.05, 100), range(8)))
+
+        assert results == [payload * 2 for payload in range(8)]
+        assert sorted(payload for group in groups for payload in group) == list(range(8))
+        assert len(groups) < 8
+
+    def test_max_size_splits_groups(self):
+        committer = GroupCommitter()
+        sizes = []
+
+        def commit_group(works):
+            sizes.append(len(works))
+
+        with ThreadPoolExecutor(6) as executor:
+            list(executor.map(lambda payload: committer.submit(payload, commit_group, 0.05, 2), range(6)))
+
+        assert sum(sizes) == 6
+        assert max(sizes) <= 2
+
+    def test_keys_are_grouped_separately(self):
+        committer = GroupCommitter()
+        groups = []
+
+        def commit_group(works):
+            groups.append({work.payload % 2 for work in works})
+
+        with ThreadPoolExecutor(8) as executor:
+            list(executor.map(lambda payload: committer.submit(payload, commit_group, 0.05, 100, key=payload % 2),
+                              range(8)))
+
+        assert all(len(keys) == 1 for keys in groups)
+        assert committer._pending == {}
+
+    def test_error_is_raised_in_its_request(self):
+        committer = GroupCommitter()
+
+        def commit_group(works):
+            for work in works:
+                work.error = ValueError("boom")
+
+        with pytest.raises(ValueError, match="boom"):
+            committer.submit(1, commit_group, 0, 10)
+
+
+class TestWebhookGroupCommit:
+    def test_single_event(self, group_client):
+        event = create_subscription_event("evt_123", "customer.subscription.created", "cus_123")
+        response = group_client.post("/stripe/webhook", data=event, content_type='application/json')
+
+        assert response.status_code == 200
+        assert "Event processed successfully for user id" in response.json["message"]
+
+        response = group_client.post("/stripe/webhook", data=event, content_type='application/json')
+        assert response.json["message"] == "Event already processed"
+
+    def test_concurrent_events_share_commits(self, group_client):
+        commits = []
+
+        def count_commit(connection):
+            commits.append(connection)
+
+        event.listen(db.engine, "commit", count_commit)
+        try:
+            responses = post_concurrently(group_client, [
+                create_subscription_event(f"evt_{index}", "customer.subscription.created", f"cus_{index}")
+                for index in range(8)])
+        finally:
+            event.remove(db.engine, "commit", count_commit)
+
+        assert all(response.status_code == 200 for response in responses)
+        assert User.query.count() == 8
+        assert StripeProcessedEvent.query.count() == 8
+        assert len(commits) < 8
+
+    def test_failure_rolls_back_only_its_event(self, group_client):
+        handle_event_by_type = StripeWebhookHandler._handle_event_by_type
+
+        def failing_handler(event_data, user):
+            if event_data["id"] == "evt_bad":
+                raise RuntimeError("boom")
+            handle_event_by_type(event_data, user)
+
+        events = [create_subscription_event(f"evt_{index}", "customer.subscription.created", f"cus_{index}")
+                  for index in range(4)]
+        events.append(create_subscription_event("evt_bad", "customer.subscription.created", "cus_bad"))
+
+        with patch.object(StripeWebhookHandler, "_handle_event_by_type", side_effect=failing_handler):
+            responses = post_concurrently(group_client, events)
+
+        statuses = {json.loads(event)["id"]: response.status_code for event, response in zip(events, responses)}
+        assert statuses == {"evt_0": 200, "evt_1": 200, "evt_2": 200, "evt_3": 200, "evt_bad": 500}
+        assert db.session.get(StripeProcessedEvent, "evt_bad") is None
+        assert User.query.filter_by(stripe_customer_id="cus_bad").first() is None
+        assert StripeProcessedEvent.query.count() == 4
+
+    def test_flush_time_failure_rolls_back_only_its_event(self, group_client):
+        handle_event_by_type = StripeWebhookHandler._handle_event_by_type
+
+        def handler_breaking_a_constraint(event_data, user):
+            handle_event_by_type(event_data, user)
+            if event_data["id"] == "evt_bad":
+                # only fails when the user is flushed
+                user.stripe_customer_id = None
+
+        events = [create_subscription_event(f"evt_{index}", "customer.subscription.created", f"cus_{index}")
+                  for index in range(4)]
+        events.insert(1, create_subscription_event("evt_bad", "customer.subscription.created", "cus_bad"))
+
+        with patch.object(StripeWebhookHandler, "_handle_event_by_type", side_effect=handler_breaking_a_constraint):
+            responses = post_concurrently(group_client, events)
+
+        statuses = {json.loads(event)["id"]: response.status_code for event, response in zip(events, responses)}
+        assert statuses == {"evt_0": 200, "evt_bad": 500, "evt_1": 200, "evt_2": 200, "evt_3": 200}
+        assert db.session.get(StripeProcessedEvent, "evt_bad") is None
+        assert StripeProcessedEvent.query.count() == 4
+
+    def test_duplicates_within_a_group(self, group_client):
+        event = create_subscription_event("evt_123", "customer.subscription.created", "cus_123")
+        responses = post_concurrently(group_client, [event] * 4)
+
+        messages = sorted(response.json["message"] for response in responses)
+        assert messages.count("Event already processed") == 3
+        assert db.session.get(User, 1).version == 1
@@ -0,0 +1,92 @@
+import threading
+from unittest.mock import patch
+
+from tests.conftest import *
+from metrics import Counter, Histogram, metrics
+
+
+def sample(name):
+    """Value of a sample line in the /metrics output, 0 if it isn't there yet"""
+    for line in metrics.render().splitlines():
+        if line.startswith(name + " "):
+            return float(line.split(" ")[-1])
+    return 0.0
+
+
+class TestMetrics:
+    def test_counter_sums_threads(self):
+        counter = Counter("test_total", "Test counter.")
+        threads = [threading.Thread(target=lambda: [counter.inc() for _ in range(1000)]) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        counter.inc()
+
+        assert counter.render()[-1] == "test_total 4001"
+
+    def test_histogram_buckets(self):
+        histogram = Histogram("test_seconds", "Test histogram.", "route", buckets=(0.1, 1.0))
+        histogram.observe("/a", 0.05)
+        histogram.observe("/a", 0.1)
+        histogram.observe("/a", 5)
+
+        assert histogram.render()[2:] == [
+            'test_seconds_bucket{route="/a",le="0.1"} 2',
+            'test_seconds_bucket{route="/a",le="1"} 2',
+            'test_seconds_bucket{route="/a",le="+Inf"} 3',
+            'test_seconds_sum{route="/a"} 5.15',
+            'test_seconds_count{route="/a"} 3',
+        ]
+
+    def test_large_values_keep_full_precision(self):
+        counter = Counter("test_total", "Test counter.")
+        counter.inc(amount=1234567)
+        assert counter.render()[-1] == "test_total 1234567"
+
+        histogram = Histogram("test_seconds", "Test histogram.", buckets=(1.0,))
+        for _ in range(1234567):
+            histogram.observe(None, 0.5)
+        histogram.observe(None, 0.25)
+        assert histogram.render()[-3:] == [
+            'test_seconds_bucket{le="+Inf"} 1234568',
+            'test_seconds_sum 617283.75',
+            'test_seconds_count 1234568',
+        ]
+
+    def test_metrics_endpoint(self, client):
+        route_count = 'http_request_duration_seconds_count{route="/stripe/webhook"}'
+        event_count = 'stripe_webhook_event_duration_seconds_count{event_type="customer.subscription.created"}'
+        before = sample(route_count), sample(event_count), sample("stripe_webhook_duplicate_events_total")
+
+        event = create_subscription_event("evt_123", "customer.subscription.created", "cus_123")
+        client.post("/stripe/webhook", data=event, content_type='application/json')
+        client.post("/stripe/webhook", data=event, content_type='application/json')
+
+        response = client.get("/metrics")
+        assert response.status_code == 200
+        assert response.mimetype == "text/plain"
+        assert (sample(route_count), sample(event_count), sample("stripe_webhook_duplicate_events_total")) == (
+            before[0] + 2, before[1] + 1, before[2] + 1)
+        assert 'db_statements_per_request_count{route="/stripe/webhook"}' in response.text
+        assert "access_cache_hits_total" in response.text
+
+    def test_rollbacks_counted(self, client):
+        before = sample("stripe_webhook_rollbacks_total")
+
+        with patch('app.db.session.commit') as mock_commit:
+            mock_commit.side_effect = Exception("Database error")
+            event = create_subscription_event("evt_123", "customer.subscription.created", "cus_123")
+            client.post("/stripe/webhook", data=event, content_type='application/json')
+
+        assert sample("stripe_webhook_rollbacks_total") == before + 1
+
+    def test_statements_counted_per_request(self, client):
+        user_id = create_user(client, None)
+        route_sum = 'db_statements_per_request_sum{route="/user/<int:user_id>/access"}'
+        before = sample(route_sum)
+
+        client.get(f"/user/{user_id}/access")  # cache miss, one SELECT
+        client.get(f"/user/{user_id}/access")  # cache hit, no statements
+
+        assert sample(route_sum) == before + 1
@@ -0,0 +1,69 @@
+from tests.conftest import *
+from concurrent.futures import ThreadPoolExecutor
+
+from models import StripeProcessedEvent, AccessChange
+
+
+class TestOutOfOrderEvents:
+    def test_stale_event_is_a_noop(self, client):
+        period_end = get_30_days_later()
+        post_webhook(client, create_subscription_event("evt_2", "customer.subscription.updated", "cus_123",
+                                                       current_period_end=period_end, created=1020))
+        # delivered late, but created before the update that renewed the subscription
+        response = post_webhook(client, create_bare_event("evt_1", "invoice.payment_failed", "cus_123", created=1010))
+
+        assert response.status_code == 200
+        assert access_until().timestamp() == period_end
+        assert db.session.get(StripeProcessedEvent, "evt_1") is not None
+        user = User.query.one()
+        assert (user.version, user.revocation_version, user.last_event_created) == (1, 0, 1020)
+
+    def test_newer_event_is_applied(self, client):
+        post_webhook(client, create_subscription_event("evt_1", "customer.subscription.created", "cus_123",
+                                                       created=1010))
+        post_webhook(client, create_subscription_event("evt_2", "customer.subscription.deleted", "cus_123",
+                                                       created=1020))
+
+        assert access_until() <= get_current_utc()
+        assert User.query.one().last_event_created == 1020
+
+    def test_events_of_the_same_second_apply_in_arrival_order(self, client):
+        post_webhook(client, create_subscription_event("evt_1", "customer.subscription.created", "cus_123",
+                                                       created=1010))
+        post_webhook(client, create_subscription_event("evt_2", "customer.subscription.updated", "cus_123",
+                                                       status="canceled", created=1010))
+
+        assert access_until() <= get_current_utc()
+
+    def test_batch_in_any_order_ends_in_the_same_state(self, client):
+        period_end = get_30_days_later()
+        events = [
+            json.loads(create_subscription_event("evt_3", "customer.subscription.updated", "cus_123",
+                                                 current_period_end=period_end, created=1030)),
+            json.loads(create_subscription_event("evt_1", "customer.subscription.created", "cus_123", created=1010)),
+            json.loads(create_bare_event("evt_2", "invoice.payment_failed", "cus_123", created=1020)),
+        ]
+
+        response = client.post("/stripe/webhook/batch", json=events)
+
+        assert [result["status"] for result in response.json["results"]] == ["processed"] * 3
+        assert access_until().timestamp() == period_end
+        assert AccessChange.query.count() == 1
+
+    def test_concurrent_deliveries_in_reverse_order(self, client):
+        period_end = get_30_days_later()
+        events = [
+            create_subscription_event("evt_3", "customer.subscription.updated", "cus_123",
+                                      current_period_end=period_end, created=1030),
+            create_bare_event("evt_2", "invoice.payment_failed", "cus_123", created=1020),
+            create_subscription_event("evt_1", "customer.subscription.created", "cus_123", created=1010),
+        ]
+        post_webhook(client, events[0])
+
+        with ThreadPoolExecutor(2) as executor:
+            responses = list(executor.map(lambda event_data: post_webhook(client.application.test_client(), event_data),
+                                          events[1:]))
+
+        assert all(response.status_code == 200 for response in responses)
+        assert access_until().timestamp() == period_end
+        assert User.query.one().version == 1
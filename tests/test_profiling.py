@@ -0,0 +1,81 @@
+from tests.conftest import *
+import cProfile
+import os
+import pstats
+
+from profiling import collapsed_stacks
+
+
+@pytest.fixture
+def profiling_client(client, monkeypatch, tmp_path):
+    monkeypatch.setitem(client.application.config, "PROFILING_ENABLED", True)
+    monkeypatch.setitem(client.application.config, "PROFILING_OUTPUT_DIR", str(tmp_path))
+    return client
+
+
+def leaf():
+    total = 0
+    for value in range(20000):
+        total += value
+    return total
+
+
+def branch():
+    return leaf() + leaf()
+
+
+class TestProfiling:
+    def test_header_profiles_request(self, profiling_client, tmp_path):
+        user_id = create_user(profiling_client, get_current_utc() + timedelta(days=1))
+
+        response = profiling_client.get(f"/user/{user_id}/access", headers={"X-Debug-Profile": "1"})
+        assert response.status_code == 200
+
+        profile_id = response.headers["X-Profile-Id"]
+        assert sorted(os.listdir(tmp_path)) == [f"{profile_id}.collapsed", f"{profile_id}.sql.log"]
+
+        sql_log = (tmp_path / f"{profile_id}.sql.log").read_text().splitlines()
+        assert sql_log[0].startswith(f"# GET /user/{user_id}/access")
+        assert len(sql_log) == 2 and "FROM user" in sql_log[1]
+
+        stacks = (tmp_path / f"{profile_id}.collapsed").read_text().splitlines()
+        assert any("user_access_handler.py:get_user_access" in stack for stack in stacks)
+        assert all(int(stack.rsplit(" ", 1)[1]) > 0 for stack in stacks)
+
+    def test_not_profiled_without_header(self, profiling_client, tmp_path):
+        response = profiling_client.get("/user/1/access")
+
+        assert "X-Profile-Id" not in response.headers
+        assert os.listdir(tmp_path) == []
+
+    def test_disabled(self, profiling_client, monkeypatch, tmp_path):
+        monkeypatch.setitem(profiling_client.application.config, "PROFILING_ENABLED", False)
+        response = profiling_client.get("/user/1/access", headers={"X-Debug-Profile": "1"})
+
+        assert "X-Profile-Id" not in response.headers
+
+    def test_header_token(self, profiling_client, monkeypatch):
+        monkeypatch.setitem(profiling_client.application.config, "PROFILING_HEADER_TOKEN", "secret")
+
+        assert "X-Profile-Id" not in profiling_client.get("/user/1/access",
+                                                          headers={"X-Debug-Profile": "1"}).headers
+        assert "X-Profile-Id" in profiling_client.get("/user/1/access",
+                                                      headers={"X-Debug-Profile": "secret"}).headers
+
+    def test_sample_rate(self, profiling_client, monkeypatch):
+        monkeypatch.setitem(profiling_client.application.config, "PROFILING_SAMPLE_RATE", 1.0)
+        event = create_subscription_event("evt_123", "customer.subscription.created", "cus_123")
+
+        response = profiling_client.post("/stripe/webhook", data=event, content_type='application/json')
+        assert "X-Profile-Id" in response.headers
+
+
+class TestCollapsedStacks:
+    def test_own_time_follows_call_path(self):
+        profiler = cProfile.Profile()
+        profiler.runcall(branch)
+
+        stacks = collapsed_stacks(pstats.Stats(profiler).stats)
+        leaf_stacks = [stack for stack in stacks if stack.endswith(f":leaf:{leaf.__code__.co_firstlineno}")]
+        assert len(leaf_stacks) == 1
+        assert leaf_stacks[0].split(";")[-2].startswith("test_profiling.py:branch:")
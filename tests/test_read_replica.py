@@ -0,0 +1,57 @@
+from tests.conftest import *
+from sqlalchemy import create_engine, insert, select
+
+from database import read_replica_router
+
+
+@pytest.fixture
+def replica(client, monkeypatch, tmp_path):
+    """
+    A separate database standing in for a replica that lags behind: it has the user, but without access
+    """
+    engine = create_engine(f"sqlite:///{tmp_path}/replica.db")
+    db.metadata.create_all(engine)
+    with engine.begin() as connection:
+        connection.execute(insert(User).values(id=1, stripe_customer_id="cus_123", access_until=None, version=0))
+
+    monkeypatch.setitem(db.engines, "replica", engine)
+    read_replica_router.clear()
+    yield engine
+    read_replica_router.clear()
+    engine.dispose()
+
+
+class TestReadReplica:
+    def test_reads_go_to_replica(self, client, replica):
+        user_id = create_user(client, get_current_utc() + timedelta(days=1))
+
+        assert not client.get(f"/user/{user_id}/access").json["has_access"]
+        assert not client.get(f"/users/access?user_ids={user_id}").json["results"][0]["has_access"]
+        assert not client.get("/users/access?stripe_customer_ids=cus_123").json["results"][0]["has_access"]
+
+    def test_read_your_writes(self, client, replica):
+        event = create_subscription_event("evt_123", "customer.subscription.created", "cus_123")
+        client.post("/stripe/webhook", data=event, content_type='application/json')
+
+        # the replica hasn't caught up yet, so the recently changed user is read from the primary
+        assert client.get("/user/1/access").json["has_access"]
+        assert client.get("/users/access?user_ids=1").json["results"][0]["has_access"]
+        assert client.get("/users/access?stripe_customer_ids=cus_123").json["results"][0]["has_access"]
+
+    def test_read_your_writes_window_expires(self, client, replica, monkeypatch):
+        monkeypatch.setattr(read_replica_router, "window_seconds", 0)
+        event = create_subscription_event("evt_123", "customer.subscription.created", "cus_123")
+        client.post("/stripe/webhook", data=event, content_type='application/json')
+
+        assert not client.get("/user/1/access").json["has_access"]
+
+    def test_writes_go_to_primary(self, client, replica):
+        event = create_subscription_event("evt_123", "customer.subscription.created", "cus_123")
+        client.post("/stripe/webhook", data=event, content_type='application/json')
+
+        assert db.session.get(User, 1).access_until is not None
+        with replica.connect() as connection:
+            assert connection.execute(select(User.access_until)).scalar() is None
+
+    def test_without_replica_reads_go_to_primary(self, client):
+        assert read_replica_router.read_engine() is db.engine
@@ -0,0 +1,149 @@
+from tests.conftest import *
+import threading
+import time
+
+from tests.fake_stripe import FakeStripeServer
+
+from stripe_client import StripeAPIError, StripeClient, stripe_client
+
+
+@pytest.fixture
+def stripe_server(client, monkeypatch):
+    server = FakeStripeServer()
+    monkeypatch.setitem(client.application.config, "STRIPE_API_KEY", "sk_test_123")
+    monkeypatch.setitem(client.application.config, "STRIPE_API_BASE_URL", server.start())
+    monkeypatch.setitem(client.application.config, "STRIPE_CIRCUIT_FAILURE_THRESHOLD", 3)
+    monkeypatch.setitem(client.application.config, "STRIPE_CIRCUIT_RESET_SECONDS", 0.2)
+    stripe_client.init_app(client.application)
+
+    yield server
+
+    monkeypatch.undo()
+    stripe_client.init_app(client.application)
+    server.stop()
+
+
+def days_later(days):
+    return int((get_current_utc() + timedelta(days=days)).timestamp())
+
+
+class TestStripeClient:
+    def test_fetches_subscription(self, stripe_server):
+        period_end = days_later(30)
+        stripe_server.add_subscription("sub_123", "cus_123", period_end)
+
+        subscription = stripe_client.get_subscription("sub_123")
+        assert subscription["customer"] == "cus_123"
+        assert StripeClient.current_period_end(subscription).timestamp() == period_end
+
+    def test_unknown_subscription_is_none(self, stripe_server):
+        assert stripe_client.get_subscription("sub_unknown") is None
+        assert stripe_client.circuit_breaker.state == "closed"
+
+    def test_period_end_of_older_api_versions(self):
+        assert StripeClient.current_period_end({"current_period_end": 1740384000}).timestamp() == 1740384000
+        assert StripeClient.current_period_end({"items": {"data": []}}) is None
+
+    def test_fetches_are_cached(self, stripe_server):
+        stripe_server.add_subscription("sub_123", "cus_123", days_later(30))
+
+        stripe_client.get_subscription("sub_123")
+        stripe_client.get_subscription("sub_123")
+        assert stripe_server.requests == 1
+
+    def test_cache_entries_expire(self, stripe_server):
+        stripe_server.add_subscription("sub_123", "cus_123", days_later(30))
+        stripe_client.cache_ttl_seconds = 0
+
+        stripe_client.get_subscription("sub_123")
+        stripe_client.get_subscription("sub_123")
+        assert stripe_server.requests == 2
+
+    def test_connections_are_kept_alive(self, stripe_server):
+        for index in range(5):
+            stripe_client.get_subscription(f"sub_{index}")
+
+        assert stripe_server.requests == 5
+        assert stripe_server.connections == 1
+
+    def test_concurrent_fetches_are_coalesced(self, stripe_server):
+        stripe_server.add_subscription("sub_123", "cus_123", days_later(30))
+        stripe_server.latency_seconds = 0.2
+        results = []
+
+        threads = [threading.Thread(target=lambda: results.append(stripe_client.get_subscription("sub_123")))
+                   for _ in range(10)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        assert stripe_server.requests == 1
+        assert len(results) == 10 and all(result["id"] == "sub_123" for result in results)
+
+    def test_slow_requests_time_out(self, stripe_server):
+        stripe_server.latency_seconds = 0.5
+        stripe_client.timeout_seconds = 0.05
+
+        with pytest.raises(StripeAPIError):
+            stripe_client.get_subscription("sub_123")
+
+    def test_circuit_opens_after_consecutive_failures(self, stripe_server):
+        stripe_server.fail_with_status = 500
+        for index in range(3):
+            with pytest.raises(StripeAPIError):
+                stripe_client.get_subscription(f"sub_{index}")
+        assert stripe_client.circuit_breaker.state == "open"
+
+        # rejected without a request while open
+        with pytest.raises(StripeAPIError, match="circuit is open"):
+            stripe_client.get_subscription("sub_123")
+        assert stripe_server.requests == 3
+
+        # a successful trial request after the reset timeout closes it again
+        stripe_server.fail_with_status = None
+        stripe_server.add_subscription("sub_123", "cus_123", days_later(30))
+        time.sleep(0.25)
+        assert stripe_client.get_subscription("sub_123")["id"] == "sub_123"
+        assert stripe_client.circuit_breaker.state == "closed"
+
+
+class TestInvoicePaidSubscriptionFetch:
+    def test_unknown_subscription_is_fetched(self, client, stripe_server):
+        period_end = days_later(365)
+        stripe_server.add_subscription("sub_123", "cus_123", period_end)
+
+        client.post("/stripe/webhook", data=create_invoice_event("evt_1", "invoice.paid", "cus_123", "sub_123"),
+                    content_type='application/json')
+        assert access_until().timestamp() == period_end
+
+    def test_local_subscription_is_not_fetched(self, client, stripe_server):
+        period_end = days_later(365)
+        client.post("/stripe/webhook", data=create_subscription_event(
+            "evt_1", "customer.subscription.created", "cus_123", "active", period_end,
+            subscription_id="sub_123", created=100), content_type='application/json')
+        client.post("/stripe/webhook", data=create_invoice_event("evt_2", "invoice.paid", "cus_123", "sub_123"),
+                    content_type='application/json')
+
+        assert stripe_server.requests == 0
+        assert access_until().timestamp() == period_end
+
+    def test_batch_fetches_each_subscription_once(self, client, stripe_server):
+        period_end = days_later(365)
+        stripe_server.add_subscription("sub_123", "cus_123", period_end)
+
+        client.post("/stripe/webhook/batch", json=[
+            json.loads(create_invoice_event(f"evt_{index}", "invoice.paid", "cus_123", "sub_123"))
+            for index in range(5)
+        ])
+        assert stripe_server.requests == 1
+        assert access_until().timestamp() == period_end
+
+    def test_falls_back_when_stripe_is_down(self, client, stripe_server):
+        stripe_server.fail_with_status = 500
+
+        response = client.post("/stripe/webhook",
+                               data=create_invoice_event("evt_1", "invoice.paid", "cus_123", "sub_123"),
+                               content_type='application/json')
+        assert response.status_code == 200
+        assert abs((access_until() - (get_current_utc() + timedelta(days=30))).total_seconds()) < 5
@@ -1,3 +1,5 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from unittest.mock import patch
 
 from tests.conftest import *
@@ -292,3 +294,22 @@ class TestStripeWebhook:
 
         user_access_until = DateTimeNaiveHelper.make_timezone_aware(user.access_until)
         assert user_access_until <= get_current_utc()
+
+    def test_concurrent_redeliveries(self, client):
+        event_data = create_subscription_event("evt_123", "customer.subscription.created", "cus_123")
+        barrier = threading.Barrier(4)
+
+        def deliver():
+            with client.application.test_client() as thread_client:
+                barrier.wait()
+                return thread_client.post("/stripe/webhook", data=event_data, content_type='application/json')
+
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            responses = list(executor.map(lambda _: deliver(), range(4)))
+
+        # every redelivery is acknowledged, but the event is applied exactly once
+        assert [response.status_code for response in responses] == [200] * 4
+        messages = [response.json["message"] for response in responses]
+        assert sum(message.startswith("Event processed successfully") for message in messages) == 1
+        assert User.query.count() == 1
+        assert StripeProcessedEvent.query.count() == 1
@@ -0,0 +1,86 @@
+from unittest.mock import patch
+
+from tests.conftest import *
+from helpers import DateTimeNaiveHelper
+from models import StripeProcessedEvent
+
+
+def post_batch(client, events):
+    return client.post("/stripe/webhook/batch", data=json.dumps([json.loads(event) for event in events]),
+                       content_type='application/json')
+
+
+class TestStripeWebhookBatch:
+    def test_batch_processes_all_events(self, client):
+        response = post_batch(client, [
+            create_subscription_event("evt_1", "customer.subscription.created", "cus_123"),
+            create_subscription_event("evt_2", "customer.subscription.created", "cus_456"),
+        ])
+        assert response.status_code == 200
+
+        results = response.json["results"]
+        assert [result["status"] for result in results] == ["processed", "processed"]
+        assert User.query.count() == 2
+        assert StripeProcessedEvent.query.count() == 2
+
+    def test_batch_applies_events_for_same_customer_in_order(self, client):
+        response = post_batch(client, [
+            create_subscription_event("evt_1", "customer.subscription.created", "cus_123"),
+            create_bare_event("evt_2", "customer.subscription.deleted", "cus_123"),
+        ])
+        assert response.status_code == 200
+
+        results = response.json["results"]
+        assert results[0]["user_id"] == results[1]["user_id"]
+        assert User.query.count() == 1
+
+        user = User.query.first()
+        assert DateTimeNaiveHelper.make_timezone_aware(user.access_until) <= get_current_utc()
+
+    def test_batch_reports_duplicates(self, client):
+        event = create_subscription_event("evt_1", "customer.subscription.created", "cus_123")
+        client.post("/stripe/webhook", data=event, content_type='application/json')
+
+        response = post_batch(client, [
+            event,
+            create_subscription_event("evt_2", "customer.subscription.created", "cus_123"),
+            create_subscription_event("evt_2", "customer.subscription.created", "cus_123"),
+        ])
+        assert response.status_code == 200
+        assert [result["status"] for result in response.json["results"]] == ["duplicate", "processed", "duplicate"]
+        assert StripeProcessedEvent.query.count() == 2
+
+    def test_batch_reports_invalid_and_ignored_events(self, client):
+        response = client.post("/stripe/webhook/batch", data=json.dumps([
+            {"type": "customer.subscription.created"},
+            {"id": "evt_1", "type": "customer.subscription.created", "data": {"object": {}}},
+            json.loads(create_bare_event("evt_2", "some.unknown.event.type", "cus_123")),
+        ]), content_type='application/json')
+        assert response.status_code == 200
+        assert [result["status"] for result in response.json["results"]] == ["invalid", "invalid", "ignored"]
+        assert User.query.count() == 0
+        assert StripeProcessedEvent.query.count() == 0
+
+    def test_batch_requires_list(self, client):
+        response = client.post("/stripe/webhook/batch", data=json.dumps({"id": "evt_1"}),
+                               content_type='application/json')
+        assert response.status_code == 400
+
+    def test_batch_too_large(self, client, monkeypatch):
+        monkeypatch.setitem(client.application.config, "WEBHOOK_BATCH_MAX_EVENTS", 1)
+        response = post_batch(client, [
+            create_subscription_event("evt_1", "customer.subscription.created", "cus_123"),
+            create_subscription_event("evt_2", "customer.subscription.created", "cus_456"),
+        ])
+        assert response.status_code == 400
+        assert User.query.count() == 0
+
+    def test_batch_rolls_back_on_error(self, client):
+        with patch('app.db.session.commit') as mock_commit:
+            mock_commit.side_effect = Exception("Database error")
+            response = post_batch(client, [
+                create_subscription_event("evt_1", "customer.subscription.created", "cus_123"),
+            ])
+        assert response.status_code == 500
+        assert "Failed to process event batch" in response.json["error"]
+        assert StripeProcessedEvent.query.count() == 0
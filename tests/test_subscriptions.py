@@ -0,0 +1,68 @@
+from tests.conftest import *
+
+from helpers import DateTimeNaiveHelper
+from models import Subscription
+
+
+class TestSubscriptionStore:
+    def test_subscription_events_are_stored(self, client):
+        period_end = get_30_days_later()
+        post_webhook(client, create_subscription_event("evt_1", "customer.subscription.created", "cus_123", "trialing",
+                                                       period_end, subscription_id="sub_123", created=100))
+
+        subscription = db.session.get(Subscription, "sub_123")
+        assert subscription.stripe_customer_id == "cus_123"
+        assert subscription.status == "trialing"
+        assert DateTimeNaiveHelper.make_timezone_aware(subscription.current_period_end).timestamp() == period_end
+
+        post_webhook(client, create_subscription_event("evt_2", "customer.subscription.updated", "cus_123", "active",
+                                                       period_end, subscription_id="sub_123", created=200))
+        post_webhook(client, create_subscription_event("evt_3", "customer.subscription.deleted", "cus_123", "active",
+                                                       period_end, subscription_id="sub_123", created=300))
+
+        db.session.expire_all()
+        assert db.session.get(Subscription, "sub_123").status == "canceled"
+        assert db.session.get(Subscription, "sub_123").last_event_created == 300
+
+    def test_older_event_does_not_overwrite(self, client):
+        post_webhook(client, create_subscription_event("evt_2", "customer.subscription.updated", "cus_123", "past_due",
+                                                       subscription_id="sub_123", created=200))
+        post_webhook(client, create_subscription_event("evt_1", "customer.subscription.created", "cus_123", "active",
+                                                       subscription_id="sub_123", created=100))
+
+        assert db.session.get(Subscription, "sub_123").status == "past_due"
+
+    def test_invoice_paid_uses_local_period_end(self, client):
+        period_end = int((get_current_utc() + timedelta(days=365)).timestamp())
+        post_webhook(client, create_subscription_event("evt_1", "customer.subscription.created", "cus_123", "active",
+                                                       period_end, subscription_id="sub_123", created=100))
+        post_webhook(client, create_invoice_event("evt_2", "invoice.payment_failed", "cus_123", "sub_123"))
+
+        response = post_webhook(client, create_invoice_event("evt_3", "invoice.paid", "cus_123", "sub_123"))
+        assert response.status_code == 200
+        assert access_until().timestamp() == period_end
+
+    def test_invoice_paid_for_unknown_subscription_falls_back(self, client):
+        post_webhook(client, create_invoice_event("evt_1", "invoice.paid", "cus_123", "sub_unknown"))
+
+        expected = get_current_utc() + timedelta(days=30)
+        assert abs((access_until() - expected).total_seconds()) < 5
+
+    def test_invoice_paid_with_lapsed_period_falls_back(self, client):
+        period_end = int((get_current_utc() - timedelta(days=1)).timestamp())
+        post_webhook(client, create_subscription_event("evt_1", "customer.subscription.created", "cus_123", "active",
+                                                       period_end, subscription_id="sub_123", created=100))
+        post_webhook(client, create_invoice_event("evt_2", "invoice.paid", "cus_123", "sub_123"))
+
+        expected = get_current_utc() + timedelta(days=30)
+        assert abs((access_until() - expected).total_seconds()) < 5
+
+    def test_batch_lookup_sees_subscription_from_same_batch(self, client):
+        period_end = int((get_current_utc() + timedelta(days=365)).timestamp())
+        client.post("/stripe/webhook/batch", json=[
+            json.loads(create_subscription_event("evt_1", "customer.subscription.created", "cus_123", "active",
+                                                 period_end, subscription_id="sub_123", created=100)),
+            json.loads(create_invoice_event("evt_2", "invoice.paid", "cus_123", "sub_123")),
+        ])
+
+        assert access_until().timestamp() == period_end
@@ -1,4 +1,6 @@
 from tests.conftest import *
+from handlers.user_access_handler import UserAccessHandler
+from helpers import ResponseHelper
 
 
 class TestUserAccessHandler:
@@ -73,3 +75,18 @@ class TestUserAccessHandler:
         """Test getting access with negative user ID"""
         response = client.get("/user/-1/access")
         assert response.status_code == 404
+
+    def test_get_user_access_body_matches_jsonify(self, client):
+        """Test the hand-written JSON body is byte for byte what jsonify would produce"""
+        for access_until in [get_current_utc() + timedelta(days=10), get_current_utc() - timedelta(days=1), None]:
+            with client.application.app_context():
+                user = User(stripe_customer_id=f"cus_{access_until}", access_until=access_until)
+                db.session.add(user)
+                db.session.commit()
+                user_id, stored_access_until = user.id, user.access_until
+
+                expected = ResponseHelper.success(UserAccessHandler._access_status(user_id, stored_access_until))[0]
+
+            response = client.get(f"/user/{user_id}/access")
+            assert response.data == expected.data
+            assert response.mimetype == "application/json"
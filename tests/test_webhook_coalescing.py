@@ -0,0 +1,95 @@
+from tests.conftest import *
+from unittest.mock import patch
+
+from sqlalchemy import event
+
+from group_commit import webhook_coalescer
+from handlers.stripe_webhook_handler import StripeWebhookHandler
+from helpers import DateTimeNaiveHelper
+from models import StripeProcessedEvent, AccessChange
+
+
+@pytest.fixture
+def coalescing_client(client, monkeypatch):
+    monkeypatch.setitem(client.application.config, "WEBHOOK_COALESCING_ENABLED", True)
+    monkeypatch.setitem(client.application.config, "WEBHOOK_COALESCE_WINDOW_MS", 500)
+    return client
+
+
+def burst(customer_id, period_end):
+    # newest first, as they may well arrive
+    return [
+        create_subscription_event("evt_3", "customer.subscription.updated", customer_id,
+                                  current_period_end=period_end, created=1030),
+        create_bare_event("evt_2", "invoice.payment_failed", customer_id, created=1020),
+        create_subscription_event("evt_1", "customer.subscription.created", customer_id, created=1010),
+    ]
+
+
+class TestWebhookCoalescing:
+    def test_burst_is_applied_in_created_order_with_one_user_write(self, coalescing_client, monkeypatch):
+        monkeypatch.setitem(coalescing_client.application.config, "WEBHOOK_COALESCE_MAX_EVENTS", 3)
+        period_end = get_30_days_later() + 3600
+        user_updates = []
+
+        def count_user_updates(connection, cursor, statement, *args):
+            if statement.startswith("UPDATE user "):
+                user_updates.append(statement)
+
+        groups = webhook_coalescer.groups
+        event.listen(db.engine, "before_cursor_execute", count_user_updates)
+        try:
+            responses = post_concurrently(coalescing_client, burst("cus_123", period_end))
+        finally:
+            event.remove(db.engine, "before_cursor_execute", count_user_updates)
+
+        assert all(response.status_code == 200 for response in responses)
+        assert webhook_coalescer.groups == groups + 1
+        assert StripeProcessedEvent.query.count() == 3
+
+        user = User.query.filter_by(stripe_customer_id="cus_123").one()
+        assert DateTimeNaiveHelper.make_timezone_aware(user.access_until).timestamp() == period_end
+        assert user.version == 1
+        assert AccessChange.query.count() == 1
+        assert len(user_updates) == 1
+
+    def test_customers_are_coalesced_separately(self, coalescing_client, monkeypatch):
+        monkeypatch.setitem(coalescing_client.application.config, "WEBHOOK_COALESCE_WINDOW_MS", 50)
+        groups = webhook_coalescer.groups
+
+        responses = post_concurrently(coalescing_client, [
+            create_subscription_event(f"evt_{index}", "customer.subscription.created", f"cus_{index}")
+            for index in range(4)])
+
+        assert all(response.status_code == 200 for response in responses)
+        assert webhook_coalescer.groups == groups + 4
+        assert User.query.count() == 4
+
+    def test_duplicates_within_a_burst(self, coalescing_client, monkeypatch):
+        monkeypatch.setitem(coalescing_client.application.config, "WEBHOOK_COALESCE_MAX_EVENTS", 3)
+        event_data = create_subscription_event("evt_123", "customer.subscription.created", "cus_123")
+
+        responses = post_concurrently(coalescing_client, [event_data] * 3)
+
+        messages = sorted(response.json["message"] for response in responses)
+        assert messages.count("Event already processed") == 2
+        assert User.query.one().version == 1
+
+    def test_failure_rolls_back_only_its_event(self, coalescing_client, monkeypatch):
+        monkeypatch.setitem(coalescing_client.application.config, "WEBHOOK_COALESCE_MAX_EVENTS", 3)
+        handle_event_by_type = StripeWebhookHandler._handle_event_by_type
+
+        def failing_handler(event_data, user):
+            if event_data["id"] == "evt_2":
+                raise RuntimeError("boom")
+            handle_event_by_type(event_data, user)
+
+        events = burst("cus_123", get_30_days_later())
+        with patch.object(StripeWebhookHandler, "_handle_event_by_type", side_effect=failing_handler):
+            responses = post_concurrently(coalescing_client, events)
+
+        statuses = {json.loads(event_data)["id"]: response.status_code for event_data, response in
+                    zip(events, responses)}
+        assert statuses == {"evt_1": 200, "evt_2": 500, "evt_3": 200}
+        assert db.session.get(StripeProcessedEvent, "evt_2") is None
+        assert StripeProcessedEvent.query.count() == 2
@@ -0,0 +1,166 @@
+from unittest.mock import patch
+
+from tests.conftest import *
+import time
+from handlers.stripe_webhook_handler import StripeWebhookHandler
+from handlers.webhook_queue_handler import WebhookQueueHandler, WebhookQueueWorkerPool
+from helpers import DateTimeNaiveHelper
+from models import StripeProcessedEvent, StripeWebhookQueueItem
+
+
+@pytest.fixture
+def async_client(client, monkeypatch):
+    monkeypatch.setitem(client.application.config, "WEBHOOK_ASYNC_MODE", True)
+    monkeypatch.setitem(client.application.config, "WEBHOOK_QUEUE_WORKERS", 1)
+    return client
+
+
+def drain(max_attempts=5):
+    return WebhookQueueHandler.drain_shard(0, 100, max_attempts)
+
+
+class TestWebhookQueue:
+    def test_webhook_is_queued_not_processed(self, async_client):
+        event = create_subscription_event("evt_123", "customer.subscription.created", "cus_123")
+
+        response = async_client.post("/stripe/webhook", data=event, content_type='application/json')
+        assert response.status_code == 202
+        assert StripeWebhookQueueItem.query.count() == 1
+        assert User.query.count() == 0
+
+        assert drain() == 1
+        assert StripeWebhookQueueItem.query.count() == 0
+        assert StripeProcessedEvent.query.count() == 1
+
+        user = User.query.first()
+        assert DateTimeNaiveHelper.make_timezone_aware(user.access_until) > get_current_utc()
+
+    def test_invalid_and_irrelevant_events_are_not_queued(self, async_client):
+        response = async_client.post("/stripe/webhook", data=json.dumps({}), content_type='application/json')
+        assert response.status_code == 400
+
+        response = async_client.post("/stripe/webhook", data=json.dumps({
+            "id": "evt_123", "type": "customer.subscription.created", "data": {"object": {}}
+        }), content_type='application/json')
+        assert response.status_code == 400
+
+        event = create_bare_event("evt_124", "some.unknown.event.type", "cus_123")
+        response = async_client.post("/stripe/webhook", data=event, content_type='application/json')
+        assert response.status_code == 200
+        assert StripeWebhookQueueItem.query.count() == 0
+
+    def test_redelivery_while_queued(self, async_client):
+        event = create_subscription_event("evt_123", "customer.subscription.created", "cus_123")
+        async_client.post("/stripe/webhook", data=event, content_type='application/json')
+
+        response = async_client.post("/stripe/webhook", data=event, content_type='application/json')
+        assert response.status_code == 200
+        assert response.json["message"] == "Event already queued"
+        assert StripeWebhookQueueItem.query.count() == 1
+
+    def test_redelivery_of_processed_event_is_not_queued(self, async_client):
+        event = create_subscription_event("evt_123", "customer.subscription.created", "cus_123")
+        async_client.post("/stripe/webhook", data=event, content_type='application/json')
+        drain()
+
+        response = async_client.post("/stripe/webhook", data=event, content_type='application/json')
+        assert response.status_code == 200
+        assert response.json["message"] == "Event already processed"
+        assert StripeWebhookQueueItem.query.count() == 0
+
+    def test_already_processed_event_is_dropped(self, async_client, monkeypatch):
+        event = create_subscription_event("evt_123", "customer.subscription.created", "cus_123")
+        async_client.post("/stripe/webhook", data=event, content_type='application/json')
+
+        # the same event gets processed synchronously while it is still queued
+        monkeypatch.setitem(async_client.application.config, "WEBHOOK_ASYNC_MODE", False)
+        async_client.post("/stripe/webhook", data=event, content_type='application/json')
+
+        assert drain() == 1
+        assert StripeWebhookQueueItem.query.count() == 0
+        assert StripeProcessedEvent.query.count() == 1
+
+    def test_events_for_same_customer_processed_in_order(self, async_client):
+        async_client.post("/stripe/webhook", data=create_subscription_event(
+            "evt_1", "customer.subscription.created", "cus_123"), content_type='application/json')
+        async_client.post("/stripe/webhook", data=create_bare_event(
+            "evt_2", "customer.subscription.deleted", "cus_123"), content_type='application/json')
+
+        assert drain() == 2
+        user = User.query.first()
+        assert DateTimeNaiveHelper.make_timezone_aware(user.access_until) <= get_current_utc()
+
+    def test_failure_blocks_only_that_customer(self, async_client):
+        for event in [create_subscription_event("evt_1", "customer.subscription.created", "cus_123"),
+                      create_bare_event("evt_2", "customer.subscription.deleted", "cus_123"),
+                      create_subscription_event("evt_3", "customer.subscription.created", "cus_456")]:
+            async_client.post("/stripe/webhook", data=event, content_type='application/json')
+
+        original = StripeWebhookHandler._handle_event_by_type
+
+        def fail_for_first_customer(event_data, user):
+            if user.stripe_customer_id == "cus_123":
+                raise Exception("Database error")
+            original(event_data, user)
+
+        with patch.object(StripeWebhookHandler, "_handle_event_by_type", side_effect=fail_for_first_customer):
+            assert drain(max_attempts=1) == 1
+
+        items = StripeWebhookQueueItem.query.order_by(StripeWebhookQueueItem.id).all()
+        assert [item.stripe_event_id for item in items] == ["evt_1", "evt_2"]
+        assert items[0].attempts == 1
+        assert items[0].failed
+        assert items[1].attempts == 0
+        assert User.query.filter_by(stripe_customer_id="cus_456").count() == 1
+
+    def test_worker_pool_drains_queue(self, async_client):
+        for index in range(10):
+            event = create_subscription_event(f"evt_{index}", "customer.subscription.created", f"cus_{index}")
+            async_client.post("/stripe/webhook", data=event, content_type='application/json')
+
+        pool = WebhookQueueWorkerPool(async_client.application)
+        pool.poll_interval = 0.01
+        pool.start()
+        try:
+            deadline = time.monotonic() + 5
+            while StripeWebhookQueueItem.query.count() and time.monotonic() < deadline:
+                db.session.rollback()
+                time.sleep(0.01)
+        finally:
+            pool.stop()
+
+        assert StripeWebhookQueueItem.query.count() == 0
+        assert User.query.count() == 10
+
+    def test_events_are_drained_by_their_stored_shard(self, async_client, monkeypatch):
+        monkeypatch.setitem(async_client.application.config, "WEBHOOK_QUEUE_WORKERS", 4)
+        for index in range(8):
+            event = create_subscription_event(f"evt_{index}", "customer.subscription.created", f"cus_{index}")
+            async_client.post("/stripe/webhook", data=event, content_type='application/json')
+
+        items = StripeWebhookQueueItem.query.all()
+        assert all(item.shard == item.shard_key % 4 for item in items)
+
+        shard = items[0].shard
+        assert WebhookQueueHandler.drain_shard(shard, 100, 5) == sum(item.shard == shard for item in items)
+        assert all(item.shard != shard for item in StripeWebhookQueueItem.query.all())
+
+    def test_reshard_moves_events_to_the_new_worker_count(self, async_client, monkeypatch):
+        monkeypatch.setitem(async_client.application.config, "WEBHOOK_QUEUE_WORKERS", 4)
+        for index in range(8):
+            event = create_subscription_event(f"evt_{index}", "customer.subscription.created", f"cus_{index}")
+            async_client.post("/stripe/webhook", data=event, content_type='application/json')
+
+        expected_moves = sum(item.shard_key % 4 != item.shard_key % 2 for item in StripeWebhookQueueItem.query.all())
+        assert WebhookQueueHandler.reshard(2) == expected_moves
+        assert all(item.shard == item.shard_key % 2 for item in StripeWebhookQueueItem.query.all())
+        assert WebhookQueueHandler.reshard(2) == 0
+
+        assert WebhookQueueHandler.drain_shard(0, 100, 5) + WebhookQueueHandler.drain_shard(1, 100, 5) == 8
+        assert User.query.count() == 8
+
+    def test_drain_reads_the_shard_index(self, async_client):
+        plan = db.session.execute(db.text(
+            "EXPLAIN QUERY PLAN SELECT * FROM stripe_webhook_queue_item WHERE shard = 0 AND failed = 0 ORDER BY id"
+        )).all()
+        assert "ix_stripe_webhook_queue_item_shard_failed_id" in str(plan)